@@ -1,50 +1,275 @@
-import openai
-from huggingface_hub import InferenceClient
-from config import OPENAI_API_KEY, HF_API_TOKEN, logger
+import abc
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import httpx
+from metrics import registry, timed
+from tracing import tracer
+from config import (OPENAI_API_KEY, HF_API_TOKEN, AI_PROVIDER, OPENAI_MODEL, HF_MODEL, AI_TIMEOUT,
+                    AI_MAX_CONCURRENCY, AI_EXECUTOR_WORKERS, AI_BREAKER_FAILURES, AI_BREAKER_RESET,
+                    AI_STUB_LATENCY_MS, AI_STUB_FAILURE_RATE, logger)
+
+
+CONTEXT_PROMPT = "מידע מהאתר שעשוי לעזור בתשובה (השתמש בו רק אם הוא רלוונטי לשאלה):\n\n"
+
+AI_REQUEST_SECONDS = registry.histogram("ai_request_seconds", "AI provider call latency", ("provider", "outcome"))
+
+
+class CircuitBreaker:
+    """
+    מפסק זרם לספק AI: אחרי N כשלונות רצופים הספק "פתוח" ומדלגים עליו מיד,
+    ואחרי reset_timeout מאפשרים ניסיון בודד (half-open) לבדוק אם התאושש.
+    """
+
+    def __init__(self, failure_threshold=AI_BREAKER_FAILURES, reset_timeout=AI_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """הקריאה בוטלה לפני שהסתיימה - בלי הצלחה ובלי כשלון, אבל הבקשה הבאה צריכה לקבל ניסיון בודד חדש"""
+        self._probing = False
+
+
+class AIProvider(abc.ABC):
+    name = "base"
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.short_circuited = 0
+        self._total_ms = 0.0
+        self.client = None
+        self._load_lock = threading.Lock()
+
+    def _create_client(self):
+        return None
+
+    def load(self):
+        """
+        import של ספריית הספק ויצירת הלקוח - פעם אחת, רק כשצריך. ספריות ה-AI כבדות לטעינה,
+        ולכן הן לא נטענות בעליית השרת אלא ב-Thread ברקע (preload) או בקריאה הראשונה.
+        """
+        with self._load_lock:
+            if self.client is None:
+                self.client = self._create_client()
+        return self.client
+
+    async def get_client(self):
+        return self.client or await asyncio.to_thread(self.load)
+
+    @abc.abstractmethod
+    async def generate(self, messages):
+        """מחזיר את טקסט התשובה להודעות (פורמט Chat). שגיאה או Timeout נספרים ב-Circuit Breaker."""
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "state": self.breaker.state,
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "short_circuited": self.short_circuited,
+            "avg_ms": round(self._total_ms / self.calls, 1) if self.calls else 0.0,
+        }
+
+
+class OpenAIProvider(AIProvider):
+    """OpenAI עם לקוח אסינכרוני וחיבורי HTTP ממוחזרים (Keep-Alive)"""
+    name = "openai"
+
+    def __init__(self, api_key):
+        super().__init__()
+        self.api_key = api_key
+
+    def _create_client(self):
+        import openai
+        http = httpx.AsyncClient(
+            timeout=AI_TIMEOUT,
+            limits=httpx.Limits(max_connections=AI_MAX_CONCURRENCY, max_keepalive_connections=AI_MAX_CONCURRENCY),
+        )
+        # את ה-Retry מנהל AIService (מעבר לספק הבא), לא הספרייה
+        return openai.AsyncOpenAI(api_key=self.api_key, timeout=AI_TIMEOUT, max_retries=0, http_client=http)
+
+    async def generate(self, messages):
+        client = await self.get_client()
+        response = await client.chat.completions.create(model=OPENAI_MODEL, messages=messages)
+        return response.choices[0].message.content
+
+    async def close(self):
+        if self.client:
+            await self.client.close()
+
+
+class HuggingFaceProvider(AIProvider):
+    """HuggingFace InferenceClient הוא סינכרוני - רץ ב-Executor חסום כדי לא לעצור את ה-Event Loop"""
+    name = "huggingface"
+
+    def __init__(self, token):
+        super().__init__()
+        self.token = token
+        self.executor = ThreadPoolExecutor(max_workers=AI_EXECUTOR_WORKERS, thread_name_prefix="hf")
+
+    def _create_client(self):
+        from huggingface_hub import InferenceClient
+        return InferenceClient(token=self.token, timeout=AI_TIMEOUT)
+
+    async def generate(self, messages):
+        prompt = "\n".join(m["content"] for m in messages)
+        client = await self.get_client()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            partial(client.text_generation, prompt, model=HF_MODEL, max_new_tokens=100),
+        )
+
+    async def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class StubProvider(AIProvider):
+    """ספק מקומי לבדיקות עומס בלי רשת: השהיה ושיעור כשלונות ניתנים להגדרה"""
+    name = "stub"
+
+    def __init__(self, latency_ms=AI_STUB_LATENCY_MS, failure_rate=AI_STUB_FAILURE_RATE):
+        super().__init__()
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+
+    async def generate(self, messages):
+        await asyncio.sleep(self.latency_ms / 1000)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("stub provider failure")
+        return f"תשובה לדוגמה: {messages[-1]['content'][:50]}"
+
 
 class AIService:
     def __init__(self):
         self.use_openai = False
         self.use_hf = False
-        
-        if OPENAI_API_KEY:
-            openai.api_key = OPENAI_API_KEY
+        self.providers = []  # לפי סדר עדיפות
+        self._semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+        if AI_PROVIDER == "stub":
+            self.providers.append(StubProvider())
+            return
+
+        if OPENAI_API_KEY and AI_PROVIDER in ("auto", "openai"):
+            self.providers.append(OpenAIProvider(OPENAI_API_KEY))
             self.use_openai = True
-        elif HF_API_TOKEN:
-            self.hf_client = InferenceClient(token=HF_API_TOKEN)
+        if HF_API_TOKEN and AI_PROVIDER in ("auto", "hf"):
+            self.providers.append(HuggingFaceProvider(HF_API_TOKEN))
             self.use_hf = True
-            
-    async def get_response(self, user_text):
-        """שולף תגובה מ-AI (נותן עדיפות ל-OpenAI)"""
-        
+
+    async def _call(self, provider, messages):
+        async with self._semaphore:
+            return await provider.generate(messages)
+
+    @timed("ai", "get_response")
+    async def get_response(self, user_text, history=None, context=None):
+        """
+        שולף תגובה מ-AI (נותן עדיפות ל-OpenAI, ועובר לספק הבא בכשל/Timeout).
+        history - הודעות קודמות בפורמט Chat (ראה conversation_memory).
+        context - קטעי מידע רלוונטיים (למשל מה-FAQ, ראה faq_index) שמצורפים כהודעת מערכת.
+        """
+
         # תגובה פשוטה אם אף מפתח לא מוגדר
-        if not self.use_openai and not self.use_hf:
+        if not self.providers:
             return "מערכת ה-AI אינה מוגדרת כרגע. אנא פנה לתמיכה."
 
-        # שימוש ב-OpenAI
-        if self.use_openai:
-            try:
-                response = await openai.ChatCompletion.acreate(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": user_text}]
-                )
-                return response.choices[0].message.content
-            except Exception as e:
-                logger.error(f"OpenAI Error: {e}")
-                
-        # שימוש ב-HuggingFace כחלופה/גיבוי
-        if self.use_hf:
+        messages = list(history or []) + [{"role": "user", "content": user_text}]
+        if context:
+            messages.insert(0, {"role": "system", "content": CONTEXT_PROMPT + "\n\n".join(context)})
+        for provider in self.providers:
+            if not provider.breaker.allow():
+                provider.short_circuited += 1
+                continue
+
+            started = time.perf_counter()
+            provider.calls += 1
+            outcome = "error"
             try:
-                # מומלץ להשתמש במודל פתוח ומהיר, לדוגמה:
-                output = self.hf_client.text_generation(
-                    user_text, 
-                    model="google/flan-t5-large", # ניתן להחליף למודל בעברית טוב יותר
-                    max_new_tokens=100
-                )
-                return output
+                # ה-Timeout כולל גם המתנה לסמפור, כך שעומס לא מעכב את המעבר לגיבוי
+                result = await asyncio.wait_for(self._call(provider, messages), timeout=AI_TIMEOUT)
+            except asyncio.CancelledError:
+                # CancelledError אינו Exception - בלי זה ניסיון half-open שבוטל היה משאיר את הספק חסום לתמיד
+                outcome = "cancelled"
+                provider.breaker.release_probe()
+                raise
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+                provider.timeouts += 1
+                provider.failures += 1
+                provider.breaker.record_failure()
+                logger.error(f"{provider.name} timed out after {AI_TIMEOUT}s")
             except Exception as e:
-                logger.error(f"HuggingFace Error: {e}")
-        
+                provider.failures += 1
+                provider.breaker.record_failure()
+                logger.error(f"{provider.name} Error: {e}")
+            else:
+                outcome = "ok"
+                provider.breaker.record_success()
+                return result
+            finally:
+                elapsed = time.perf_counter() - started
+                provider._total_ms += elapsed * 1000
+                AI_REQUEST_SECONDS.labels(provider.name, outcome).observe(elapsed)
+                tracer.add("ai", elapsed)
+
         return "מצטער, חווינו שגיאה בכל המערכות החכמות."
 
+    async def preload(self):
+        """טעינת ספריות הספקים ברקע אחרי שהשרת מוכן, כדי שהמשתמש הראשון לא ישלם עליה"""
+        started = time.perf_counter()
+        results = await asyncio.gather(*(asyncio.to_thread(p.load) for p in self.providers), return_exceptions=True)
+        for provider, result in zip(self.providers, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to load AI provider {provider.name}: {result}")
+        if self.providers:
+            logger.info(f"AI providers loaded in {(time.perf_counter() - started) * 1000:.0f}ms.")
+
+    async def close(self):
+        for provider in self.providers:
+            await provider.close()
+
+    def stats(self):
+        return {provider.name: provider.stats() for provider in self.providers}
+
 ai_service = AIService()
@@ -0,0 +1,296 @@
+# קובץ: analytics.py
+"""
+אנליטיקת קמפיינים ומפנים מטבלאות סיכום מצטברות, כך שדוח הניהול לא סורק את users/crm_leads.
+- הרשמות והתפלגות ניקוד: מתעדכנות בזמן הכתיבה (add_user ושטיפת הניקוד ב-Write-Behind).
+- הודעות לפי intent ופניות לתמיכה: Job תקופתי שמעבד את crm_leads לפי High-water mark על id.
+  ה-Job מעבד רק עד id מקסימלי שנצפה לפני interval שניות לפחות, כך שטרנזקציה שקיבלה id נמוך יותר
+  ועוד לא עשתה Commit לא "מדולגת".
+קמפיין ריק נשמר כ-'direct'.
+"""
+
+import asyncio
+import time
+from database import get_db_pool, logger
+from partitions import high_water_mark
+from config import ANALYTICS_INTERVAL, ANALYTICS_BATCH_SIZE
+
+ANALYTICS_LOCK_KEY = 0xA7A1
+DIRECT_CAMPAIGN = "direct"
+
+# $1 = קמפיין, $2 = מפנה (או NULL), $3 = ניקוד התחלתי. רץ בתוך הטרנזקציה של add_user.
+RECORD_SIGNUP_SQL = """
+    WITH campaign AS (
+        INSERT INTO analytics_campaign_daily AS a (campaign, day, signups) VALUES ($1, CURRENT_DATE, 1)
+        ON CONFLICT (campaign, day) DO UPDATE SET signups = a.signups + 1
+    ), referrer AS (
+        INSERT INTO analytics_referrer AS a (referrer_id, signups)
+        SELECT $2, 1 WHERE $2::bigint IS NOT NULL
+        ON CONFLICT (referrer_id) DO UPDATE SET signups = a.signups + 1
+    )
+    INSERT INTO analytics_score_histogram AS a (campaign, score, users) VALUES ($1, $3, 1)
+    ON CONFLICT (campaign, score) DO UPDATE SET users = a.users + 1
+"""
+
+# העברת משתמשים בין תאי היסטוגרמת הניקוד אחרי שינוי lead_score, באותה פקודה.
+# משותף לשטיפת ה-Write-Behind (crm_manager) ולחישוב מחדש (scoring).
+SCORE_HISTOGRAM_SQL = """
+    INSERT INTO analytics_score_histogram AS h (campaign, score, users)
+    SELECT campaign, score, SUM(moved) FROM (
+        SELECT campaign, old_score AS score, -1 AS moved FROM upd WHERE new_score <> old_score
+        UNION ALL
+        SELECT campaign, new_score, 1 FROM upd WHERE new_score <> old_score
+    ) m
+    GROUP BY campaign, score
+    ON CONFLICT (campaign, score) DO UPDATE SET users = h.users + EXCLUDED.users
+"""
+
+
+def score_update_sql(update_ctes):
+    """
+    משלים שאילתת עדכון ניקוד: update_ctes הם ה-CTE-ים שמסתיימים ב-upd, שמחזיר (campaign, old_score, new_score).
+    נוספים עדכון ההיסטוגרמה, והשאילתה מחזירה את סכום השינוי בניקוד (ל-running_stats).
+    """
+    return f"""
+    WITH {update_ctes.strip()},
+    histogram AS ({SCORE_HISTOGRAM_SQL})
+    SELECT COALESCE(SUM(new_score - old_score), 0) FROM upd
+"""
+
+
+# שורות crm_leads בטווח ($1, $2] עם הקמפיין והמפנה של המשתמש
+LEADS_RANGE_SQL = """
+    SELECT l.id, l.source, COALESCE(l.intent_type, 'unknown') AS intent_type,
+           COALESCE(l.created_at, LOCALTIMESTAMP)::date AS day,
+           COALESCE(u.campaign_source, 'direct') AS campaign, u.referred_by
+    FROM crm_leads l LEFT JOIN users u ON u.user_id = l.user_id
+    WHERE l.id > $1 AND l.id <= $2 AND l.source IN ('user_msg', 'support_request')
+"""
+
+ROLLUP_SQL = [
+    # משתמשים שפנו לתמיכה לראשונה (להמרה לפי משתמשים ולא לפי לחיצות)
+    """
+    INSERT INTO analytics_support_users (user_id, lead_id, campaign, day, referrer_id)
+    SELECT DISTINCT ON (l.user_id) l.user_id, l.id, COALESCE(u.campaign_source, 'direct'),
+           COALESCE(l.created_at, LOCALTIMESTAMP)::date, u.referred_by
+    FROM crm_leads l LEFT JOIN users u ON u.user_id = l.user_id
+    WHERE l.id > $1 AND l.id <= $2 AND l.source = 'support_request'
+    ORDER BY l.user_id, l.id
+    ON CONFLICT (user_id) DO NOTHING
+    """,
+    f"""
+    INSERT INTO analytics_campaign_daily AS a (campaign, day, messages, support_requests, support_users)
+    SELECT campaign, day, SUM(messages), SUM(support_requests), SUM(support_users) FROM (
+        SELECT campaign, day, (source = 'user_msg')::int AS messages,
+               (source = 'support_request')::int AS support_requests, 0 AS support_users
+        FROM ({LEADS_RANGE_SQL}) l
+        UNION ALL
+        SELECT campaign, day, 0, 0, 1 FROM analytics_support_users WHERE lead_id > $1 AND lead_id <= $2
+    ) t
+    GROUP BY campaign, day
+    ON CONFLICT (campaign, day) DO UPDATE SET
+        messages = a.messages + EXCLUDED.messages,
+        support_requests = a.support_requests + EXCLUDED.support_requests,
+        support_users = a.support_users + EXCLUDED.support_users
+    """,
+    f"""
+    INSERT INTO analytics_intent_daily AS a (campaign, day, intent_type, messages)
+    SELECT campaign, day, intent_type, COUNT(*) FROM ({LEADS_RANGE_SQL}) l
+    WHERE source = 'user_msg'
+    GROUP BY campaign, day, intent_type
+    ON CONFLICT (campaign, day, intent_type) DO UPDATE SET messages = a.messages + EXCLUDED.messages
+    """,
+    f"""
+    INSERT INTO analytics_referrer AS a (referrer_id, messages, support_requests, support_users)
+    SELECT referrer_id, SUM(messages), SUM(support_requests), SUM(support_users) FROM (
+        SELECT referred_by AS referrer_id, (source = 'user_msg')::int AS messages,
+               (source = 'support_request')::int AS support_requests, 0 AS support_users
+        FROM ({LEADS_RANGE_SQL}) l WHERE referred_by IS NOT NULL
+        UNION ALL
+        SELECT referrer_id, 0, 0, 1 FROM analytics_support_users
+        WHERE lead_id > $1 AND lead_id <= $2 AND referrer_id IS NOT NULL
+    ) t
+    GROUP BY referrer_id
+    ON CONFLICT (referrer_id) DO UPDATE SET
+        messages = a.messages + EXCLUDED.messages,
+        support_requests = a.support_requests + EXCLUDED.support_requests,
+        support_users = a.support_users + EXCLUDED.support_users
+    """,
+]
+
+CAMPAIGNS_SQL = """
+    SELECT campaign, SUM(signups) AS signups, SUM(messages) AS messages,
+           SUM(support_requests) AS support_requests, SUM(support_users) AS support_users
+    FROM analytics_campaign_daily
+    WHERE day > CURRENT_DATE - $1::int
+    GROUP BY campaign
+    ORDER BY signups DESC
+"""
+
+INTENTS_SQL = """
+    SELECT campaign, intent_type, SUM(messages) AS messages
+    FROM analytics_intent_daily
+    WHERE day > CURRENT_DATE - $1::int
+    GROUP BY campaign, intent_type
+"""
+
+DAILY_SQL = """
+    SELECT day, signups, messages, support_requests, support_users
+    FROM analytics_campaign_daily
+    WHERE campaign = $1 AND day > CURRENT_DATE - $2::int
+    ORDER BY day
+"""
+
+
+async def record_signup(conn, campaign_source, referred_by, initial_score=1):
+    """נקרא בתוך הטרנזקציה של add_user, רק למשתמש חדש"""
+    await conn.execute(RECORD_SIGNUP_SQL, campaign_source or DIRECT_CAMPAIGN, referred_by, initial_score)
+
+
+def _rate(part, whole):
+    return round(part / whole, 4) if whole else 0.0
+
+
+class AnalyticsEngine:
+    def __init__(self, interval=ANALYTICS_INTERVAL, batch_size=ANALYTICS_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._candidate = None  # ה-id המקסימלי שנראה לאחרונה
+        self._candidate_at = 0.0
+        self._safe_upper = 0    # עד כאן כל הטרנזקציות כבר הסתיימו
+        self._task = None
+        # מדדים
+        self.runs = 0
+        self.ids_processed = 0
+        self.last_id = 0
+        self.last_run_ms = 0.0
+        self.errors = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Analytics rollup job started.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.run_once() >= self.batch_size:
+                    pass  # יש עוד פיגור - ממשיכים מיד
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Analytics rollup failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """מעבד את השורות החדשות ב-crm_leads עד הגבול הבטוח. מחזיר את מספר ה-id שעובדו."""
+        pool = await get_db_pool()
+        if not pool: return 0
+
+        started = time.perf_counter()
+        # Candidate שנצפה לפני interval שניות לפחות הופך לגבול הבטוח לעיבוד
+        if self._candidate is not None and started - self._candidate_at >= self.interval:
+            self._safe_upper, self._candidate = self._candidate, None
+
+        processed = 0
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # הגנה מפני שני תהליכים שמריצים את ה-Job במקביל
+                if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", ANALYTICS_LOCK_KEY):
+                    return 0
+                last_id = await conn.fetchval(
+                    "SELECT last_id FROM analytics_state WHERE name = 'crm_leads' FOR UPDATE"
+                )
+                upper = min(self._safe_upper, last_id + self.batch_size)
+                if upper > last_id:
+                    for sql in ROLLUP_SQL:
+                        await conn.execute(sql, last_id, upper)
+                    await conn.execute("UPDATE analytics_state SET last_id = $1 WHERE name = 'crm_leads'", upper)
+                    processed = upper - last_id
+                    last_id = upper
+            if self._candidate is None:
+                self._candidate = await high_water_mark(conn)
+                self._candidate_at = time.perf_counter()
+
+        self.runs += 1
+        self.ids_processed += processed
+        self.last_id = last_id
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+        return processed
+
+    async def report(self, days=30, top_referrers=10):
+        """דוח מלא מטבלאות הסיכום - זמן קבוע ביחס לכמות המשתמשים וההודעות"""
+        pool = await get_db_pool()
+        if not pool: return {}
+
+        async with pool.acquire() as conn:
+            campaigns = await conn.fetch(CAMPAIGNS_SQL, days)
+            intents = await conn.fetch(INTENTS_SQL, days)
+            histogram = await conn.fetch(
+                "SELECT campaign, score, users FROM analytics_score_histogram WHERE users > 0 ORDER BY campaign, score"
+            )
+            referrers = await conn.fetch("""
+                SELECT referrer_id, signups, messages, support_requests, support_users
+                FROM analytics_referrer ORDER BY signups DESC LIMIT $1
+            """, top_referrers)
+
+        by_campaign = {}
+        for row in campaigns:
+            by_campaign[row["campaign"]] = {
+                "signups": row["signups"],
+                "messages": row["messages"],
+                "support_requests": row["support_requests"],
+                "support_users": row["support_users"],
+                "support_conversion": _rate(row["support_users"], row["signups"]),
+                "intents": {},
+                "score_distribution": {},
+                "avg_score": 0.0,
+            }
+        for row in intents:
+            entry = by_campaign.get(row["campaign"])
+            if entry is not None:
+                entry["intents"][row["intent_type"]] = row["messages"]
+        for row in histogram:
+            entry = by_campaign.get(row["campaign"])
+            if entry is not None:
+                entry["score_distribution"][row["score"]] = row["users"]
+        for entry in by_campaign.values():
+            distribution = entry["score_distribution"]
+            total = sum(distribution.values())
+            entry["avg_score"] = round(sum(s * n for s, n in distribution.items()) / total, 2) if total else 0.0
+
+        return {
+            "days": days,
+            "campaigns": by_campaign,
+            "top_referrers": [
+                dict(row, support_conversion=_rate(row["support_users"], row["signups"])) for row in referrers
+            ],
+            "rollup": {"last_id": self.last_id, "runs": self.runs},
+        }
+
+    async def daily(self, campaign, days=30):
+        pool = await get_db_pool()
+        if not pool: return []
+
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(DAILY_SQL, campaign, days)
+        return [dict(row, day=row["day"].isoformat()) for row in rows]
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "ids_processed": self.ids_processed,
+            "last_id": self.last_id,
+            "last_run_ms": round(self.last_run_ms, 1),
+            "errors": self.errors,
+        }
+
+
+analytics = AnalyticsEngine()
@@ -0,0 +1,140 @@
+# קובץ: benchmarks/bench_db_pool.py
+"""
+תפוקה וזמני תגובה של השאילתות החמות תחת עומס מקבילי, בשלוש תצורות Pool:
+ברירת המחדל של asyncpg, ה-Pool המכוון של הבוט (database.py) עם Prepared Statements חמים,
+ו-Pool בלי מטמון Statements (כמו מאחורי PgBouncer במצב transaction).
+יוצר סכמה זמנית במסד שב-DATABASE_URL.
+
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/bench_db_pool.py --concurrency 10 50 200
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import asyncpg
+import database
+import crm_manager
+import referral_tree
+
+SCHEMA = "bench_db_pool"
+
+QUERIES = [crm_manager.LEAD_SCORE, referral_tree.DIRECT_COUNT, referral_tree.DOWNLINE_COUNT]
+
+
+async def set_search_path(conn):
+    await conn.execute(f"SET search_path TO {SCHEMA}")
+
+
+async def setup(dsn, users):
+    conn = await asyncpg.connect(dsn)
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    await set_search_path(conn)
+    await conn.execute("CREATE TABLE users (user_id BIGINT PRIMARY KEY, lead_score INT DEFAULT 1)")
+    await conn.execute("""
+        CREATE TABLE referral_counts (user_id BIGINT PRIMARY KEY, direct_count INT DEFAULT 0, downline_count INT DEFAULT 0)
+    """)
+    await conn.copy_records_to_table("users", records=((i, i % 10 + 1) for i in range(1, users + 1)))
+    await conn.copy_records_to_table(
+        "referral_counts", records=((i, i % 7, i % 31) for i in range(1, users + 1) if i % 3 == 0)
+    )
+    await conn.execute("ANALYZE")
+    return conn
+
+
+async def default_pool(dsn, size):
+    raw = await asyncpg.create_pool(dsn, min_size=size, max_size=size, init=set_search_path)
+
+    async def query(name, user_id):
+        async with raw.acquire() as conn:
+            return await conn.fetchval(database.HOT_STATEMENTS[name], user_id)
+    return raw, query
+
+
+async def tuned_pool(dsn, size):
+    async def init(conn):
+        await set_search_path(conn)
+        await database._init_connection(conn)
+
+    raw = await asyncpg.create_pool(
+        dsn, min_size=size, max_size=size, statement_cache_size=database.DB_STATEMENT_CACHE_SIZE,
+        max_queries=database.DB_MAX_QUERIES, connection_class=database.CRMConnection, init=init,
+    )
+    pool = database.InstrumentedPool(raw)
+
+    async def query(name, user_id):
+        async with pool.acquire() as conn:
+            return await conn.fetchval_hot(name, user_id)
+    return raw, query
+
+
+async def uncached_pool(dsn, size):
+    raw = await asyncpg.create_pool(dsn, min_size=size, max_size=size, statement_cache_size=0, init=set_search_path)
+
+    async def query(name, user_id):
+        async with raw.acquire() as conn:
+            return await conn.fetchval(database.HOT_STATEMENTS[name], user_id)
+    return raw, query
+
+
+VARIANTS = {
+    "asyncpg default": default_pool,
+    "tuned + hot prepared": tuned_pool,
+    "no statement cache": uncached_pool,
+}
+
+
+async def run_load(query, concurrency, requests, users, rng):
+    latencies = []
+    plan = [(rng.choice(QUERIES), rng.randint(1, users)) for _ in range(requests)]
+    position = 0
+
+    async def client():
+        nonlocal position
+        while position < len(plan):
+            name, user_id = plan[position]
+            position += 1
+            started = time.perf_counter()
+            await query(name, user_id)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return requests / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--pool-size", type=int, default=database.DB_POOL_MAX_SIZE)
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    args = parser.parse_args()
+
+    dsn = os.environ["DATABASE_URL"].replace("postgres://", "postgresql://")
+    admin = await setup(dsn, args.users)
+    try:
+        for variant, make_pool in VARIANTS.items():
+            raw, query = await make_pool(dsn, args.pool_size)
+            try:
+                await run_load(query, args.pool_size, 1000, args.users, random.Random(0))  # חימום
+                for concurrency in args.concurrency:
+                    qps, p50, p99 = await run_load(query, concurrency, args.requests, args.users, random.Random(concurrency))
+                    print(f"{variant:<22} clients={concurrency:<5} {qps:>9,.0f} q/s  p50={p50:7.3f}ms p99={p99:7.3f}ms")
+            finally:
+                await raw.close()
+    finally:
+        await admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await admin.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+# קובץ: benchmarks/bench_faq.py
+"""
+זמן חיפוש באינדקס ה-FAQ (faq_index.py): האינדקס ההפוך ב-NumPy מול מעבר על כל הקורפוס ב-Python
+(דמיון קוסינוס בין מילוני n-gram), על ה-FAQ של האתר ועל קורפוס סינתטי גדול יותר.
+לא מתחבר ל-DB או לטלגרם.
+
+    python benchmarks/bench_faq.py --entries 2000 --queries 2000
+"""
+
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import faq_index
+from intent_engine import normalize
+
+WORDS = ("מחיר עלות בוט טלגרם אתר קמפיין לקוחות לידים הפניות תמיכה שירות חודשי התקנה זמן ימים "
+         "שאלה תשובה חיבור מערכת דוחות פרסום ווטסאפ אפליקציה הדרכה חוזה ביטול").split()
+
+
+def synthetic(entries, rng):
+    return [
+        faq_index.FAQEntry(" ".join(rng.choices(WORDS, k=6)) + "?", " ".join(rng.choices(WORDS, k=30)), ())
+        for _ in range(entries)
+    ]
+
+
+def python_search(corpus, text):
+    """נקודת ההשוואה: וקטור n-gram לכל שאלה, חישוב קוסינוס מול כל הקורפוס בכל חיפוש"""
+    query = faq_index._grams(normalize(text))
+    query_norm = math.sqrt(sum(v * v for v in query.values()))
+    best, best_score = None, 0.0
+    for entry in corpus:
+        grams = faq_index._grams(normalize(entry.question))
+        dot = sum(count * grams[gram] for gram, count in query.items() if gram in grams)
+        score = dot / (query_norm * math.sqrt(sum(v * v for v in grams.values())) or 1)
+        if score > best_score:
+            best, best_score = entry, score
+    return best, best_score
+
+
+def measure(label, fn, queries):
+    samples = []
+    for text in queries:
+        started = time.perf_counter()
+        fn(text)
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    print(f"  {label:<14} p50={statistics.median(samples):>9.0f}µs  p95={samples[int(len(samples) * 0.95)]:>9.0f}µs")
+    return statistics.median(samples)
+
+
+def bench(name, corpus, queries):
+    started = time.perf_counter()
+    service = faq_index.FAQService(reload_interval=0)
+    service.index = faq_index.FAQIndex(corpus)
+    build_ms = (time.perf_counter() - started) * 1000
+    print(f"{name}: {len(corpus):,} entries, {len(service.index.vocabulary):,} n-grams, build={build_ms:.0f}ms")
+    indexed = measure("inverted index", service.search, queries)
+    looped = measure("python loop", lambda text: python_search(corpus, text), queries[:200])
+    print(f"  x{looped / indexed:.1f}  answered directly: {service.stats()['deflection_rate']:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    site = faq_index.load_corpus(faq_index.SITE_FAQ_PATH)
+    if site:
+        queries = [rng.choice(site).question if rng.random() < 0.5 else " ".join(rng.choices(WORDS, k=8))
+                   for _ in range(args.queries)]
+        bench("site FAQ", site, queries)
+
+    corpus = synthetic(args.entries, rng)
+    queries = [rng.choice(corpus).question if rng.random() < 0.5 else " ".join(rng.choices(WORDS, k=8))
+               for _ in range(args.queries)]
+    bench("synthetic", corpus, queries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# קובץ: benchmarks/bench_metrics.py
+"""
+עלות המדידה לכל קריאה: פונקציה async ריקה מול אותה פונקציה עם timed, ועם Trace פעיל.
+לא דורש DB - מטרתו לוודא שאפשר להשאיר את המדדים פעילים בפרודקשן.
+
+    python benchmarks/bench_metrics.py --calls 200000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from metrics import timed, registry
+from tracing import tracer
+
+
+async def plain():
+    return None
+
+
+@timed("bench", "timed")
+async def measured():
+    return None
+
+
+@timed("bench", "timed_span", span="db")
+async def measured_span():
+    return None
+
+
+async def run(fn, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        await fn()
+    return (time.perf_counter() - started) / calls * 1e9
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200_000)
+    args = parser.parse_args()
+
+    baseline = await run(plain, args.calls)
+    print(f"{'plain':<26} {baseline:8.0f} ns/call")
+    print(f"{'timed':<26} {await run(measured, args.calls):8.0f} ns/call")
+    print(f"{'timed + span (no trace)':<26} {await run(measured_span, args.calls):8.0f} ns/call")
+    tracer.sample_rate = 1.0
+    with tracer.trace("bench"):
+        print(f"{'timed + span (sampled)':<26} {await run(measured_span, args.calls):8.0f} ns/call")
+
+    started = time.perf_counter()
+    text = registry.render()
+    print(f"render /metrics: {(time.perf_counter() - started) * 1000:.2f}ms, {len(text)} bytes")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+# קובץ: benchmarks/bench_partitions.py
+"""
+עלות הכנסה ושליפת היסטוריה אחרונה למשתמש ב-crm_leads, כפונקציה של גודל הטבלה:
+טבלה רגילה בלי אינדקס (המצב הקודם), טבלה רגילה עם אינדקס, וטבלה מחולקת למחיצות חודשיות.
+יוצר סכמות זמניות במסד שב-DATABASE_URL.
+
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/bench_partitions.py --sizes 100000 1000000 5000000
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import asyncpg
+import partitions
+from create_tables import CRM_LEADS_TABLE_SQL, PARTITIONED_CRM_LEADS_SQL
+
+COLUMNS = ["user_id", "message_content", "intent_type", "source", "created_at"]
+
+# אותה שליפה כמו conversation_memory
+HISTORY_SQL = """
+    SELECT message_content, source FROM crm_leads
+    WHERE user_id = $1 AND source = ANY($2::text[])
+      AND created_at >= LOCALTIMESTAMP - make_interval(days => 90)
+    ORDER BY created_at DESC
+    LIMIT 12
+"""
+
+
+async def setup_heap(conn):
+    await conn.execute(CRM_LEADS_TABLE_SQL)
+
+
+async def setup_heap_indexed(conn):
+    await conn.execute(CRM_LEADS_TABLE_SQL)
+    await conn.execute("CREATE INDEX ON crm_leads (user_id, created_at DESC)")
+
+
+async def setup_partitioned(conn, months):
+    # אותו מסלול כמו בפרודקשן: טבלה רגילה ← מיגרציה 7 ← העברת הטבלה הישנה ← מחיצות לחודשי העבר
+    await conn.execute(CRM_LEADS_TABLE_SQL)
+    async with conn.transaction():
+        for statement in PARTITIONED_CRM_LEADS_SQL:
+            await conn.execute(statement)
+    await partitions.migrate_legacy(conn, pause=0)
+    current = partitions.month_start(datetime.date.today())
+    for i in range(1, months + 1):
+        await partitions.create_partition(conn, partitions.add_months(current, -i))
+
+
+VARIANTS = {
+    "heap (no index)": setup_heap,
+    "heap + index": setup_heap_indexed,
+    "partitioned": setup_partitioned,
+}
+
+
+def generate_rows(count, users, months, rng, recent=False):
+    now = datetime.datetime.now()
+    span = datetime.timedelta(days=1 if recent else months * 30)
+    for _ in range(count):
+        yield (
+            rng.randint(1, users),
+            "הודעת בדיקה " * rng.randint(1, 8),
+            rng.choice(["pricing", "support", "general", None]),
+            rng.choice(["user_msg", "ai_reply"]),
+            now - span * rng.random(),
+        )
+
+
+async def timed_queries(conn, user_ids):
+    samples = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        await conn.fetch(HISTORY_SQL, user_id, ["user_msg", "ai_reply"])
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 5_000_000])
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--months", type=int, default=12, help="פיזור ההודעות לאחור")
+    parser.add_argument("--insert-batch", type=int, default=20_000, help="גודל ה-COPY הנמדד בכל גודל")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--keep", action="store_true", help="לא למחוק את סכמות הבדיקה בסיום")
+    args = parser.parse_args()
+
+    dsn = os.environ["DATABASE_URL"].replace("postgres://", "postgresql://")
+    conns = {}
+    try:
+        for index, (variant, setup) in enumerate(VARIANTS.items()):
+            schema = f"bench_partitions_{index}"
+            conn = await asyncpg.connect(dsn)
+            await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            await conn.execute(f"CREATE SCHEMA {schema}")
+            await conn.execute(f"SET search_path TO {schema}")
+            await (setup(conn, args.months) if setup is setup_partitioned else setup(conn))
+            conns[variant] = (schema, conn)
+
+        loaded = 0
+        for size in sorted(args.sizes):
+            rng = random.Random(-size)
+            fill = max(0, size - loaded)
+            probe = list(generate_rows(args.insert_batch, args.users, args.months, rng, recent=True))
+            user_ids = [rng.randint(1, args.users) for _ in range(args.queries)]
+            print(f"rows={size:>11,}")
+            for variant, (_, conn) in conns.items():
+                if fill:
+                    # אותן שורות לכל הגרסאות (אותו Seed), כ-Generator כדי לא להחזיק מיליונים בזיכרון
+                    rows = generate_rows(fill, args.users, args.months, random.Random(size))
+                    await conn.copy_records_to_table("crm_leads", records=rows, columns=COLUMNS)
+                    await conn.execute("ANALYZE crm_leads")
+                started = time.perf_counter()
+                await conn.copy_records_to_table("crm_leads", records=probe, columns=COLUMNS)
+                insert_s = time.perf_counter() - started
+                p50, p95 = await timed_queries(conn, user_ids)
+                print(f"    {variant:<16} insert={len(probe) / insert_s:>10,.0f} rows/s  "
+                      f"history p50={p50:7.3f}ms p95={p95:7.3f}ms")
+            loaded = size + len(probe)
+    finally:
+        for schema, conn in conns.values():
+            if not args.keep:
+                await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
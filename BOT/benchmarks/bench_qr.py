@@ -0,0 +1,76 @@
+# קובץ: benchmarks/bench_qr.py
+"""
+מיקרו-בנצ'מרק ל-QR: ציור מלא מול שכבות המטמון (זיכרון, דיסק, file_id).
+
+    python benchmarks/bench_qr.py --iterations 200
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from qr_generator import QRCache, build_referral_link, generate_user_qr
+
+BOT_USERNAME = "EliezerBenchBot"
+
+
+def report(name, samples_ms):
+    samples_ms.sort()
+    p50 = samples_ms[len(samples_ms) // 2]
+    p99 = samples_ms[int(len(samples_ms) * 0.99) - 1]
+    print(f"{name:<24} p50={p50:9.3f}ms  p99={p99:9.3f}ms  ops/s={1000 / (sum(samples_ms) / len(samples_ms)):10.0f}")
+
+
+async def timed(iterations, fn):
+    samples = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        await fn(i)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    n = args.iterations
+
+    async def render(i):
+        generate_user_qr(BOT_USERNAME, i, campaign_source="SHARE")
+
+    report("render (event loop)", await timed(n, render))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = QRCache(cache_dir=cache_dir)
+
+        async def cold(i):
+            await cache.get_photo(BOT_USERNAME, 10_000 + i, campaign_source="SHARE")
+
+        report("cache miss (worker)", await timed(n, cold))
+        report("memory hit", await timed(n, cold))
+
+        # מטמון חדש מעל אותה תיקייה = זיכרון ריק, דיסק חם
+        disk_cache = QRCache(cache_dir=cache_dir)
+
+        async def disk(i):
+            await disk_cache.get_png(build_referral_link(BOT_USERNAME, 10_000 + i, "SHARE"))
+
+        report("disk hit", await timed(n, disk))
+
+        for i in range(n):
+            link = build_referral_link(BOT_USERNAME, 10_000 + i, "SHARE")
+            cache.remember_file_id(cache.cache_key(link), f"file-id-{i}")
+
+        report("telegram file_id hit", await timed(n, cold))
+        cache.close()
+        disk_cache.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+# קובץ: benchmarks/bench_referrals.py
+"""
+השוואת ספירת רשת הפניות: CTE רקורסיבי על users.referred_by מול מונים ממומשים (referral_tree).
+יוצר סכמה זמנית במסד שב-DATABASE_URL, ממלא עץ אקראי ומודד זמני שליפה.
+
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/bench_referrals.py --sizes 10000 100000 1000000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import asyncpg
+import referral_tree
+from create_tables import USERS_TABLE_SQL, REFERRAL_TABLES_SQL
+
+SCHEMA = "bench_referrals"
+
+RECURSIVE_DOWNLINE_SQL = """
+    WITH RECURSIVE downline AS (
+        SELECT user_id FROM users WHERE referred_by = $1
+        UNION ALL
+        SELECT u.user_id FROM users u JOIN downline d ON u.referred_by = d.user_id
+    )
+    SELECT COUNT(*) FROM downline
+"""
+
+
+def generate_users(size, referral_ratio, seed):
+    """עץ אקראי: כל משתמש חדש מופנה (בהסתברות referral_ratio) ע"י משתמש קודם אקראי"""
+    rng = random.Random(seed)
+    for user_id in range(1, size + 1):
+        referred_by = rng.randint(1, user_id - 1) if user_id > 1 and rng.random() < referral_ratio else None
+        yield (user_id, f"user{user_id}", "Bench", referred_by, "BENCH", 1)
+
+
+async def timed_lookups(conn, sql, user_ids):
+    samples = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        await conn.fetchval(sql, user_id)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 3),
+        "max_ms": round(samples[-1], 3),
+    }
+
+
+async def bench_size(conn, size, lookups, referral_ratio):
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    await conn.execute(f"SET search_path TO {SCHEMA}")
+    await conn.execute(USERS_TABLE_SQL)
+    for statement in REFERRAL_TABLES_SQL:
+        await conn.execute(statement)
+
+    started = time.perf_counter()
+    await conn.copy_records_to_table(
+        "users",
+        records=generate_users(size, referral_ratio, seed=size),
+        columns=["user_id", "username", "first_name", "referred_by", "campaign_source", "lead_score"],
+    )
+    # אותו אינדקס שה-CTE היה מקבל במקרה הטוב ביותר
+    await conn.execute("CREATE INDEX ON users (referred_by)")
+    await conn.execute("ANALYZE")
+    load_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    closure_rows = await referral_tree.backfill(conn)
+    await conn.execute("ANALYZE")
+    backfill_s = time.perf_counter() - started
+
+    # דגימה מוטה למשתמשים מוקדמים - בעלי הרשתות הגדולות ביותר
+    rng = random.Random(size)
+    user_ids = [int(size ** rng.random()) for _ in range(lookups)]
+
+    cte = await timed_lookups(conn, RECURSIVE_DOWNLINE_SQL, user_ids)
+    closure = await timed_lookups(conn, "SELECT downline_count FROM referral_counts WHERE user_id = $1", user_ids)
+    print(f"users={size:>9,} closure_rows={closure_rows:>11,} load={load_s:6.1f}s backfill={backfill_s:6.1f}s")
+    print(f"    recursive CTE : {cte}")
+    print(f"    closure counts: {closure}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--referral-ratio", type=float, default=0.7)
+    parser.add_argument("--keep", action="store_true", help="לא למחוק את סכמת הבדיקה בסיום")
+    args = parser.parse_args()
+
+    dsn = os.environ["DATABASE_URL"].replace("postgres://", "postgresql://")
+    conn = await asyncpg.connect(dsn)
+    try:
+        for size in args.sizes:
+            await bench_size(conn, size, args.lookups, args.referral_ratio)
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
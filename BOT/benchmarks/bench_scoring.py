@@ -0,0 +1,146 @@
+# קובץ: benchmarks/bench_scoring.py
+"""
+חישוב הניקוד של scoring.py: המעבר הווקטורי (NumPy) מול לולאת Python לכל משתמש, על נתונים סינתטיים.
+עם DATABASE_URL - גם הכתיבה: UPDATE אחד עם unnest לכל Batch (APPLY_SCORES_SQL) מול UPDATE לכל שורה,
+על סכמה זמנית במסד.
+
+    python benchmarks/bench_scoring.py --users 1000000 --events 3000000
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/bench_scoring.py --db-users 200000
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import scoring
+
+SCHEMA = "bench_scoring"
+SOURCES = ["user_msg", "user_msg", "user_msg", "qr_request", "support_request"]
+INTENTS = list(scoring.DEFAULT_INTENT_WEIGHTS) + ["", "אחר"]
+
+
+def synthetic(users, events, rng):
+    user_rows = [
+        {"user_id": i, "score_raw": raw, "age_days": age, "lead_score": 1, "direct_count": direct, "downline_count": direct * 2}
+        for i, raw, age, direct in zip(
+            range(1, users + 1), rng.exponential(3, users).tolist(), rng.uniform(0, 2, users).tolist(),
+            rng.poisson(0.3, users).tolist(),
+        )
+    ]
+    event_rows = [
+        {"user_id": user_id, "source": SOURCES[source], "intent_type": INTENTS[intent], "age_days": age}
+        for user_id, source, intent, age in zip(
+            rng.integers(1, users + 1, events).tolist(), rng.integers(0, len(SOURCES), events).tolist(),
+            rng.integers(0, len(INTENTS), events).tolist(), rng.uniform(0, 90, events).tolist(),
+        )
+    ]
+    return event_rows, user_rows
+
+
+def python_rescore(engine, events, user_rows):
+    """אותו מודל, משתמש אחרי משתמש - נקודת ההשוואה"""
+    weights = engine.weights
+    added = {}
+    for row in events:
+        points = weights.sources.get(row["source"], 0.0) + weights.intents.get(row["intent_type"], 0.0)
+        points *= 2 ** (-max(row["age_days"], 0.0) / engine.half_life_days)
+        added[row["user_id"]] = added.get(row["user_id"], 0.0) + points
+    scores = {}
+    for row in user_rows:
+        raw = row["score_raw"] * 2 ** (-max(row["age_days"], 0.0) / engine.half_life_days) + added.get(row["user_id"], 0.0)
+        total = (raw + weights.referrals["direct"] * math.log1p(row["direct_count"])
+                 + weights.referrals["downline"] * math.log1p(row["downline_count"]))
+        scores[row["user_id"]] = 1 + round((scoring.MAX_LEAD_SCORE - 1) * (1 - math.exp(-max(total, 0.0) / engine.scale)))
+    return scores
+
+
+def bench_math(users, events):
+    engine = scoring.LeadScoringEngine()
+    event_rows, user_rows = synthetic(users, events, np.random.default_rng(0))
+
+    started = time.perf_counter()
+    ids, _, vectorized, _ = engine.rescore(event_rows, user_rows)
+    vectorized_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    looped = python_rescore(engine, event_rows, user_rows)
+    loop_s = time.perf_counter() - started
+
+    mismatches = sum(looped[user_id] != score for user_id, score in zip(ids.tolist(), vectorized.tolist()))
+    print(f"rescore {users:,} users / {events:,} events: numpy={vectorized_s:.2f}s  python loop={loop_s:.2f}s  "
+          f"x{loop_s / vectorized_s:.1f}  (mismatches: {mismatches})")
+
+
+async def bench_write(dsn, users, batch_size):
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn)
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    await conn.execute(f"SET search_path TO {SCHEMA}")
+    try:
+        await conn.execute("""
+            CREATE TABLE users (
+                user_id BIGINT PRIMARY KEY, campaign_source TEXT, lead_score INTEGER DEFAULT 1,
+                score_raw DOUBLE PRECISION NOT NULL DEFAULT 0, score_as_of TIMESTAMP
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE analytics_score_histogram (
+                campaign TEXT, score INTEGER, users INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (campaign, score)
+            )
+        """)
+        await conn.copy_records_to_table("users", records=((i, f"c{i % 5}", 1) for i in range(1, users + 1)),
+                                         columns=["user_id", "campaign_source", "lead_score"])
+        await conn.execute("ANALYZE users")
+
+        rng = np.random.default_rng(1)
+        ids = list(range(1, users + 1))
+        raw = rng.exponential(3, users).tolist()
+        scores = rng.integers(1, 11, users).tolist()
+        now = await conn.fetchval("SELECT LOCALTIMESTAMP")
+
+        started = time.perf_counter()
+        for start in range(0, users, batch_size):
+            end = start + batch_size
+            async with conn.transaction():
+                await conn.fetchval(scoring.APPLY_SCORES_SQL, ids[start:end], raw[start:end], scores[start:end], now)
+        bulk_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        async with conn.transaction():
+            await conn.executemany(
+                "UPDATE users SET score_raw = $2, score_as_of = $3, lead_score = $4 WHERE user_id = $1",
+                ((user_id, value + 1, now, score % 10 + 1) for user_id, value, score in zip(ids, raw, scores)),
+            )
+        row_s = time.perf_counter() - started
+
+        print(f"write {users:,} scores: unnest batches of {batch_size:,}={bulk_s:.2f}s ({users / bulk_s:,.0f} rows/s)  "
+              f"per-row UPDATE={row_s:.2f}s ({users / row_s:,.0f} rows/s)  x{row_s / bulk_s:.1f}")
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--events", type=int, default=3_000_000)
+    parser.add_argument("--db-users", type=int, default=200_000)
+    parser.add_argument("--batch-size", type=int, default=scoring.SCORING_BATCH_SIZE)
+    args = parser.parse_args()
+
+    bench_math(args.users, args.events)
+    if os.getenv("DATABASE_URL"):
+        dsn = os.environ["DATABASE_URL"].replace("postgres://", "postgresql://")
+        asyncio.run(bench_write(dsn, args.db_users, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# קובץ: benchmarks/bench_startup.py
+"""
+זמן ה-import הקר של main (מה שכל הפעלה מחדש ב-Railway משלמת לפני האתחול עצמו),
+ב-Interpreter חדש בכל חזרה, ורשימת המודולים הכבדים לפי python -X importtime.
+לא מתחבר ל-DB או לטלגרם. את זמני שלבי האתחול עצמם מחזיר GET /startup.
+
+    python benchmarks/bench_startup.py --runs 5 --top 15
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ENV = dict(os.environ, TELEGRAM_BOT_TOKEN=os.getenv("TELEGRAM_BOT_TOKEN", "123456:BENCH"), LOG_LEVEL="ERROR")
+
+
+def import_main():
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=BOT_DIR, env=ENV, check=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def heaviest_imports(top):
+    """(מצטבר ms, מודול) לפי -X importtime, רק מודולים ברמה העליונה של כל חבילה"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=BOT_DIR, env=ENV, capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if "." not in name:
+            modules.append((int(cumulative) / 1000, name))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    samples = [import_main() for _ in range(args.runs)]
+    print(f"import main (incl. interpreter start): median={statistics.median(samples):.0f}ms "
+          f"min={min(samples):.0f}ms max={max(samples):.0f}ms")
+
+    print(f"\n{'cumulative ms':>14}  module")
+    for ms, name in heaviest_imports(args.top):
+        print(f"{ms:>14.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# קובץ: benchmarks/bench_static.py
+"""
+הגשת דף הנחיתה: static_assets.py (דחוס מראש בזיכרון, ETag ו-304) מול קריאת הקובץ מהדיסק ודחיסת gzip
+בכל בקשה. בתוך התהליך, בלי שרת. עם --url - גם בקשות HTTP במקביל לשרת שרץ (uvicorn main:app).
+
+    python benchmarks/bench_static.py --requests 5000 --revalidate 0.5
+    python benchmarks/bench_static.py --url http://localhost:8080 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import gzip
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from static_assets import static_assets
+
+ACCEPT = "gzip, deflate, br"
+
+
+def naive_serve(path, accept_encoding):
+    """נקודת ההשוואה: פתיחה וקריאה של הקובץ ודחיסה מחדש בכל בקשה, בלי ETag"""
+    filename = "index.html" if path == "/" else path.lstrip("/")
+    with open(os.path.join(static_assets.root, filename), "rb") as f:
+        body = f.read()
+    if "gzip" in accept_encoding:
+        return 200, {"Content-Encoding": "gzip"}, gzip.compress(body)
+    return 200, {}, body
+
+
+def run(label, fn, requests):
+    sent = 0
+    started = time.perf_counter()
+    for args in requests:
+        sent += len(fn(*args)[2])
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<22} {len(requests) / elapsed:>10,.0f} req/s  {sent / len(requests) / 1024:>7.1f} KB/req")
+    return elapsed
+
+
+def bench_in_process(total, revalidate):
+    asyncio.run(static_assets.load())
+    rng = random.Random(0)
+    paths = [f"/{name}" if name != "index.html" else "/" for name in static_assets.filenames
+             if f"/{name}" in static_assets.routes]
+    etags = {path: static_assets.serve(path, ACCEPT)[1]["ETag"] for path in paths}
+
+    requests = []
+    for _ in range(total):
+        path = rng.choice(paths)
+        requests.append((path, ACCEPT, etags[path] if rng.random() < revalidate else None))
+
+    print(f"{total:,} requests over {', '.join(paths)} ({revalidate:.0%} with If-None-Match):")
+    naive_s = run("read + gzip per request", lambda path, accept, _: naive_serve(path, accept), requests)
+    cached_s = run("static_assets", static_assets.serve, requests)
+    print(f"  x{naive_s / cached_s:.0f}  (304: {static_assets.not_modified:,})")
+
+
+async def bench_http(url, total, concurrency):
+    import httpx
+
+    async with httpx.AsyncClient(base_url=url, headers={"Accept-Encoding": ACCEPT}) as client:
+        etag = (await client.get("/")).headers.get("ETag")
+        for label, headers in (("GET /", {}), ("GET / If-None-Match", {"If-None-Match": etag or ""})):
+            statuses = {}
+            queue = iter(range(total))
+
+            async def worker():
+                for _ in queue:
+                    response = await client.get("/", headers=headers)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+            print(f"  {label:<22} {total / elapsed:>10,.0f} req/s  statuses={statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--revalidate", type=float, default=0.5, help="חלק הבקשות עם If-None-Match תואם")
+    parser.add_argument("--url", help="שרת שרץ לבדיקת HTTP")
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    bench_in_process(args.requests, args.revalidate)
+    if args.url:
+        print(f"HTTP {args.url}, concurrency {args.concurrency}:")
+        asyncio.run(bench_http(args.url, args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
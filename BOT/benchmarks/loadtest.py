@@ -0,0 +1,525 @@
+# קובץ: benchmarks/loadtest.py
+"""
+בדיקת עומס מקצה לקצה לבוט, בלי טלגרם אמיתי ובלי ספק AI:
+- שרת Bot API מדומה (FastAPI) עם השהיה ניתנת להגדרה - הבוט מופנה אליו דרך TELEGRAM_API_BASE_URL.
+- ספק AI מדומה (AI_PROVIDER=stub) עם השהיה ושיעור כשלונות ניתנים להגדרה.
+- PostgreSQL מקומי (DATABASE_URL), או זמני שנוצר ונמחק בסיום (--ephemeral, דורש initdb/pg_ctl).
+משתמשים וירטואליים שולחים ל-POST /telegram רצף עדכונים: /start עם Payload של קמפיין, הודעות טקסט
+ולחיצות על כפתורים. כל משתמש ממתין לסיום הטיפול בעדכון הקודם שלו (כמו משתמש אמיתי).
+
+מדווח עדכונים לשנייה, p50/p95/p99 מהשליחה ועד סוף הטיפול (כולל ולפי סוג עדכון), פירוק הזמן
+ל-DB / AI / טלגרם / QR (מה-Tracing), וקריאות ל-Bot API. התוצאות נשמרות כ-JSON להשוואה בין גרסאות:
+
+    DATABASE_URL=postgresql://localhost/eliezer_bench python benchmarks/loadtest.py run --users 200 --duration 60
+    python benchmarks/loadtest.py run --ephemeral --ai-ms 800 --telegram-ms 40 --label campaign-x
+    python benchmarks/loadtest.py compare benchmarks/results/before.json benchmarks/results/after.json
+
+אזהרה: הבדיקה יוצרת משתמשים ולידים סינתטיים - להריץ רק מול DB מקומי.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+BOT_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Eliezer", "username": "eliezer_loadtest_bot"}
+LOG_GROUP = "-1001000000001"
+SUPPORT_GROUP = "-1001000000002"
+CAMPAIGNS = ["summer", "fb", "google", "tiktok", "newsletter"]
+TEXTS = [
+    "כמה עולה קמפיין בפייסבוק?",
+    "אני צריך עזרה עם ההזמנה שלי",
+    "מה שעות הפעילות שלכם?",
+    "אפשר לדבר עם נציג?",
+    "תודה רבה, היה מעולה",
+    "איך מצטרפים לתוכנית השותפים?",
+    "יש לכם הנחה לעסקים קטנים?",
+]
+CALLBACKS = ["get_qr", "my_status", "support_req"]
+COMPONENTS = ["db", "ai", "telegram", "qr"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+# --- PostgreSQL זמני ---
+
+class EphemeralPostgres:
+    """initdb לתיקייה זמנית ו-pg_ctl על פורט פנוי; נמחק בסיום"""
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="eliezer_pg_")
+        self.port = free_port()
+
+    def start(self):
+        for tool in ("initdb", "pg_ctl"):
+            if not shutil.which(tool):
+                sys.exit(f"--ephemeral requires {tool} on PATH")
+        data = os.path.join(self.directory, "data")
+        subprocess.run(["initdb", "-D", data, "-A", "trust", "-U", "postgres"], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(
+            ["pg_ctl", "-D", data, "-l", os.path.join(self.directory, "log"), "-w",
+             "-o", f"-p {self.port} -k {self.directory} -c fsync=off -c synchronous_commit=off", "start"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        return f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    def stop(self):
+        subprocess.run(["pg_ctl", "-D", os.path.join(self.directory, "data"), "-m", "immediate", "stop"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# --- Bot API מדומה ---
+
+class FakeTelegram:
+    """מחזיר תשובות תקינות לכל מתודה שהבוט משתמש בה, אחרי latency_ms, וסופר קריאות"""
+
+    def __init__(self, latency_ms):
+        self.latency_s = latency_ms / 1000
+        self.calls = Counter()
+        self._message_id = 0
+
+    def _message(self, chat_id, **extra):
+        self._message_id += 1
+        chat_id = int(chat_id)
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    def result(self, method, fields):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(fields.get("chat_id", 0), text=fields.get("text", ""))
+        if method == "sendPhoto":
+            file_id = f"photo-{self._message_id}"
+            return self._message(fields.get("chat_id", 0), photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 330, "height": 330}
+            ])
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        return True  # setWebhook, sendChatAction, answerCallbackQuery, deleteWebhook
+
+    def app(self):
+        from fastapi import FastAPI, Request
+        fake = FastAPI()
+
+        @fake.post("/bot{token}/{method}")
+        async def bot_api(method: str, request: Request):
+            self.calls[method] += 1
+            form = await request.form()
+            if self.latency_s:
+                await asyncio.sleep(self.latency_s)
+            return {"ok": True, "result": self.result(method, dict(form))}
+
+        return fake
+
+
+# --- עדכונים סינתטיים ---
+
+class UpdateFactory:
+    def __init__(self, first_user_id, rng):
+        self.rng = rng
+        self.first_user_id = first_user_id
+        self._update_id = int(time.time() * 1000) % 10**12
+        self._message_id = 0
+
+    def _ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Load{user_id % 10000}", "username": f"load{user_id}"}
+
+    def _message(self, user_id, text, entities=None):
+        update_id, message_id = self._ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if entities:
+            message["entities"] = entities
+        return {"update_id": update_id, "message": message}
+
+    def start(self, user_id, index):
+        # חלק מהמשתמשים מגיעים דרך הפניה של משתמש וירטואלי קודם, חלק מקמפיין ישיר
+        campaign = self.rng.choice(CAMPAIGNS)
+        if index and self.rng.random() < 0.5:
+            payload = f"{campaign}_{self.first_user_id + self.rng.randrange(index)}"
+        else:
+            payload = campaign
+        return self._message(user_id, f"/start {payload}", [{"type": "bot_command", "offset": 0, "length": 6}])
+
+    def text(self, user_id):
+        return self._message(user_id, self.rng.choice(TEXTS))
+
+    def callback(self, user_id):
+        update_id, message_id = self._ids()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": self.rng.choice(CALLBACKS),
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "תפריט",
+                },
+            },
+        }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"start", "text", "callback"}
+    if unknown:
+        sys.exit(f"unknown update kinds in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+# --- הרצה ---
+
+class Recorder:
+    """זמני השליחה והסיום לכל update_id, ופירוק ה-Trace לפי סוג העדכון"""
+
+    def __init__(self):
+        self.pending = {}  # update_id -> (kind, sent_at, Event)
+        self.measuring = False
+        self.latencies = defaultdict(list)  # kind -> שניות
+        self.ack = []
+        self.spans = defaultdict(lambda: defaultdict(float))
+        self.http_errors = Counter()
+
+    def complete(self, update_id, trace):
+        entry = self.pending.pop(update_id, None)
+        if entry is None:
+            return
+        kind, sent_at, done = entry
+        if self.measuring:
+            self.latencies[kind].append(time.perf_counter() - sent_at)
+            if trace is not None:
+                for category, seconds in trace.spans.items():
+                    self.spans[kind][category] += seconds
+        done.set()
+
+
+class TrackedApplication:
+    """עוטף את Application של הבוט (שאי אפשר להוסיף לו מאפיינים) ומדווח ל-Recorder בסיום כל עדכון"""
+
+    def __init__(self, application, recorder, tracer):
+        self._application = application
+        self._recorder = recorder
+        self._tracer = tracer
+        self.bot = application.bot
+
+    async def process_update(self, update):
+        try:
+            await self._application.process_update(update)
+        finally:
+            self._recorder.complete(update.update_id, self._tracer.current())
+
+
+async def virtual_user(index, client, factory, recorder, args, mix, stop_at):
+    rng = factory.rng
+    user_id = factory.first_user_id + index
+    kinds, weights = zip(*mix.items())
+    kind = "start"
+    while time.perf_counter() < stop_at:
+        body = factory.start(user_id, index) if kind == "start" else getattr(factory, kind)(user_id)
+        done = asyncio.Event()
+        sent_at = time.perf_counter()
+        recorder.pending[body["update_id"]] = (kind, sent_at, done)
+        response = await client.post("/telegram", json=body)
+        if recorder.measuring:
+            recorder.ack.append(time.perf_counter() - sent_at)
+        if response.status_code != 200:
+            recorder.http_errors[response.status_code] += 1
+            recorder.pending.pop(body["update_id"], None)
+        else:
+            try:
+                await asyncio.wait_for(done.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                recorder.pending.pop(body["update_id"], None)
+                recorder.http_errors["timeout"] += 1
+        if args.think_ms:
+            await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+        kind = rng.choices(kinds, weights)[0]
+
+
+async def serve(app, port):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+def configure_environment(args, database_url, telegram_port, app_port):
+    """לפני ה-import של main: config.py קורא את הסביבה בזמן הטעינה"""
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{telegram_port}",
+        "WEBHOOK_URL": f"http://127.0.0.1:{app_port}",
+        "DATABASE_URL": database_url,
+        "AI_PROVIDER": "stub",
+        "AI_STUB_LATENCY_MS": str(args.ai_ms),
+        "AI_STUB_FAILURE_RATE": str(args.ai_failure_rate),
+        "LOG_GROUP_ID": LOG_GROUP,
+        "SUPPORT_GROUP_ID": SUPPORT_GROUP,
+        "TELEGRAM_GLOBAL_RATE": str(args.global_rate),
+        "TRACE_SAMPLE_RATE": "1",
+        "TRACE_SLOW_MS": str(args.timeout * 1000),
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    })
+    os.environ.pop("TELEGRAM_WEBHOOK_SECRET", None)
+    os.environ.pop("CLUSTER_MODE", None)
+
+
+async def run_load(args, database_url):
+    import httpx
+
+    fake = FakeTelegram(args.telegram_ms)
+    telegram_port, app_port = free_port(), free_port()
+    configure_environment(args, database_url, telegram_port, app_port)
+    telegram_server, telegram_task = await serve(fake.app(), telegram_port)
+
+    import main
+    from tracing import tracer
+
+    recorder = Recorder()
+    app_server, app_task = await serve(main.app, app_port)
+    while not main.startup.ready:  # FAST_BOOT: האתחול ממשיך ברקע אחרי שהשרת עלה
+        if main.startup.error:
+            sys.exit(f"app startup failed: {main.startup.error}")
+        await asyncio.sleep(0.05)
+    # אחרי ה-Lifespan: ה-Ingestor מעביר עדכונים דרך עטיפה שמסמנת את סיום הטיפול בכל אחד
+    main.ingestor._application = TrackedApplication(main.ingestor._application, recorder, tracer)
+
+    rng = random.Random(args.seed)
+    factory = UpdateFactory(first_user_id=int(time.time()) * 1000, rng=rng)
+    mix = parse_mix(args.mix)
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}", limits=limits, timeout=args.timeout) as client:
+            started = time.perf_counter()
+            stop_at = started + args.warmup + args.duration
+            users = [
+                asyncio.create_task(virtual_user(i, client, factory, recorder, args, mix, stop_at))
+                for i in range(args.users)
+            ]
+            await asyncio.sleep(args.warmup)
+            fake.calls.clear()
+            recorder.measuring = True
+            measure_started = time.perf_counter()
+            await asyncio.gather(*users)
+            elapsed = time.perf_counter() - measure_started
+            recorder.measuring = False
+            stats = (await client.get("/stats")).json()
+    finally:
+        app_server.should_exit = True
+        await app_task
+        telegram_server.should_exit = True
+        await telegram_task
+
+    return summarize(args, recorder, fake, stats, elapsed)
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2) if samples else 0.0,
+    }
+
+
+def summarize(args, recorder, fake, stats, elapsed):
+    all_latencies = [value for values in recorder.latencies.values() for value in values]
+    by_kind = {}
+    for kind, samples in sorted(recorder.latencies.items()):
+        spans = recorder.spans[kind]
+        total = sum(samples)
+        breakdown = {c: round(spans.get(c, 0.0) / len(samples) * 1000, 2) for c in COMPONENTS}
+        breakdown["other"] = round(max(0.0, total / len(samples) * 1000 - sum(breakdown.values())), 2)
+        by_kind[kind] = dict(latency_summary(samples), components_avg_ms=breakdown)
+
+    return {
+        "label": args.label,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_rev": git_rev(),
+        "python": platform.python_version(),
+        "params": {
+            key: getattr(args, key) for key in
+            ("users", "duration", "warmup", "mix", "ai_ms", "ai_failure_rate", "telegram_ms", "think_ms",
+             "global_rate", "seed", "ephemeral")
+        },
+        "updates": len(all_latencies),
+        "updates_per_s": round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency": latency_summary(all_latencies),
+        "ack_latency": latency_summary(recorder.ack),
+        "by_kind": by_kind,
+        "errors": dict(recorder.http_errors),
+        "telegram_calls": dict(fake.calls),
+        "app": {key: stats.get(key) for key in ("db", "ingest", "outbound", "ai", "write_behind")},
+    }
+
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(result):
+    print(f"\n{result['label'] or 'run'} @ {result['git_rev']}  users={result['params']['users']}  "
+          f"ai={result['params']['ai_ms']}ms  telegram={result['params']['telegram_ms']}ms")
+    latency = result["latency"]
+    print(f"  {result['updates']} updates, {result['updates_per_s']} updates/s  "
+          f"p50={latency['p50_ms']}ms p95={latency['p95_ms']}ms p99={latency['p99_ms']}ms  "
+          f"(webhook ack p99={result['ack_latency']['p99_ms']}ms)")
+    print(f"  {'kind':<9} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9}   " + "  ".join(f"{c:>8}" for c in COMPONENTS + ["other"]))
+    for kind, row in result["by_kind"].items():
+        components = row["components_avg_ms"]
+        print(f"  {kind:<9} {row['count']:>7} {row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}   "
+              + "  ".join(f"{components[c]:>8}" for c in COMPONENTS + ["other"]))
+    if result["errors"]:
+        print(f"  errors: {result['errors']}")
+    print(f"  Bot API calls: {result['telegram_calls']}")
+
+
+def save_result(result, output):
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = f"{result['label'] or 'loadtest'}-{result['timestamp'].replace(':', '')}.json"
+        output = os.path.join(RESULTS_DIR, name)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"  saved: {output}")
+
+
+def compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        after = json.load(f)
+
+    rows = [("updates/s", before["updates_per_s"], after["updates_per_s"], True)]
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        rows.append((f"all {key}", before["latency"][key], after["latency"][key], False))
+    for kind in sorted(set(before["by_kind"]) & set(after["by_kind"])):
+        rows.append((f"{kind} p95_ms", before["by_kind"][kind]["p95_ms"], after["by_kind"][kind]["p95_ms"], False))
+        for component in COMPONENTS + ["other"]:
+            rows.append((f"{kind} {component} avg_ms", before["by_kind"][kind]["components_avg_ms"][component],
+                         after["by_kind"][kind]["components_avg_ms"][component], False))
+
+    if before["params"] != after["params"]:
+        print("!! runs used different parameters - the comparison may not be meaningful")
+    print(f"{'metric':<24} {before['git_rev'] or 'before':>12} {after['git_rev'] or 'after':>12} {'change':>9}")
+    regressions = []
+    for name, old, new, higher_is_better in rows:
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = ""
+        # רכיבים זניחים (מתחת ל-1ms) לא נחשבים רגרסיה גם אם השתנו באחוזים
+        if worse > args.threshold and max(old, new) >= 1:
+            flag = "  <-- regression"
+            regressions.append(name)
+        print(f"{name:<24} {old:>12} {new:>12} {change:>+8.1f}%{flag}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="הרצת בדיקת עומס ושמירת התוצאות")
+    run.add_argument("--users", type=int, default=100, help="משתמשים וירטואליים במקביל")
+    run.add_argument("--duration", type=float, default=30, help="שניות מדידה")
+    run.add_argument("--warmup", type=float, default=5, help="שניות חימום שלא נמדדות")
+    run.add_argument("--mix", default="start=0.15,text=0.6,callback=0.25", help="משקלות סוגי העדכונים")
+    run.add_argument("--ai-ms", type=float, default=300, help="השהיית ספק ה-AI המדומה")
+    run.add_argument("--ai-failure-rate", type=float, default=0.0)
+    run.add_argument("--telegram-ms", type=float, default=30, help="השהיית ה-Bot API המדומה")
+    run.add_argument("--think-ms", type=float, default=0, help="זמן ממוצע בין עדכונים של אותו משתמש")
+    run.add_argument("--global-rate", type=float, default=1000,
+                     help="TELEGRAM_GLOBAL_RATE לבדיקה (30 = המגבלה האמיתית של טלגרם)")
+    run.add_argument("--timeout", type=float, default=30, help="שניות מקסימום לעדכון בודד")
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--ephemeral", action="store_true", help="PostgreSQL זמני במקום DATABASE_URL")
+    run.add_argument("--label", default="", help="שם להרצה (נכנס לשם הקובץ)")
+    run.add_argument("--output", help="קובץ JSON לתוצאות (ברירת מחדל: benchmarks/results/)")
+
+    diff = commands.add_parser("compare", help="השוואת שתי הרצות שמורות")
+    diff.add_argument("baseline")
+    diff.add_argument("candidate")
+    diff.add_argument("--threshold", type=float, default=10, help="אחוז החמרה שנחשב רגרסיה")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        sys.exit(compare(args))
+
+    postgres = None
+    if args.ephemeral:
+        postgres = EphemeralPostgres()
+        database_url = postgres.start()
+    else:
+        database_url = os.getenv("DATABASE_URL")
+        if not database_url:
+            sys.exit("DATABASE_URL is required (local PostgreSQL only), or use --ephemeral")
+    try:
+        result = asyncio.run(run_load(args, database_url))
+    finally:
+        if postgres:
+            postgres.stop()
+    print_report(result)
+    save_result(result, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# קובץ: benchmarks/loadtest_cluster.py
+"""
+בדיקת עומס למצב Cluster: כמה תהליכים מעבדים יחד את update_inbox מול PostgreSQL מקומי.
+כל עדכון מדמה עבודת CPU (--cpu-ms) והמתנה לרשת (--io-ms). בסוף נבדק שכל עדכון טופל
+פעם אחת בדיוק ושהסדר בתוך כל צ'אט נשמר, ומודפסת התפוקה וההאצה ביחס לתהליך אחד.
+
+    DATABASE_URL=postgresql://localhost/eliezer_bench python benchmarks/loadtest_cluster.py --processes 1,2,4
+
+אזהרה: הטבלה update_inbox מתרוקנת - להריץ רק מול DB מקומי.
+"""
+
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class FakeApplication:
+    """מחליף את Application של הבוט: עבודת CPU ואז המתנה אסינכרונית"""
+
+    bot = None
+
+    def __init__(self, cpu_ms, io_ms):
+        self.cpu_s = cpu_ms / 1000
+        self.io_s = io_ms / 1000
+
+    async def process_update(self, update):
+        deadline = time.perf_counter() + self.cpu_s
+        while time.perf_counter() < deadline:
+            pass
+        await asyncio.sleep(self.io_s)
+
+
+def make_update(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "text": f"message {update_id}",
+        },
+    }
+
+
+def worker_main(args, ready, go, stop, processed):
+    from cluster import PgUpdateInbox
+    from database import init_db_pool, close_db_pool
+
+    async def run():
+        await init_db_pool()
+        inbox = PgUpdateInbox(workers=args.workers, poll_interval=0.05)
+        ready.release()
+        while not go.is_set():
+            await asyncio.sleep(0.01)
+        await inbox.start(FakeApplication(args.cpu_ms, args.io_ms))
+        while not stop.is_set():
+            await asyncio.sleep(0.05)
+        await inbox.stop()
+        with processed.get_lock():
+            processed.value += inbox.processed
+        await close_db_pool()
+
+    asyncio.run(run())
+
+
+async def prepare(args):
+    from cluster import INSERT_SQL
+    from create_tables import create_tables
+    from database import init_db_pool, close_db_pool, get_db_pool
+    from webhook_handler import chat_key
+    import json
+
+    await init_db_pool()
+    await create_tables()
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        await conn.execute("TRUNCATE update_inbox")
+        records = []
+        for update_id in range(1, args.updates + 1):
+            body = make_update(update_id, 1000 + update_id % args.chats)
+            records.append((update_id, str(chat_key(body)), json.dumps(body)))
+        await conn.executemany(INSERT_SQL, records)
+    await close_db_pool()
+
+
+async def remaining():
+    from database import init_db_pool, close_db_pool, get_db_pool
+    await init_db_pool()
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        left = await conn.fetchval("SELECT COUNT(*) FROM update_inbox WHERE status <> 'done'")
+    await close_db_pool()
+    return left
+
+
+async def verify():
+    from database import init_db_pool, close_db_pool, get_db_pool
+    await init_db_pool()
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        out_of_order = await conn.fetchval("""
+            SELECT COUNT(*) FROM (
+                SELECT processed_at < lag(processed_at) OVER (PARTITION BY chat_key ORDER BY update_id) AS bad
+                FROM update_inbox
+            ) t WHERE bad
+        """)
+        done = await conn.fetchval("SELECT COUNT(*) FROM update_inbox WHERE status = 'done'")
+    await close_db_pool()
+    return done, out_of_order
+
+
+def run_round(args, processes):
+    asyncio.run(prepare(args))
+
+    ctx = mp.get_context("spawn")
+    ready = ctx.Semaphore(0)
+    go, stop = ctx.Event(), ctx.Event()
+    processed = ctx.Value("i", 0)
+    children = [ctx.Process(target=worker_main, args=(args, ready, go, stop, processed)) for _ in range(processes)]
+    for child in children:
+        child.start()
+    for _ in children:
+        ready.acquire()
+
+    started = time.perf_counter()
+    go.set()
+    while asyncio.run(remaining()):
+        time.sleep(0.1)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for child in children:
+        child.join()
+    done, out_of_order = asyncio.run(verify())
+    return elapsed, processed.value, done, out_of_order
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", default="1,2,4", help="רשימת מספרי תהליכים, מופרדת בפסיקים")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=16, help="עדכונים במקביל לכל תהליך")
+    parser.add_argument("--cpu-ms", type=float, default=2.0)
+    parser.add_argument("--io-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    if not os.getenv("DATABASE_URL"):
+        sys.exit("DATABASE_URL is required (local PostgreSQL only - update_inbox is truncated)")
+
+    baseline = None
+    print(f"{'processes':>9} {'seconds':>8} {'updates/s':>10} {'speedup':>8} {'processed':>10} {'out_of_order':>12}")
+    for processes in (int(p) for p in args.processes.split(",")):
+        elapsed, processed, done, out_of_order = run_round(args, processes)
+        throughput = done / elapsed
+        baseline = baseline or throughput
+        print(f"{processes:>9} {elapsed:>8.2f} {throughput:>10.0f} {throughput / baseline:>7.2f}x "
+              f"{processed:>10} {out_of_order:>12}")
+        if processed != args.updates or out_of_order:
+            print(f"!! expected {args.updates} updates processed exactly once and in order")
+
+
+if __name__ == "__main__":
+    main()
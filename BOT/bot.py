@@ -1,47 +1,41 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from config import TELEGRAM_BOT_TOKEN, ADMIN_IDS, LOG_GROUP_ID, SUPPORT_GROUP_ID, DB_EXPORT_PASSKEY, logger
+from config import (TELEGRAM_BOT_TOKEN, TELEGRAM_API_BASE_URL, ADMIN_IDS, SUPPORT_GROUP_ID, DB_EXPORT_PASSKEY,
+                    EXPORT_MAX_BYTES)
 from crm_manager import crm
 from ai_service import ai_service
-from qr_generator import generate_user_qr
-from database import fetch_all_users_csv
+from faq_index import faq_index
+from intent_engine import intent_engine
+from conversation_memory import conversation_memory
+from qr_generator import qr_cache
+from scheduler import enroll
+from database import export_csv, ExportTooLarge
+from outbound import outbound, InstrumentedRequest
+from metrics import timed
+from analytics import analytics, DIRECT_CAMPAIGN
+from broadcast import broadcasts, parse_segment, describe_segment
+import asyncio
 import datetime
-import io
 import re
 
 # --- פונקציות עזר ותזמון ---
 
-async def notify_log_group(context, message):
-    if LOG_GROUP_ID:
-        try:
-            await context.bot.send_message(chat_id=LOG_GROUP_ID, text=message, parse_mode='Markdown')
-        except Exception as e:
-            logger.error(f"Failed to log to group {LOG_GROUP_ID}: {e}")
+async def reply(update, text, **kwargs):
+    """תשובה בצ'אט של העדכון - דרך outbound, כמו כל הודעה יוצאת (תור ו-Rate Limit לכל צ'אט)"""
+    return await outbound.send(update.effective_chat.id, text, **kwargs)
 
-async def send_initial_followup(context: ContextTypes.DEFAULT_TYPE):
-    """נשלח לאחר 24 שעות"""
-    user_id = context.job.data
-    try:
-        await context.bot.send_message(
-            chat_id=user_id, 
-            text="👋 היי שוב! רציתי לוודא שקיבלת את כל המידע שאתה צריך. יש שאלה ספציפית שתרצה לשאול?"
-        )
-        await crm.update_lead_score(user_id, 1) 
-    except Exception as e:
-        logger.warning(f"Failed to send followup to {user_id}: {e}")
-
-def schedule_followup(context: ContextTypes.DEFAULT_TYPE, user_id):
-    """מגדיר שליחת הודעה לאחר 24 שעות"""
-    delay = datetime.timedelta(hours=24)
-    context.job_queue.run_once(
-        send_initial_followup, 
-        delay, 
-        data=user_id, 
-        name=f"followup_{user_id}"
-    )
+async def edit(query, text, **kwargs):
+    """עריכת ההודעה שהכפתור שלה נלחץ - גם עריכות נספרות במגבלת ההודעות של טלגרם"""
+    message = query.message
+    return await outbound.call(message.chat_id, "edit_message_text", message_id=message.message_id, text=text, **kwargs)
+
+async def schedule_followup(user_id):
+    """רושם את המשתמש לרצף ה-Follow-up (נשמר ב-DB ושורד הפעלה מחדש)"""
+    await enroll(user_id, "followup")
 
 # --- Handlers ---
 
+@timed("handler", "start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     args = context.args
@@ -65,15 +59,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 2. רישום ל-DB
     await crm.add_user(user.id, user.username, user.first_name, referred_by=referrer_id, campaign_source=campaign_source)
     
-    # 3. תזמון Follow-up
-    schedule_followup(context, user.id)
+    # 3. תזמון Follow-up, והכנה מוקדמת של ה-QR האישי ברקע
+    await schedule_followup(user.id)
+    qr_cache.warm(context.bot.username, user.id, campaign_source="SHARE")
     
-    # 4. עדכון קבוצת לוגים
+    # 4. עדכון קבוצת לוגים (בעומס - הודעת סיכום אחת לכל חלון זמן)
     score = await crm.get_user_lead_score(user.id)
     log_msg = f"🔔 **ליד חדש!** (ציון: {score})\nID: {user.id}\nמקור: {campaign_source or 'ישיר'}"
     if referrer_id:
         log_msg += f" (הופנה ע\"י {referrer_id})"
-    await notify_log_group(context, log_msg)
+    outbound.log_lead(campaign_source or 'ישיר', log_msg)
 
     # 5. תפריט ראשי
     keyboard = [
@@ -85,37 +80,46 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard.append([InlineKeyboardButton("🔒 פאנל ניהול", callback_data="admin_panel")])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(
+    await outbound.send(
+        update.effective_chat.id,
         f"שלום {user.first_name}! אני הבוט המתקדם לחברת הפרסום שלך. איך אפשר לעזור?",
         reply_markup=reply_markup
     )
 
+@timed("handler", "handle_ai_message")
 async def handle_ai_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = update.message.text
     user_id = update.effective_user.id
     
     await crm.update_lead_score(user_id, 1)
 
-    # 1. ניתוח כוונות באמצעות AI
-    intent_prompt = f"סווג את כוונת המשתמש הבאה לקטגוריה אחת בלבד. התשובה שלך תהיה רק שם הקטגוריה: 'התעניינות במחיר', 'בקשת תמיכה', 'שאלה כללית', 'בקשת חזרה טלפונית', 'אחר'. טקסט: {user_text}"
-    intent_type = "שאלה כללית"
-    
-    if ai_service.use_openai: 
-        try:
-            intent_response = await ai_service.get_response(intent_prompt)
-            intent_type = intent_response.strip().replace("'", "").split('\n')[0] 
-        except Exception as e:
-            logger.warning(f"AI intent analysis failed: {e}")
-            
-    # 2. שמירה ב-CRM עם סיווג
+    # 1. שאלה נפוצה: תשובה מהאינדקס המקומי בלי שום קריאה ל-LLM (גם לא לסיווג)
+    faq = faq_index.search(user_text)
+    if faq.answer is not None:
+        intent_type = await intent_engine.classify(user_text)
+        ai_response, reply_source = faq.answer, "faq_reply"
+    else:
+        # 2. ניתוח כוונות (מטמון/מסווג מקומי, LLM רק כשצריך) במקביל לקבלת התשובה מ-AI,
+        #    עם קטעי ה-FAQ הקרובים כהקשר
+        await update.message.reply_chat_action("typing")
+        llm = ai_service.get_response if ai_service.use_openai else None
+        history = await conversation_memory.get_messages(user_id)
+        intent_type, ai_response = await asyncio.gather(
+            intent_engine.classify(user_text, llm=llm),
+            ai_service.get_response(user_text, history=history, context=faq.context),
+        )
+        reply_source = "ai_reply"
+
+    # 3. שמירה ב-CRM עם סיווג, ועדכון זיכרון השיחה
     await crm.log_interaction(user_id, user_text, source="user_msg", intent_type=intent_type)
-    
-    # 3. קבלת תשובה רגילה מ-AI
-    await update.message.reply_chat_action("typing")
-    ai_response = await ai_service.get_response(user_text)
-    
-    await update.message.reply_text(ai_response)
+    await crm.log_interaction(user_id, ai_response, source=reply_source)
+    await conversation_memory.add_turn(user_id, "user", user_text)
+    await conversation_memory.add_turn(user_id, "assistant", ai_response)
 
+    # 4. שליחת התשובה
+    await outbound.send(update.effective_chat.id, ai_response)
+
+@timed("handler", "button_handler")
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -124,31 +128,47 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if data == "get_qr":
         await crm.update_lead_score(user.id, 2)
+        await crm.log_interaction(user.id, data, source="qr_request")
         bot_username = context.bot.username
         
-        qr_bio = generate_user_qr(bot_username, user.id, campaign_source="SHARE") 
-        await query.message.reply_photo(photo=qr_bio, caption="זה קוד ה-QR האישי שלך!\nכל מי שיסרוק אותו יירשם תחתיך (מקור: SHARE).")
+        # file_id שמור מטלגרם אם כבר נשלח, אחרת PNG מהמטמון (זיכרון/דיסק/ציור ב-Worker)
+        photo, qr_key = await qr_cache.get_photo(bot_username, user.id, campaign_source="SHARE")
+        message = await outbound.call(
+            query.message.chat_id, "send_photo", photo=photo,
+            caption="זה קוד ה-QR האישי שלך!\nכל מי שיסרוק אותו יירשם תחתיך (מקור: SHARE).",
+        )
+        if message.photo:
+            qr_cache.remember_file_id(qr_key, message.photo[-1].file_id)
     
     elif data == "support_req":
         if SUPPORT_GROUP_ID:
             # מעדכן את הניקוד על פנייה יזומה לתמיכה
             await crm.update_lead_score(user.id, 3) 
+            await crm.log_interaction(user.id, data, source="support_request")
             text = f"🆘 **בקשת תמיכה חדשה (ציון גבוה)**\nמאת: {user.first_name} ({user.id})\nיוזר: @{user.username}\n\nנא לפנות אליו בפרטי."
-            await context.bot.send_message(chat_id=SUPPORT_GROUP_ID, text=text, parse_mode='Markdown')
-            await query.edit_message_text("הבקשה נשלחה לצוות התמיכה. ניצור איתך קשר בהקדם!")
+            outbound.post(SUPPORT_GROUP_ID, text, parse_mode='Markdown')
+            await edit(query, "הבקשה נשלחה לצוות התמיכה. ניצור איתך קשר בהקדם!")
         else:
-            await query.edit_message_text("מערכת התמיכה אינה מוגדרת כרגע.")
+            await edit(query, "מערכת התמיכה אינה מוגדרת כרגע.")
 
     elif data == "my_status":
         score = await crm.get_user_lead_score(user.id)
         # תיקון: קריאה לפונקציה החדשה ב-CRM Manager
         referrals = await crm.get_referral_count(user.id)
-        
-        await query.edit_message_text(f"📊 **הסטטוס שלך**\n⭐ ניקוד הליד שלך: {score}/10\n👥 אנשים שהצטרפו דרכך: {referrals}")
+        text = f"📊 **הסטטוס שלך**\n⭐ ניקוד הליד שלך: {score}/10\n👥 אנשים שהצטרפו דרכך: {referrals}"
+
+        downline = await crm.get_referral_downline_count(user.id)
+        if downline > referrals:
+            # יש גם דורות נוספים מתחת למי שהזמנת
+            depths = await crm.get_referral_depth_counts(user.id)
+            generations = ", ".join(f"דור {depth}: {users}" for depth, users in depths.items())
+            text += f"\n🌳 כל הרשת שלך: {downline} ({generations})"
+
+        await edit(query, text)
 
     elif data == "admin_panel":
         if user.id not in ADMIN_IDS:
-            await query.edit_message_text("אין לך גישה.")
+            await edit(query, "אין לך גישה.")
             return
         
         stats = await crm.get_stats()
@@ -158,39 +178,237 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"⭐ ניקוד ממוצע: {stats['avg_score']}\n"
             f"\nכדי לייצא נתונים, השתמש בפקודה:\n`/export [סיסמה סודית]`"
         )
-        await query.edit_message_text(text, parse_mode='Markdown')
+        await edit(query, text, parse_mode='Markdown')
+
+EXPORT_USAGE = (
+    "שימוש: `/export [סיסמה] [users|leads] [campaign=X] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [min_score=N] [gz]`"
+)
 
+def parse_export_args(args):
+    """מפרק את הפרמטרים של /export (אחרי הסיסמה). זורק ValueError על פרמטר לא תקין."""
+    options = {"table": "users", "campaign": None, "since": None, "until": None, "min_score": None, "compress": False}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if not value and key in ("users", "leads"):
+            options["table"] = key
+        elif not value and key == "gz":
+            options["compress"] = True
+        elif key == "campaign" and value:
+            options["campaign"] = value
+        elif key == "from" and value:
+            options["since"] = datetime.datetime.strptime(value, "%Y-%m-%d")
+        elif key == "to" and value:
+            options["until"] = datetime.datetime.strptime(value, "%Y-%m-%d")
+        elif key == "min_score" and value:
+            options["min_score"] = int(value)
+        else:
+            raise ValueError(arg)
+    return options
+
+@timed("handler", "export_data_command")
 async def export_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.id not in ADMIN_IDS:
-        await update.message.reply_text("אין לך הרשאת אדמין.")
+        await reply(update, "אין לך הרשאת אדמין.")
         return
     
     if not DB_EXPORT_PASSKEY or not context.args or context.args[0] != DB_EXPORT_PASSKEY:
-        await update.message.reply_text("הסיסמה לייצוא אינה תקינה או חסרה בהגדרות השרת.")
+        await reply(update, "הסיסמה לייצוא אינה תקינה או חסרה בהגדרות השרת.")
+        return
+
+    try:
+        options = parse_export_args(context.args[1:])
+    except ValueError as e:
+        await reply(update, f"פרמטר לא תקין: {e}\n{EXPORT_USAGE}", parse_mode='Markdown')
         return
         
-    await update.message.reply_text("מייצא נתונים... אנא המתן.")
+    await reply(update, "מייצא נתונים... אנא המתן.")
     
-    csv_file = await fetch_all_users_csv()
+    try:
+        result = await export_csv(**options)
+    except ExportTooLarge:
+        hint = "צמצמו עם from= / to= / campaign=" + ("" if options["compress"] else " או הוסיפו gz")
+        await reply(update, 
+            f"הייצוא גדול מ-{EXPORT_MAX_BYTES // (1024 * 1024)}MB (תקרת הקבצים של בוט בטלגרם) ונעצר. {hint}."
+        )
+        return
     
-    if csv_file:
-        csv_file_bytes = io.BytesIO(csv_file.getvalue().encode('utf-8'))
-        csv_file_bytes.name = f'eliezer_leads_{datetime.date.today()}.csv'
-        await context.bot.send_document(
-            chat_id=user.id, 
-            document=csv_file_bytes, 
-            caption="הנתונים של כל המשתמשים מחוברת ה-CRM."
+    if result:
+        export_file, rows = result
+        filename = f"eliezer_{options['table']}_{datetime.date.today()}.csv" + (".gz" if options["compress"] else "")
+        try:
+            # InputFile קורא את הקובץ פעם אחת (ב-Thread), כך שניסיון חוזר אחרי 429 שולח אותו שוב במלואו
+            document = await asyncio.to_thread(InputFile, export_file, filename=filename)
+        finally:
+            export_file.close()
+        await outbound.call(
+            user.id, "send_document", document=document,
+            caption=f"ייצוא {options['table']} מחוברת ה-CRM ({rows} שורות)."
         )
     else:
-        await update.message.reply_text("לא נמצאו נתונים לייצוא או אירעה שגיאה.")
+        await reply(update, "לא נמצאו נתונים לייצוא או אירעה שגיאה.")
+
+BROADCAST_USAGE = (
+    "שימוש:\n"
+    "/broadcast [פילטרים] טקסט ההודעה - שליחה לפלח\n"
+    "/broadcast count [פילטרים] - כמה משתמשים בפלח\n"
+    "/broadcast status | pause N | resume N | cancel N\n"
+    "פילטרים: campaign=X min_score=N max_score=N referrer=ID from=YYYY-MM-DD to=YYYY-MM-DD"
+)
+
+BROADCAST_ACTIONS = {"pause": "הושהה", "resume": "ממשיך", "cancel": "בוטל"}
+
+@timed("handler", "broadcast_command")
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast - שידור יזום לפלח משתמשים (broadcast.py), עם דוח התקדמות חי"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await reply(update, "אין לך הרשאת אדמין.")
+        return
+
+    args = context.args or []
+    if not args:
+        await reply(update, BROADCAST_USAGE)
+        return
+
+    if args[0] == "status":
+        rows = await broadcasts.recent()
+        if not rows:
+            await reply(update, "אין עדיין שידורים.")
+            return
+        lines = ["📣 שידורים אחרונים"]
+        for row in rows:
+            done = row["sent"] + row["failed"] + row["blocked"]
+            lines.append(
+                f"#{row['id']} {row['status']}: {done}/{row['total']} | נשלחו {row['sent']} | "
+                f"חסמו {row['blocked']} | נכשלו {row['failed']} | {describe_segment(row['segment'])}"
+            )
+        await reply(update, "\n".join(lines))
+        return
+
+    if args[0] in BROADCAST_ACTIONS:
+        if len(args) < 2 or not args[1].isdigit():
+            await reply(update, BROADCAST_USAGE)
+            return
+        if await broadcasts.control(int(args[1]), args[0]):
+            await reply(update, f"שידור #{args[1]} {BROADCAST_ACTIONS[args[0]]}.")
+        else:
+            await reply(update, f"שידור #{args[1]} לא נמצא או שאינו במצב שמאפשר {args[0]}.")
+        return
+
+    # הטקסט המקורי ולא context.args - כדי לשמור על השורות והרווחים של ההודעה
+    body = re.sub(r"^/\S*\s*", "", update.message.text, count=1)
+    counting = args[0] == "count"
+    if counting:
+        body = body[len("count"):]
+    try:
+        segment, text = parse_segment(body)
+    except ValueError as e:
+        await reply(update, f"פילטר לא תקין: {e}\n{BROADCAST_USAGE}")
+        return
+
+    if counting:
+        total = await broadcasts.count(segment)
+        await reply(update, f"👥 {total} משתמשים בפלח ({describe_segment(segment)}).")
+        return
+    if not text:
+        await reply(update, BROADCAST_USAGE)
+        return
+
+    # ההודעה הזו הופכת לדוח ההתקדמות - השידור עורך אותה תוך כדי
+    progress = await reply(update, f"📣 מכין שידור ל-{describe_segment(segment)}...")
+    broadcast_id, total = await broadcasts.create(
+        update.effective_user.id, text, segment, progress.chat_id, progress.message_id
+    )
+    if broadcast_id is None:
+        await progress.edit_text("אין משתמשים בפלח הזה - השידור לא נוצר.")
+        return
+    broadcasts.launch(broadcast_id)
+
+@timed("handler", "analytics_command")
+async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/analytics [ימים] - דוח קמפיינים ומפנים מטבלאות הסיכום"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await reply(update, "אין לך הרשאת אדמין.")
+        return
+
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else 30
+    report = await analytics.report(days=days)
+    if not report.get("campaigns"):
+        await reply(update, "אין עדיין נתוני אנליטיקה לתקופה הזו.")
+        return
+
+    lines = [f"📈 אנליטיקה - {days} הימים האחרונים"]
+    for campaign, entry in list(report["campaigns"].items())[:10]:
+        name = "ישיר" if campaign == DIRECT_CAMPAIGN else campaign
+        lines.append(
+            f"\n▫️ {name}: {entry['signups']} נרשמו | {entry['messages']} הודעות | "
+            f"תמיכה: {entry['support_users']} ({entry['support_conversion']:.1%}) | ניקוד ממוצע {entry['avg_score']}"
+        )
+        top_intents = sorted(entry["intents"].items(), key=lambda item: item[1], reverse=True)[:3]
+        if top_intents:
+            lines.append("   כוונות: " + ", ".join(f"{intent} {count}" for intent, count in top_intents))
+
+    if report["top_referrers"]:
+        lines.append("\n👥 מפנים מובילים:")
+        for row in report["top_referrers"][:5]:
+            lines.append(f"{row['referrer_id']}: {row['signups']} נרשמו, {row['support_users']} פנו לתמיכה")
+
+    networks = await crm.get_top_referrers(limit=5)
+    if networks:
+        lines.append("\n🌳 הרשתות הגדולות (כל הזמנים):")
+        for row in networks:
+            lines.append(f"{row['user_id']}: {row['direct_count']} ישירים, {row['downline_count']} בכל הרשת")
+
+    await reply(update, "\n".join(lines))
+
+@timed("handler", "faq_command")
+async def faq_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/faq - מצב אינדקס השאלות הנפוצות | /faq reload - טעינה מחדש | /faq test שאלה - בדיקת התאמה"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await reply(update, "אין לך הרשאת אדמין.")
+        return
+
+    args = context.args or []
+    if args and args[0] == "reload":
+        if await faq_index.load():
+            await reply(update, f"✅ נטענו {len(faq_index.index)} שאלות מ-{faq_index.path}.")
+        else:
+            await reply(update, "❌ הטעינה נכשלה - האינדקס הקודם נשאר (פרטים בלוג).")
+        return
+
+    if args and args[0] == "test" and len(args) > 1:
+        index = faq_index.index
+        question_scores, passage_scores = index.scores(" ".join(args[1:]))
+        lines = [f"🔎 סף תשובה ישירה: {faq_index.answer_threshold} | סף הקשר: {faq_index.context_threshold}"]
+        for i in passage_scores.argsort()[::-1][:3].tolist():
+            lines.append(f"{question_scores[i]:.2f} / {passage_scores[i]:.2f} - {index.entries[i].question}")
+        await reply(update, "\n".join(lines))
+        return
+
+    stats = faq_index.stats()
+    await reply(update, 
+        f"❓ FAQ: {stats['entries']} שאלות\n"
+        f"נענו בלי AI: {stats['answered']}/{stats['queries']} ({stats['deflection_rate']:.1%})\n"
+        f"עם הקשר ל-AI: {stats['with_context']}\n"
+        f"זמן חיפוש ממוצע: {stats['latency']['avg_ms']}ms"
+    )
 
 
 def create_bot_application():
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # ה-Follow-up מתוזמן ב-DB (scheduler.py), אין צורך ב-JobQueue בזיכרון
+    # InstrumentedRequest: מדדי זמן לכל קריאת Bot API (אותו גודל Pool כמו ברירת המחדל של ה-Builder)
+    builder = (Application.builder().token(TELEGRAM_BOT_TOKEN).job_queue(None)
+               .request(InstrumentedRequest(connection_pool_size=256)))
+    if TELEGRAM_API_BASE_URL:
+        # Bot API Server מקומי, או השרת המדומה של benchmarks/loadtest.py
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("export", export_data_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("analytics", analytics_command))
+    application.add_handler(CommandHandler("faq", faq_command))
     application.add_handler(CallbackQueryHandler(button_handler))
     
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_ai_message))
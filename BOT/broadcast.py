@@ -0,0 +1,447 @@
+# קובץ: broadcast.py
+"""
+שידור יזום לפלח משתמשים מטבלת users: קמפיין, טווח ניקוד, מפנה ותאריך הרשמה.
+- הנמענים נשלפים בדפים של BROADCAST_PAGE_SIZE לפי user_id (Keyset) ולא נטענים כולם לזיכרון.
+  אחרי כל דף נשמר Checkpoint (ה-user_id האחרון והמונים), כך ששידור שנעצר ממשיך מאותה נקודה.
+- עד BROADCAST_CONCURRENCY שליחות במקביל, בקצב BROADCAST_RATE - מתחת לתקרה הגלובלית של טלגרם,
+  כדי שתשובות למשתמשים לא ייתקעו מאחורי השידור. במצב Cluster הקצב משותף לכל התהליכים.
+- Forbidden / "chat not found": המשתמש מסומן is_blocked, לא נכלל בשידורים הבאים וה-Follow-ups שלו מבוטלים.
+- pause / resume / cancel נבדקים בכל Checkpoint, גם כשהשידור רץ בתהליך אחר.
+- שידור שלא התקדם BROADCAST_STALE_AFTER שניות (התהליך קרס) נלקח ע"י המנהיג וממשיך.
+אחרי קריסה באמצע דף, הדף הזה נשלח שוב - עד BROADCAST_PAGE_SIZE הודעות כפולות במקרה הגרוע.
+"""
+
+import asyncio
+import datetime
+import json
+import re
+import time
+from telegram.error import BadRequest, Forbidden
+from database import get_db_pool, logger
+from crm_manager import MARK_BLOCKED_SQL
+from cluster import shared_rate_limiter
+from outbound import outbound, TokenBucket
+from metrics import Histogram
+from tracing import tracer
+from config import (BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE, BROADCAST_PROGRESS_INTERVAL,
+                    BROADCAST_STALE_AFTER, CLUSTER_MODE)
+
+# פילטר בפקודה -> (מפתח בפלח השמור, המרה ובדיקה של הערך)
+SEGMENT_FILTERS = {
+    "campaign": ("campaign", str),
+    "min_score": ("min_score", int),
+    "max_score": ("max_score", int),
+    "referrer": ("referrer", int),
+    "from": ("since", lambda value: datetime.date.fromisoformat(value).isoformat()),
+    "to": ("until", lambda value: datetime.date.fromisoformat(value).isoformat()),
+}
+
+_FILTER = re.compile(r"\s*(\w+)=(\S+)")
+
+# שידור שתהליך אחר יכול לקחת: חדש, או רץ בלי Checkpoint מזה stale_after שניות.
+# lease מונה את הלקיחות - Checkpoint של מי שאיבד את השידור לא יעבור.
+CLAIM_SQL = """
+    UPDATE broadcasts
+    SET status = 'running', lease = lease + 1, updated_at = LOCALTIMESTAMP,
+        started_at = COALESCE(started_at, LOCALTIMESTAMP)
+    WHERE id = $1
+      AND (status = 'pending' OR (status = 'running' AND updated_at < LOCALTIMESTAMP - make_interval(secs => $2)))
+    RETURNING *
+"""
+
+RESUMABLE_SQL = """
+    SELECT id FROM broadcasts
+    WHERE status = 'pending' OR (status = 'running' AND updated_at < LOCALTIMESTAMP - make_interval(secs => $1))
+    ORDER BY id
+"""
+
+CHECKPOINT_SQL = """
+    UPDATE broadcasts
+    SET last_user_id = $3, sent = sent + $4, failed = failed + $5, blocked = blocked + $6, updated_at = LOCALTIMESTAMP
+    WHERE id = $1 AND lease = $2
+    RETURNING status
+"""
+
+FINISH_SQL = """
+    UPDATE broadcasts SET status = 'done', finished_at = LOCALTIMESTAMP, updated_at = LOCALTIMESTAMP
+    WHERE id = $1 AND lease = $2 AND status = 'running'
+    RETURNING status
+"""
+
+# כיבוי מסודר: השידור חוזר לתור ונלקח מיד ע"י התהליך הבא, בלי לחכות ל-stale_after
+REQUEUE_SQL = "UPDATE broadcasts SET status = 'pending' WHERE id = $1 AND lease = $2 AND status = 'running'"
+
+CONTROL_SQL = {
+    "pause": "UPDATE broadcasts SET status = 'paused' WHERE id = $1 AND status IN ('pending', 'running') RETURNING id",
+    "resume": "UPDATE broadcasts SET status = 'pending' WHERE id = $1 AND status = 'paused' RETURNING id",
+    "cancel": """
+        UPDATE broadcasts SET status = 'cancelled', finished_at = LOCALTIMESTAMP
+        WHERE id = $1 AND status IN ('pending', 'running', 'paused') RETURNING id
+    """,
+}
+
+HEADERS = {
+    "running": "📣 שידור #{id} בשליחה",
+    "done": "✅ שידור #{id} הסתיים",
+    "paused": "⏸ שידור #{id} הושהה",
+    "cancelled": "🛑 שידור #{id} בוטל",
+}
+
+
+def parse_segment(body):
+    """
+    מפרק "campaign=X min_score=N ... טקסט ההודעה" לפלח ולטקסט (שנשאר בדיוק כמו שנכתב, כולל שורות).
+    זורק ValueError על פילטר לא מוכר או ערך לא תקין.
+    """
+    segment = {}
+    position = 0
+    while True:
+        match = _FILTER.match(body, position)
+        if not match:
+            break
+        name, value = match.groups()
+        if name not in SEGMENT_FILTERS:
+            raise ValueError(match.group(0).strip())
+        key, convert = SEGMENT_FILTERS[name]
+        try:
+            segment[key] = convert(value)
+        except ValueError:
+            raise ValueError(match.group(0).strip()) from None
+        position = match.end()
+    return segment, body[position:].strip()
+
+
+def describe_segment(segment):
+    names = {key: name for name, (key, _) in SEGMENT_FILTERS.items()}
+    return " ".join(f"{names[key]}={value}" for key, value in segment.items()) or "כל המשתמשים"
+
+
+def build_segment_query(segment):
+    """תנאי ה-WHERE של הפלח (על users u). מחזיר (sql, args). משתמשים שחסמו את הבוט תמיד בחוץ."""
+    args = []
+    clauses = ["NOT u.is_blocked"]
+
+    def arg(value):
+        args.append(value)
+        return f"${len(args)}"
+
+    if "campaign" in segment:
+        clauses.append(f"u.campaign_source = {arg(segment['campaign'])}")
+    if "min_score" in segment:
+        clauses.append(f"u.lead_score >= {arg(segment['min_score'])}")
+    if "max_score" in segment:
+        clauses.append(f"u.lead_score <= {arg(segment['max_score'])}")
+    if "referrer" in segment:
+        clauses.append(f"u.referred_by = {arg(segment['referrer'])}")
+    if "since" in segment:
+        clauses.append(f"u.created_at >= {arg(datetime.datetime.fromisoformat(segment['since']))}")
+    if "until" in segment:
+        clauses.append(f"u.created_at < {arg(datetime.datetime.fromisoformat(segment['until']))}")
+    return " AND ".join(clauses), args
+
+
+def recipients_query(segment):
+    """דף נמענים אחרי user_id נתון. מחזיר (sql, args) - ה-user_id וגודל הדף מתווספים בסוף."""
+    where, args = build_segment_query(segment)
+    sql = (f"SELECT u.user_id FROM users u WHERE {where} AND u.user_id > ${len(args) + 1} "
+           f"ORDER BY u.user_id LIMIT ${len(args) + 2}")
+    return sql, args
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class BroadcastRun:
+    """שידור שרץ בתהליך הזה: מצב ה-Checkpoint האחרון ונתונים לדוח ההתקדמות"""
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.lease = row["lease"]
+        self.text = row["text"]
+        self.segment = json.loads(row["segment"])
+        self.total = row["total"]
+        self.last_user_id = row["last_user_id"]
+        self.sent = row["sent"]
+        self.failed = row["failed"]
+        self.blocked = row["blocked"]
+        self.chat_id = row["progress_chat_id"]
+        self.message_id = row["progress_message_id"]
+        self.started = time.monotonic()
+        self.processed_here = 0  # הקצב מחושב רק ממה שנשלח מאז שהתהליך הזה לקח את השידור
+        self.last_report = float("-inf")
+
+    def advance(self, last_user_id, sent, failed, blocked):
+        self.last_user_id = last_user_id
+        self.sent += sent
+        self.failed += failed
+        self.blocked += blocked
+        self.processed_here += sent + failed + blocked
+
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.started
+        return self.processed_here / elapsed if elapsed > 0 else 0.0
+
+    def render(self, status):
+        # total נספר ביצירה; משתמשים שנרשמו מאז יכולים להיכלל, לכן האחוז חסום ב-100
+        processed = self.processed()
+        percent = min(processed / self.total, 1.0) if self.total else 1.0
+        rate = self.throughput()
+        lines = [
+            HEADERS[status].format(id=self.id),
+            f"{processed}/{self.total} ({percent:.0%})",
+            f"✅ נשלחו: {self.sent} | 🚫 חסמו: {self.blocked} | ❌ נכשלו: {self.failed}",
+        ]
+        if status == "running":
+            remaining = max(self.total - processed, 0)
+            eta = _duration(remaining / rate) if rate else "?"
+            lines.append(f"⚡ {rate:.1f} הודעות לשנייה | ⏳ נותרו כ-{eta}")
+        else:
+            lines.append(f"⚡ {rate:.1f} הודעות לשנייה | ⏱ {_duration(time.monotonic() - self.started)}")
+        return "\n".join(lines)
+
+
+class BroadcastEngine:
+    def __init__(self, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, page_size=BROADCAST_PAGE_SIZE,
+                 progress_interval=BROADCAST_PROGRESS_INTERVAL, stale_after=BROADCAST_STALE_AFTER):
+        self.rate = rate
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.stale_after = stale_after
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate, rate)
+        self._bot = None
+        self._runs = {}  # id -> Task של שידור שרץ בתהליך הזה
+        self._resumer = None
+        # מדדים
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.completed = 0
+        self.send_latency = Histogram()
+
+    def start(self, bot):
+        self._bot = bot
+
+    def start_resumer(self):
+        """רק אצל המנהיג: לוקח שידורים שהתהליך שלהם נעצר"""
+        if self._resumer is None:
+            self._resumer = asyncio.create_task(self._resume_loop())
+
+    async def stop_resumer(self):
+        if self._resumer:
+            self._resumer.cancel()
+            try:
+                await self._resumer
+            except asyncio.CancelledError:
+                pass
+            self._resumer = None
+
+    async def stop(self):
+        """עוצר את השידורים שרצים בתהליך הזה - הם חוזרים לתור וממשיכים מה-Checkpoint"""
+        await self.stop_resumer()
+        runs = list(self._runs.values())
+        for task in runs:
+            task.cancel()
+        await asyncio.gather(*runs, return_exceptions=True)
+
+    async def _resume_loop(self):
+        while True:
+            try:
+                await self.resume_stale()
+            except Exception as e:
+                logger.error(f"Broadcast resume check failed: {e}")
+            await asyncio.sleep(self.stale_after / 2)
+
+    async def resume_stale(self):
+        pool = await get_db_pool()
+        if not pool: return 0
+
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(RESUMABLE_SQL, self.stale_after)
+        for row in rows:
+            self.launch(row["id"])
+        return len(rows)
+
+    # --- פקודות האדמין ---
+
+    async def count(self, segment):
+        pool = await get_db_pool()
+        if not pool: return None
+
+        where, args = build_segment_query(segment)
+        async with pool.acquire() as conn:
+            return await conn.fetchval(f"SELECT COUNT(*) FROM users u WHERE {where}", *args)
+
+    async def create(self, created_by, text, segment, chat_id=None, message_id=None):
+        """שומר שידור חדש (pending). מחזיר (id, מספר נמענים), או (None, 0) אם הפלח ריק."""
+        pool = await get_db_pool()
+        if not pool: return None, 0
+
+        where, args = build_segment_query(segment)
+        async with pool.acquire() as conn:
+            total = await conn.fetchval(f"SELECT COUNT(*) FROM users u WHERE {where}", *args)
+            if not total:
+                return None, 0
+            broadcast_id = await conn.fetchval("""
+                INSERT INTO broadcasts (created_by, text, segment, total, progress_chat_id, progress_message_id)
+                VALUES ($1, $2, $3::jsonb, $4, $5, $6)
+                RETURNING id
+            """, created_by, text, json.dumps(segment), total, chat_id, message_id)
+        logger.info(f"Broadcast #{broadcast_id} created by {created_by}: {total} recipients ({describe_segment(segment)})")
+        return broadcast_id, total
+
+    async def control(self, broadcast_id, action):
+        """pause / resume / cancel. מחזיר False אם השידור לא קיים או לא במצב שמאפשר את הפעולה."""
+        pool = await get_db_pool()
+        if not pool: return False
+
+        async with pool.acquire() as conn:
+            changed = await conn.fetchval(CONTROL_SQL[action], broadcast_id)
+        if changed is None:
+            return False
+        if action == "resume":
+            self.launch(broadcast_id)
+        return True
+
+    async def recent(self, limit=5):
+        pool = await get_db_pool()
+        if not pool: return []
+
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, status, segment, total, sent, failed, blocked, created_at
+                FROM broadcasts ORDER BY id DESC LIMIT $1
+            """, limit)
+        return [{**dict(row), "segment": json.loads(row["segment"])} for row in rows]
+
+    # --- השליחה ---
+
+    def launch(self, broadcast_id):
+        """מריץ את השידור ברקע בתהליך הזה (אם אף תהליך אחר לא מריץ אותו כבר)"""
+        if self._bot is None or broadcast_id in self._runs:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._runs[broadcast_id] = task
+        task.add_done_callback(lambda _: self._runs.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id):
+        # נוצר מתוך הפקודה של האדמין - השליחות לא נזקפות ל-Trace שלה
+        tracer.detach()
+        pool = await get_db_pool()
+        if not pool: return
+
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(CLAIM_SQL, broadcast_id, self.stale_after)
+        if row is None:
+            return  # כבר רץ בתהליך אחר, או שהושהה / בוטל בינתיים
+        run = BroadcastRun(row)
+        logger.info(f"Broadcast #{run.id} running from user_id>{run.last_user_id} ({run.processed()}/{run.total} done)")
+        sql, args = recipients_query(run.segment)
+        await self._report(run, "running", force=True)
+
+        try:
+            while True:
+                async with pool.acquire() as conn:
+                    page = await conn.fetch(sql, *args, run.last_user_id, self.page_size)
+                if not page:
+                    async with pool.acquire() as conn:
+                        status = await conn.fetchval(FINISH_SQL, run.id, run.lease)
+                    break
+
+                user_ids = [row["user_id"] for row in page]
+                results = await asyncio.gather(*(self._send(user_id, run.text) for user_id in user_ids))
+                blocked = [user_id for user_id, result in zip(user_ids, results) if result == "blocked"]
+                sent, failed = results.count("sent"), results.count("failed")
+
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        if blocked:
+                            await conn.execute(MARK_BLOCKED_SQL, blocked)
+                        status = await conn.fetchval(
+                            CHECKPOINT_SQL, run.id, run.lease, user_ids[-1], sent, failed, len(blocked)
+                        )
+                run.advance(user_ids[-1], sent, failed, len(blocked))
+                if status != "running":
+                    break  # הושהה / בוטל, או (None) שתהליך אחר לקח את השידור
+                await self._report(run, "running")
+        except asyncio.CancelledError:
+            try:
+                async with pool.acquire() as conn:
+                    await conn.execute(REQUEUE_SQL, run.id, run.lease)
+            except Exception as e:
+                logger.warning(f"Broadcast #{run.id} not requeued ({e}) - will resume after {self.stale_after:.0f}s")
+            raise
+        except Exception as e:
+            # נשאר running - המנהיג ימשיך אותו מה-Checkpoint אחרי stale_after
+            logger.error(f"Broadcast #{run.id} stopped at user_id>{run.last_user_id}: {e}")
+            return
+
+        if status in HEADERS:
+            if status == "done":
+                self.completed += 1
+            logger.info(f"Broadcast #{run.id} {status}: sent={run.sent} blocked={run.blocked} failed={run.failed} "
+                        f"({run.throughput():.1f} msg/s)")
+            await self._report(run, status, force=True)
+
+    async def _send(self, user_id, text):
+        async with self._semaphore:
+            if CLUSTER_MODE:
+                await shared_rate_limiter.acquire("telegram:broadcast", self.rate)
+            else:
+                await asyncio.sleep(self._bucket.reserve())
+            started = time.perf_counter()
+            try:
+                # התור לצ'אט, התקרה הגלובלית ו-429 מטופלים בשכבת השליחה
+                await outbound.send(user_id, text)
+            except Forbidden:
+                self.blocked += 1
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    self.blocked += 1
+                    return "blocked"
+                self.failed += 1
+                logger.warning(f"Broadcast to {user_id} rejected: {e}")
+                return "failed"
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Broadcast to {user_id} failed: {e}")
+                return "failed"
+        self.send_latency.observe(time.perf_counter() - started)
+        self.sent += 1
+        return "sent"
+
+    async def _report(self, run, status, force=False):
+        """עריכת הודעת ההתקדמות אצל האדמין, לכל היותר פעם ב-progress_interval"""
+        if not run.chat_id or not run.message_id:
+            return
+        now = time.monotonic()
+        if not force and now - run.last_report < self.progress_interval:
+            return
+        run.last_report = now
+        try:
+            await outbound.call(run.chat_id, "edit_message_text", message_id=run.message_id, text=run.render(status))
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Broadcast #{run.id} progress update failed: {e}")
+        except Exception as e:
+            logger.warning(f"Broadcast #{run.id} progress update failed: {e}")
+
+    def stats(self):
+        return {
+            "running": len(self._runs),
+            "completed": self.completed,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "send_latency": self.send_latency.snapshot(),
+        }
+
+
+broadcasts = BroadcastEngine()
@@ -0,0 +1,70 @@
+# קובץ: cache.py
+
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    מטמון בזיכרון עם תפוגה (TTL) ופינוי LRU.
+    מוגבל במספר רשומות כדי שצריכת הזיכרון תישאר חסומה.
+    """
+
+    def __init__(self, maxsize, ttl, name="cache"):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expires_at(self):
+        return time.monotonic() + self.ttl if self.ttl else None
+
+    def get(self, key, default=MISSING):
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._data[key] = (self._expires_at(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, key, fn):
+        """מעדכן ערך קיים במקום (בלי לשנות את זמן התפוגה). לא עושה כלום אם הערך לא במטמון."""
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data[key] = (entry[0], fn(entry[1]))
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
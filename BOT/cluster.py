@@ -0,0 +1,377 @@
+# קובץ: cluster.py
+"""
+מצב Cluster (CLUSTER_MODE=true): כמה תהליכי uvicorn / Replicas מול אותו PostgreSQL.
+- הנהגה: Advisory Lock על חיבור ייעודי. רק המנהיג מגדיר Webhook ומריץ משימות תקופתיות;
+  אם החיבור נופל הנעילה משתחררת ותהליך אחר תופס אותה.
+- תיבת עדכונים משותפת (update_inbox): update_id הוא המפתח, כך שכפילויות נזרקות בכל התהליכים,
+  ועדכון של צ'אט נתפס רק כשאין לאותו צ'אט עדכון מוקדם יותר שממתין או בעיבוד.
+- Rate Limit משותף: Token Bucket בטבלת rate_limits, מתעדכן ב-Round-trip אחד.
+זיכרון שיחה ומטמוני CRM נשארים מקומיים לכל תהליך (עם TTL וטעינה מה-DB בהחמצה).
+"""
+
+import asyncio
+import json
+import os
+import time
+import asyncpg
+from telegram import Update
+from database import get_db_pool, get_dsn
+from metrics import Histogram
+from tracing import tracer
+from webhook_handler import chat_key
+from crm_manager import write_buffer
+from config import (CLUSTER_LEADER_RETRY, INBOX_POLL_INTERVAL, INBOX_LOCK_TIMEOUT, INBOX_RETENTION,
+                    INGEST_WORKERS, INGEST_DRAIN_TIMEOUT, logger)
+
+LEADER_LOCK_KEY = 0x456C6965  # 'Elie'
+INBOX_CHANNEL = "update_inbox"
+
+INSERT_SQL = """
+    WITH ins AS (
+        INSERT INTO update_inbox (update_id, chat_key, payload) VALUES ($1, $2, $3::jsonb)
+        ON CONFLICT (update_id) DO NOTHING
+        RETURNING update_id
+    )
+    SELECT update_id, pg_notify('update_inbox', '') FROM ins
+"""
+
+# העדכון הוותיק ביותר של כל צ'אט שאין לו עדכון בעיבוד. עדכון של צ'אט שנעול ע"י תהליך אחר
+# מדולג (SKIP LOCKED), והעדכון הבא של אותו צ'אט לא עומד בתנאי - כך נשמר הסדר בין תהליכים.
+CLAIM_SQL = """
+    UPDATE update_inbox AS i
+    SET status = 'processing', locked_at = LOCALTIMESTAMP
+    FROM (
+        SELECT u.update_id FROM update_inbox u
+        WHERE u.status = 'pending'
+          AND NOT EXISTS (
+              SELECT 1 FROM update_inbox e
+              WHERE e.chat_key = u.chat_key
+                AND (e.status = 'processing' OR (e.status = 'pending' AND e.update_id < u.update_id))
+          )
+        ORDER BY u.update_id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ) AS next
+    WHERE i.update_id = next.update_id
+    RETURNING i.update_id, i.payload, EXTRACT(EPOCH FROM LOCALTIMESTAMP - i.received_at)::float8 AS wait_s
+"""
+
+COMPLETE_SQL = """
+    UPDATE update_inbox SET status = $2, locked_at = NULL, processed_at = LOCALTIMESTAMP
+    WHERE update_id = $1
+"""
+
+RECLAIM_SQL = """
+    UPDATE update_inbox SET status = 'pending', locked_at = NULL
+    WHERE status = 'processing' AND locked_at < LOCALTIMESTAMP - make_interval(secs => $1)
+"""
+
+PURGE_SQL = """
+    DELETE FROM update_inbox
+    WHERE status IN ('done', 'failed') AND processed_at < LOCALTIMESTAMP - make_interval(secs => $1)
+"""
+
+# Token Bucket ב-Round-trip אחד. tokens שלילי = הזמנה מראש: הקורא ממתין -tokens/rate שניות.
+TOKEN_BUCKET_SQL = """
+    INSERT INTO rate_limits AS r (key, tokens, updated_at) VALUES ($1, $3 - 1, clock_timestamp())
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = LEAST($3, r.tokens + EXTRACT(EPOCH FROM clock_timestamp() - r.updated_at) * $2) - 1,
+        updated_at = clock_timestamp()
+    RETURNING tokens
+"""
+
+
+class LeaderElection:
+    """בחירת מנהיג עם pg_try_advisory_lock על חיבור ייעודי (הנעילה חיה כל עוד החיבור חי)"""
+
+    def __init__(self, lock_key=LEADER_LOCK_KEY, retry_interval=CLUSTER_LEADER_RETRY):
+        self.lock_key = lock_key
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self.elections = 0
+        self._on_elected = None
+        self._on_demoted = None
+        self._task = None
+
+    def start(self, on_elected, on_demoted):
+        if self._task is None:
+            self._on_elected = on_elected
+            self._on_demoted = on_demoted
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _demote(self):
+        if self.is_leader:
+            self.is_leader = False
+            logger.warning(f"Process {os.getpid()} lost cluster leadership.")
+            try:
+                await self._on_demoted()
+            except Exception as e:
+                logger.error(f"Leader demotion hook failed: {e}")
+
+    async def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(get_dsn())
+                while True:
+                    if not self.is_leader:
+                        if await conn.fetchval("SELECT pg_try_advisory_lock($1)", self.lock_key):
+                            self.is_leader = True
+                            self.elections += 1
+                            logger.info(f"Process {os.getpid()} elected cluster leader.")
+                            await self._on_elected()
+                    else:
+                        # בדיקת חיות - אם החיבור נפל, הנעילה כבר שוחררה בצד השרת
+                        await conn.fetchval("SELECT 1")
+                    await asyncio.sleep(self.retry_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Leader election error: {e}")
+            finally:
+                await self._demote()
+                if conn is not None:
+                    await conn.close()
+            await asyncio.sleep(self.retry_interval)
+
+    def stats(self):
+        return {"is_leader": self.is_leader, "elections": self.elections}
+
+
+class SharedRateLimiter:
+    """Token Bucket משותף לכל התהליכים (טבלת rate_limits)"""
+
+    def __init__(self):
+        self.acquired = 0
+        self.waited = 0
+        self.errors = 0
+        self.wait_time = Histogram()
+
+    async def acquire(self, key, rate, burst=None):
+        """ממתין עד שמותר לבצע פעולה אחת תחת המפתח. burst ברירת מחדל = rate."""
+        pool = await get_db_pool()
+        if not pool: return
+
+        burst = burst or rate
+        try:
+            async with pool.acquire() as conn:
+                tokens = await conn.fetchval(TOKEN_BUCKET_SQL, key, float(rate), float(burst))
+        except Exception as e:
+            # עדיף לשלוח מאשר לחסום את כל השליחות כשה-DB לא זמין לרגע
+            self.errors += 1
+            logger.warning(f"Shared rate limiter unavailable for {key}: {e}")
+            return
+
+        self.acquired += 1
+        delay = -tokens / rate if tokens < 0 else 0.0
+        self.wait_time.observe(delay)
+        if delay > 0:
+            self.waited += 1
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "errors": self.errors,
+            "wait_time": self.wait_time.snapshot(),
+        }
+
+
+class PgUpdateInbox:
+    """
+    קליטת Webhook במצב Cluster - אותו ממשק כמו UpdateIngestor (start/stop/submit/stats),
+    אבל התור הוא הטבלה update_inbox וכל תהליך תופס ממנה עד workers עדכונים במקביל.
+    LISTEN/NOTIFY מעיר את התהליכים מיד, ו-poll_interval הוא רשת ביטחון.
+    """
+
+    def __init__(self, workers=INGEST_WORKERS, poll_interval=INBOX_POLL_INTERVAL,
+                 lock_timeout=INBOX_LOCK_TIMEOUT, retention=INBOX_RETENTION):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self.retention = retention
+        self._application = None
+        self._wake = asyncio.Event()
+        self._fetcher = None
+        self._maintenance = None
+        self._listener = None
+        self._active = set()
+        self._accepting = False
+        # מדדים
+        self.accepted = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.processed = 0
+        self.errors = 0
+        self.reclaimed = 0
+        self.queue_wait = Histogram()
+        self.processing = Histogram()
+
+    async def start(self, application):
+        self._application = application
+        self._accepting = True
+        try:
+            self._listener = await asyncpg.connect(get_dsn())
+            await self._listener.add_listener(INBOX_CHANNEL, self._notified)
+        except Exception as e:
+            self._listener = None
+            logger.warning(f"Inbox LISTEN unavailable, polling every {self.poll_interval}s: {e}")
+        self._fetcher = asyncio.create_task(self._run())
+        logger.info(f"Update inbox started with {self.workers} workers (pid {os.getpid()}).")
+
+    async def stop(self, drain_timeout=INGEST_DRAIN_TIMEOUT):
+        """מפסיק לתפוס עדכונים חדשים ומסיים את אלה שכבר בעיבוד. השאר נשארים לתהליכים אחרים."""
+        self._accepting = False
+        for task in (self._fetcher, self._maintenance):
+            if task:
+                task.cancel()
+        await asyncio.gather(*(t for t in (self._fetcher, self._maintenance) if t), return_exceptions=True)
+        self._fetcher = self._maintenance = None
+
+        if self._active:
+            _, still_running = await asyncio.wait(self._active, timeout=drain_timeout)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+
+    def _notified(self, *_):
+        self._wake.set()
+
+    async def submit(self, body):
+        """מחזיר 'queued' / 'duplicate' / 'dropped' / 'invalid'"""
+        if not isinstance(body, dict) or not isinstance(body.get("update_id"), int):
+            self.invalid += 1
+            return "invalid"
+        if not self._accepting:
+            self.dropped += 1
+            return "dropped"
+
+        update_id = body["update_id"]
+        key = chat_key(body)
+        key = str(key) if key is not None else f"update:{update_id}"
+        try:
+            pool = await get_db_pool()
+            async with pool.acquire() as conn:
+                inserted = await conn.fetchval(INSERT_SQL, update_id, key, json.dumps(body))
+        except Exception as e:
+            # טלגרם ישלח שוב, וה-update_id ימנע כפילות אם ההכנסה בכל זאת הצליחה
+            logger.error(f"Failed to store update {update_id}: {e}")
+            self.dropped += 1
+            return "dropped"
+        if inserted is None:
+            self.duplicates += 1
+            return "duplicate"
+        self.accepted += 1
+        return "queued"
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            free = self.workers - len(self._active)
+            if free > 0:
+                try:
+                    pool = await get_db_pool()
+                    async with pool.acquire() as conn:
+                        rows = await conn.fetch(CLAIM_SQL, free)
+                except Exception as e:
+                    logger.error(f"Inbox claim failed: {e}")
+                    rows = []
+                for row in rows:
+                    task = asyncio.create_task(self._process(row))
+                    self._active.add(task)
+                    task.add_done_callback(self._active.discard)
+            # NOTIFY על עדכון חדש או סיום עיבוד מעירים מיד
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, row):
+        started = time.perf_counter()
+        self.queue_wait.observe(row["wait_s"])
+        status = "pending"  # אם התהליך נעצר באמצע - העדכון חוזר לתור
+        try:
+            with tracer.trace("update", update_id=row["update_id"]):
+                update = Update.de_json(json.loads(row["payload"]), self._application.bot)
+                await self._application.process_update(update)
+                # העדכון הבא של הצ'אט עשוי להגיע לתהליך אחר - הוא צריך לראות את מה שנכתב כאן
+                await write_buffer.flush()
+            status = "done"
+            self.processed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            status = "failed"
+            self.errors += 1
+            logger.error(f"Error processing update {row['update_id']}: {e}")
+        finally:
+            self.processing.observe(time.perf_counter() - started)
+            try:
+                pool = await get_db_pool()
+                async with pool.acquire() as conn:
+                    await conn.execute(COMPLETE_SQL, row["update_id"], status)
+            except Exception as e:
+                # ה-Reclaim של המנהיג יחזיר אותו לתור אחרי lock_timeout
+                logger.error(f"Failed to complete update {row['update_id']}: {e}")
+            # הצ'אט השתחרר - אולי מחכה לו העדכון הבא
+            self._wake.set()
+
+    def start_maintenance(self):
+        """רץ רק אצל המנהיג: החזרת עדכונים תקועים וניקוי update_id ישנים"""
+        if self._maintenance is None:
+            self._maintenance = asyncio.create_task(self._maintain())
+
+    async def stop_maintenance(self):
+        if self._maintenance:
+            self._maintenance.cancel()
+            try:
+                await self._maintenance
+            except asyncio.CancelledError:
+                pass
+            self._maintenance = None
+
+    async def _maintain(self):
+        while True:
+            try:
+                pool = await get_db_pool()
+                async with pool.acquire() as conn:
+                    result = await conn.execute(RECLAIM_SQL, self.lock_timeout)
+                    self.reclaimed += int(result.split()[-1])
+                    await conn.execute(PURGE_SQL, self.retention)
+            except Exception as e:
+                logger.error(f"Inbox maintenance failed: {e}")
+            await asyncio.sleep(min(self.lock_timeout, 60))
+
+    def stats(self):
+        return {
+            "active": len(self._active),
+            "workers": self.workers,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "invalid": self.invalid,
+            "processed": self.processed,
+            "errors": self.errors,
+            "reclaimed": self.reclaimed,
+            "queue_wait": self.queue_wait.snapshot(),
+            "processing": self.processing.snapshot(),
+        }
+
+
+leader_election = LeaderElection()
+shared_rate_limiter = SharedRateLimiter()
+update_inbox = PgUpdateInbox()
@@ -1,5 +1,6 @@
 import os
 import logging
+import tempfile
 
 # הגדרות לוגים
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -12,7 +13,9 @@ logger = logging.getLogger(__name__)
 # טוקנים ופרטי בוט
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")  # אופציונלי: נבדק מול X-Telegram-Bot-Api-Secret-Token
 PORT = int(os.getenv("PORT", 8080))
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").rstrip("/")  # ריק = api.telegram.org (שרת מקומי / בדיקות עומס)
 
 # ניהול הרשאות וקבוצות
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
@@ -28,11 +31,153 @@ RECEIPTS_GROUP_ID = os.getenv("RECEIPTS_GROUP_ID") # קבוצת קבלות לת
 # משתנים לניהול
 DATABASE_URL = os.getenv("DATABASE_URL")
 DB_EXPORT_PASSKEY = os.getenv("DB_EXPORT_PASSKEY") # סיסמה סודית לייצוא נתונים
+ANALYTICS_API_KEY = os.getenv("ANALYTICS_API_KEY")  # כותרת X-API-Key עבור GET /analytics
+EXPORT_SPOOL_MAX_MEMORY = int(os.getenv("EXPORT_SPOOL_MAX_MEMORY", 8 * 1024 * 1024))  # מעבר לזה הייצוא נכתב לדיסק
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", 49 * 1024 * 1024))  # תקרת קובץ הייצוא (טלגרם: 50MB להעלאה של בוט)
+
+# Pool החיבורים ל-PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", 5))                # שניות המתנה לחיבור פנוי
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 15))               # שניות לכל שאילתה
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", 50000))                      # מחזור חיבור אחרי N שאילתות
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))  # סגירת חיבור שלא היה בשימוש
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))      # 0 מאחורי PgBouncer במצב transaction
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", 3))                    # ניסיונות לשאילתות קריאה בשגיאה זמנית
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 250))                  # שאילתות איטיות נרשמות ללוג
 
 # AI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 HF_API_TOKEN = os.getenv("HF_API_TOKEN")
+AI_PROVIDER = os.getenv("AI_PROVIDER", "auto").lower()      # auto / openai / hf / stub (בדיקות עומס בלי רשת)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+HF_MODEL = os.getenv("HF_MODEL", "google/flan-t5-large")     # ניתן להחליף למודל בעברית טוב יותר
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", 15))              # שניות לקריאה אחת, כולל המתנה בתור
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", 20))
+AI_EXECUTOR_WORKERS = int(os.getenv("AI_EXECUTOR_WORKERS", 4))  # Threads לספקים סינכרוניים (HuggingFace)
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", 5))  # כשלונות רצופים עד לפתיחת המפסק
+AI_BREAKER_RESET = float(os.getenv("AI_BREAKER_RESET", 30))     # שניות עד ניסיון חוזר
+AI_STUB_LATENCY_MS = float(os.getenv("AI_STUB_LATENCY_MS", 300))
+AI_STUB_FAILURE_RATE = float(os.getenv("AI_STUB_FAILURE_RATE", 0))
+
+# זיכרון שיחה לכל משתמש
+CONV_MAX_TURNS = int(os.getenv("CONV_MAX_TURNS", 12))                  # תורות אחרונים לכל משתמש
+CONV_TOKEN_BUDGET = int(os.getenv("CONV_TOKEN_BUDGET", 800))           # תקציב טוקנים להקשר (כולל סיכום)
+CONV_SUMMARY_MAX_CHARS = int(os.getenv("CONV_SUMMARY_MAX_CHARS", 600))
+CONV_MAX_USERS = int(os.getenv("CONV_MAX_USERS", 5000))                # משתמשים בזיכרון במקביל
+CONV_MAX_TOTAL_CHARS = int(os.getenv("CONV_MAX_TOTAL_CHARS", 8_000_000))
+CONV_IDLE_TTL = float(os.getenv("CONV_IDLE_TTL", 3600))                # שניות עד פינוי משתמש לא פעיל
+CONV_HISTORY_DAYS = int(os.getenv("CONV_HISTORY_DAYS", 90))            # טעינה מה-DB רק מהמחיצות האחרונות
+
+# מטמון QR
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "eliezer_qr"))  # ריק = בלי שכבת דיסק
+QR_CACHE_MAX_BYTES = int(os.getenv("QR_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+QR_CACHE_DISK_MAX_BYTES = int(os.getenv("QR_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024))  # מעבר לזה נמחקים הקבצים הישנים (לפי mtime)
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", 2))
+
+# תזמון Follow-up מבוסס DB
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", 10))   # שניות בין בדיקות כשאין משימות
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", 100))
+SCHEDULER_SEND_CONCURRENCY = int(os.getenv("SCHEDULER_SEND_CONCURRENCY", 10))
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", 5))
+SCHEDULER_LOCK_TIMEOUT = float(os.getenv("SCHEDULER_LOCK_TIMEOUT", 300))     # שניות עד שמשימה "תקועה" חוזרת לתור
+
+# קליטת Webhook: תור עדכונים ו-Workers
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 16))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 1000))            # עדכונים ממתינים לכל היותר
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv("INGEST_ENQUEUE_TIMEOUT", 2.0))  # שניות המתנה לתור מלא לפני 503
+INGEST_DEDUPE_SIZE = int(os.getenv("INGEST_DEDUPE_SIZE", 10000))          # update_id אחרונים לזיהוי כפילויות
+INGEST_DRAIN_TIMEOUT = float(os.getenv("INGEST_DRAIN_TIMEOUT", 20))       # שניות לריקון התור בכיבוי
+
+# מצב Cluster: מספר תהליכים/Replicas עם מצב משותף ב-PostgreSQL
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "false").lower() in ("1", "true", "yes")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))                       # תהליכי uvicorn
+CLUSTER_LEADER_RETRY = float(os.getenv("CLUSTER_LEADER_RETRY", 5))          # שניות בין ניסיונות לקבל הנהגה
+CLUSTER_STATS_RESYNC = float(os.getenv("CLUSTER_STATS_RESYNC", 30))         # שניות עד טעינה מחדש של סיכומים משותפים
+INBOX_POLL_INTERVAL = float(os.getenv("INBOX_POLL_INTERVAL", 1.0))          # גיבוי ל-NOTIFY שהולך לאיבוד
+INBOX_LOCK_TIMEOUT = float(os.getenv("INBOX_LOCK_TIMEOUT", 120))            # שניות עד שעדכון "תקוע" חוזר לתור
+INBOX_RETENTION = float(os.getenv("INBOX_RETENTION", 86400))                # שניות שמירת update_id שטופלו (חלון כפילויות)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))         # הודעות לשנייה לכל הבוט
+
+# שכבת שליחה לטלגרם: Rate Limit לכל צ'אט ולכל הבוט, Retry ו-Digest לקבוצת הלוגים
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", 1.0))       # הודעות לשנייה לצ'אט פרטי
+OUTBOUND_PRIVATE_BURST = int(os.getenv("OUTBOUND_PRIVATE_BURST", 3))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", 20))  # הודעות לדקה לקבוצה
+OUTBOUND_GROUP_BURST = int(os.getenv("OUTBOUND_GROUP_BURST", 3))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 3))
+OUTBOUND_MAX_CHATS = int(os.getenv("OUTBOUND_MAX_CHATS", 50000))             # דליים שנשמרים בזיכרון
+LOG_DIGEST_WINDOW = float(os.getenv("LOG_DIGEST_WINDOW", 60))                 # שניות לאיסוף לידים ל-Digest
+
+# אנליטיקה: עיבוד מצטבר של crm_leads לטבלאות סיכום
+ANALYTICS_INTERVAL = float(os.getenv("ANALYTICS_INTERVAL", 60))       # שניות בין ריצות (גם מרווח הביטחון ל-High-water mark)
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", 50000))  # שורות crm_leads לכל טרנזקציה
+
+# מחיצות חודשיות ל-crm_leads ושמירת היסטוריה
+CRM_LEADS_PARTITIONS_AHEAD = int(os.getenv("CRM_LEADS_PARTITIONS_AHEAD", 2))      # חודשים קדימה שנוצרים מראש
+CRM_LEADS_RETENTION_MONTHS = int(os.getenv("CRM_LEADS_RETENTION_MONTHS", 0))      # 0 = שומרים הכל
+CRM_LEADS_ARCHIVE_DIR = os.getenv("CRM_LEADS_ARCHIVE_DIR", "")                    # ריק = מחיקה בלי ארכיון
+# התיקייה על Volume קבוע. ב-Railway מערכת הקבצים זמנית ונמחקת בכל פריסה - בלי הסימון לא מוחקים מחיצות
+CRM_LEADS_ARCHIVE_DURABLE = os.getenv("CRM_LEADS_ARCHIVE_DURABLE", "false").lower() in ("1", "true", "yes")
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 6 * 3600))
+CRM_LEADS_LEGACY_BATCH_SIZE = int(os.getenv("CRM_LEADS_LEGACY_BATCH_SIZE", 10000))  # שורות לכל טרנזקציה בהעברת הטבלה הישנה
+CRM_LEADS_LEGACY_PAUSE = float(os.getenv("CRM_LEADS_LEGACY_PAUSE", 0.1))           # שניות בין Batches (עומס על ה-DB)
+
+# ניקוד לידים: חישוב מחדש מצטבר מ-crm_leads עם דעיכה בזמן (scoring.py)
+SCORING_INTERVAL = float(os.getenv("SCORING_INTERVAL", 300))                 # שניות בין ריצות (גם מרווח הביטחון ל-High-water mark)
+SCORING_BATCH_SIZE = int(os.getenv("SCORING_BATCH_SIZE", 100000))            # id-ים של crm_leads / משתמשים לכל טרנזקציה
+SCORING_HALF_LIFE_DAYS = float(os.getenv("SCORING_HALF_LIFE_DAYS", 30))      # אחרי כמה ימים אירוע שווה חצי
+SCORING_SCALE = float(os.getenv("SCORING_SCALE", 8))                         # נקודות גולמיות שמביאות ל-~63% מהטווח 1-10
+SCORING_DECAY_INTERVAL = float(os.getenv("SCORING_DECAY_INTERVAL", 24 * 3600))  # מעבר דעיכה על כל המשתמשים
+SCORING_WEIGHTS = os.getenv("SCORING_WEIGHTS", "")                           # JSON, למשל {"sources": {"support_request": 6}}
+
+# שידורים יזומים לפלחי משתמשים
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))                      # הודעות לשנייה - מתחת ל-TELEGRAM_GLOBAL_RATE כדי להשאיר מקום לתשובות
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 30))          # שליחות במקביל
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", 200))             # נמענים לכל שליפה ו-Checkpoint
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))  # שניות בין עדכוני התקדמות לאדמין
+BROADCAST_STALE_AFTER = float(os.getenv("BROADCAST_STALE_AFTER", 120))      # שידור בלי Checkpoint מזה - ממשיך בתהליך אחר
+
+# עליית השרת
+FAST_BOOT = os.getenv("FAST_BOOT", "true").lower() in ("1", "true", "yes")  # האתחול רץ ברקע; /ready מחזיר 503 עד סיומו
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", 10000))               # אזהרה בלוג אם העלייה איטית מזה
+
+# מדדים ו-Tracing
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))  # חלק העדכונים שמפורקים לפי DB/AI/טלגרם (0 = כבוי)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 2000))          # עדכון שנדגם ואיטי מזה נרשם ללוג
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", 50))                    # עדכונים איטיים אחרונים ב-GET /traces
+
+# Write-Behind: איחוד כתיבות ניקוד ואינטראקציות ל-Batch
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", 500))          # שטיפה מיידית מעל גודל זה
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 2.0))  # שניות בין שטיפות
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", 50000))    # תקרת שורות ממתינות בזיכרון
+
+# מטמון קריאות CRM (ניקוד, הפניות)
+CRM_CACHE_MAX_ENTRIES = int(os.getenv("CRM_CACHE_MAX_ENTRIES", 20000))  # לכל מטמון
+CRM_CACHE_TTL = float(os.getenv("CRM_CACHE_TTL", 300))                 # שניות
+
+# עץ הפניות
+REFERRAL_MAX_DEPTH = int(os.getenv("REFERRAL_MAX_DEPTH", 50))  # עומק מקסימלי במילוי הראשוני
+
+# סיווג כוונות (מטמון + מסווג מקומי לפני LLM)
+INTENT_CACHE_MAX_ENTRIES = int(os.getenv("INTENT_CACHE_MAX_ENTRIES", 10000))
+INTENT_CACHE_TTL = float(os.getenv("INTENT_CACHE_TTL", 86400))
+INTENT_FAST_PATH_THRESHOLD = float(os.getenv("INTENT_FAST_PATH_THRESHOLD", 0.55))  # דמיון n-gram מינימלי
+
+# שאלות נפוצות: תשובה מאינדקס מקומי בלי LLM (faq_index.py)
+FAQ_CORPUS_PATH = os.getenv("FAQ_CORPUS_PATH", "")                            # JSON או HTML; ריק = ה-FAQ של index.html בשורש הריפו
+FAQ_ANSWER_THRESHOLD = float(os.getenv("FAQ_ANSWER_THRESHOLD", 0.6))          # דמיון לשאלה שמעליו עונים ישירות
+FAQ_CONTEXT_THRESHOLD = float(os.getenv("FAQ_CONTEXT_THRESHOLD", 0.1))        # דמיון שמעליו הקטע מצורף כהקשר ל-LLM
+FAQ_CONTEXT_PASSAGES = int(os.getenv("FAQ_CONTEXT_PASSAGES", 2))
+FAQ_RELOAD_INTERVAL = float(os.getenv("FAQ_RELOAD_INTERVAL", 30))             # שניות בין בדיקות שינוי בקובץ (0 = כבוי)
+
+# דף הנחיתה: קבצים סטטיים דחוסים מראש בזיכרון (static_assets.py)
+STATIC_ROOT = os.getenv("STATIC_ROOT", "")                                     # ריק = שורש הריפו
+STATIC_FILES = [x.strip() for x in os.getenv("STATIC_FILES", "index.html,style.css,scripts.js").split(",") if x.strip()]
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", 0))                           # שניות לשמות בלי טביעת אצבע (0 = אימות ETag בכל טעינה)
 
 # וודא שהטוקן קיים
 if not TELEGRAM_BOT_TOKEN:
     logger.error("Must provide TELEGRAM_BOT_TOKEN!")
+
+if WEB_CONCURRENCY > 1 and not CLUSTER_MODE:
+    logger.warning("WEB_CONCURRENCY > 1 without CLUSTER_MODE: every process will set the webhook and run jobs!")
@@ -0,0 +1,161 @@
+# קובץ: conversation_memory.py
+"""
+זיכרון שיחה לכל משתמש, בתוך התהליך.
+Ring Buffer של תורות אחרונים בתקציב טוקנים, תורות ישנים מתקפלים לסיכום קצר,
+ובהחמצה (משתמש שלא בזיכרון) נטען ההיסטוריה מ-crm_leads.
+הזיכרון חסום גם לכל משתמש וגם בסך הכל; משתמשים לא פעילים מפונים לפי LRU.
+במצב Cluster עדכונים של אותו משתמש מגיעים לתהליכים שונים, לכן אין זיכרון בתהליך:
+ההיסטוריה נטענת מ-crm_leads בכל הודעה (ה-Inbox שוטף את ה-Write-Behind לפני שהעדכון מסומן כגמור).
+"""
+
+import re
+import time
+from collections import OrderedDict, deque
+from database import get_db_pool, logger
+from config import (CONV_MAX_TURNS, CONV_TOKEN_BUDGET, CONV_SUMMARY_MAX_CHARS, CONV_MAX_USERS,
+                    CONV_MAX_TOTAL_CHARS, CONV_IDLE_TTL, CONV_HISTORY_DAYS, CLUSTER_MODE)
+
+# מקורות crm_leads שנחשבים לתורות בשיחה
+ROLE_BY_SOURCE = {"user_msg": "user", "ai_reply": "assistant", "faq_reply": "assistant"}
+SUMMARY_SNIPPET_CHARS = 120
+_SENTENCE_END = re.compile(r'[.!?\n]')
+
+
+def estimate_tokens(text):
+    """הערכה גסה וזולה: בעברית טוקן הוא בערך 3 תווים"""
+    return len(text) // 3 + 1
+
+
+class UserConversation:
+    __slots__ = ("turns", "summary", "last_seen", "chars")
+
+    def __init__(self):
+        self.turns = deque(maxlen=CONV_MAX_TURNS)  # (role, text)
+        self.summary = ""
+        self.last_seen = time.monotonic()
+        self.chars = 0
+
+    def recount(self):
+        self.chars = len(self.summary) + sum(len(text) for _, text in self.turns)
+
+
+class ConversationMemory:
+    def __init__(self, token_budget=CONV_TOKEN_BUDGET, max_users=CONV_MAX_USERS,
+                 max_total_chars=CONV_MAX_TOTAL_CHARS, idle_ttl=CONV_IDLE_TTL, shared=CLUSTER_MODE):
+        self.token_budget = token_budget
+        self.max_users = max_users
+        self.max_total_chars = max_total_chars
+        self.idle_ttl = idle_ttl
+        # shared: תהליכים אחרים כותבים לאותם משתמשים - crm_leads הוא מקור האמת היחיד
+        self.shared = shared
+        self._users = OrderedDict()  # user_id -> UserConversation, לפי סדר פעילות
+        self.total_chars = 0
+        # מדדים
+        self.db_loads = 0
+        self.evictions = 0
+        self.summarized_turns = 0
+
+    async def _load(self, user_id):
+        conv = UserConversation()
+        pool = await get_db_pool()
+        if pool:
+            try:
+                async with pool.acquire() as conn:
+                    rows = await conn.fetch("""
+                        SELECT message_content, source FROM crm_leads
+                        WHERE user_id = $1 AND source = ANY($2::text[])
+                          AND created_at >= LOCALTIMESTAMP - make_interval(days => $4)
+                        ORDER BY created_at DESC
+                        LIMIT $3
+                    """, user_id, list(ROLE_BY_SOURCE), CONV_MAX_TURNS, CONV_HISTORY_DAYS)
+                self.db_loads += 1
+                for row in reversed(rows):
+                    if row["message_content"]:
+                        conv.turns.append((ROLE_BY_SOURCE[row["source"]], row["message_content"]))
+            except Exception as e:
+                logger.warning(f"Failed to load conversation for {user_id}: {e}")
+        self._trim(conv)
+        return conv
+
+    async def _get(self, user_id):
+        if self.shared:
+            return await self._load(user_id)
+        conv = self._users.get(user_id)
+        if conv is None:
+            loaded = await self._load(user_id)
+            # ייתכן שהודעה מקבילה של אותו משתמש כבר טענה אותו בזמן ההמתנה ל-DB
+            conv = self._users.get(user_id)
+            if conv is None:
+                conv = self._users[user_id] = loaded
+                self.total_chars += conv.chars
+        else:
+            self._users.move_to_end(user_id)
+        conv.last_seen = time.monotonic()
+        self._evict()
+        return conv
+
+    async def get_messages(self, user_id):
+        """ההקשר לשליחה ל-LLM: סיכום (אם יש) ואחריו התורות האחרונים"""
+        conv = await self._get(user_id)
+        messages = []
+        if conv.summary:
+            messages.append({"role": "system", "content": f"סיכום השיחה הקודמת עם המשתמש: {conv.summary}"})
+        messages.extend({"role": role, "content": text} for role, text in conv.turns)
+        return messages
+
+    async def add_turn(self, user_id, role, text):
+        if self.shared:
+            # התור כבר בדרך ל-crm_leads דרך log_interaction
+            return
+        conv = await self._get(user_id)
+        before = conv.chars
+        if len(conv.turns) == conv.turns.maxlen:
+            self._fold(conv, conv.turns[0])
+        conv.turns.append((role, text))
+        self._trim(conv)
+        self.total_chars += conv.chars - before
+        self._evict()
+
+    def _fold(self, conv, turn):
+        """מקפל תור ישן לסיכום המצטבר (חילוצי, בלי קריאת LLM נוספת)"""
+        role, text = turn
+        if role == "user":
+            snippet = _SENTENCE_END.split(text.strip(), maxsplit=1)[0][:SUMMARY_SNIPPET_CHARS]
+            conv.summary = f"{conv.summary} | {snippet}" if conv.summary else snippet
+            if len(conv.summary) > CONV_SUMMARY_MAX_CHARS:
+                conv.summary = conv.summary[-CONV_SUMMARY_MAX_CHARS:].split(" | ", 1)[-1]
+        self.summarized_turns += 1
+
+    def _trim(self, conv):
+        tokens = estimate_tokens(conv.summary) + sum(estimate_tokens(text) for _, text in conv.turns)
+        # תמיד נשאר לפחות התור האחרון, גם אם הוא לבדו חורג מהתקציב
+        while tokens > self.token_budget and len(conv.turns) > 1:
+            oldest = conv.turns.popleft()
+            tokens -= estimate_tokens(oldest[1])
+            self._fold(conv, oldest)
+        conv.recount()
+
+    def _evict(self):
+        now = time.monotonic()
+        # המשתמש הפעיל כרגע תמיד בסוף ה-LRU ולעולם לא מפונה
+        while len(self._users) > 1:
+            user_id, conv = next(iter(self._users.items()))
+            idle = now - conv.last_seen > self.idle_ttl
+            if not (idle or len(self._users) > self.max_users or self.total_chars > self.max_total_chars):
+                break
+            del self._users[user_id]
+            self.total_chars -= conv.chars
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "shared": self.shared,
+            "users": len(self._users),
+            "total_chars": self.total_chars,
+            "db_loads": self.db_loads,
+            "evictions": self.evictions,
+            "summarized_turns": self.summarized_turns,
+        }
+
+
+conversation_memory = ConversationMemory()
@@ -1,8 +1,383 @@
-from database import get_db_pool, logger
+import asyncio
+import re
+import sys
+from collections import namedtuple
+from database import init_db_pool, get_db_pool, close_db_pool, logger
+from referral_tree import BACKFILL_CLOSURE_SQL, BACKFILL_COUNTS_SQL
+from config import REFERRAL_MAX_DEPTH
+
+# מיגרציה אחת בסכמה. transactional=False עבור פקודות שאסור להריץ בתוך טרנזקציה (CREATE INDEX CONCURRENTLY).
+# פקודה היא מחרוזת SQL, או (sql, פרמטר, ...) לפקודה עם פרמטרים.
+Migration = namedtuple("Migration", ["version", "description", "statements", "transactional"])
+
+# מפתח ל-Advisory Lock כדי שרק תהליך אחד יריץ מיגרציות בכל רגע
+MIGRATION_LOCK_KEY = 0x5C4E3A
+
+# טבלת משתמשים - עם שדות ניקוד וקמפיין
+USERS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        referred_by BIGINT,
+        campaign_source TEXT,
+        lead_score INTEGER DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# טבלת CRM / לידים
+CRM_LEADS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS crm_leads (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT,
+        message_content TEXT,
+        intent_type TEXT,
+        source TEXT DEFAULT 'bot',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# עץ הפניות ממומש: טבלת Closure (כל זוג אב-צאצא ועומקו) ומונים מצטברים לכל מפנה.
+# המילוי הראשוני מ-users.referred_by רץ באותה טרנזקציה, כך שהפניות חדשות נבנות מעל שרשרת אבות מלאה.
+REFERRAL_TABLES_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS referral_closure (
+        ancestor_id BIGINT NOT NULL,
+        descendant_id BIGINT NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant ON referral_closure (descendant_id)",
+    """
+    CREATE TABLE IF NOT EXISTS referral_counts (
+        user_id BIGINT PRIMARY KEY,
+        direct_count INTEGER NOT NULL DEFAULT 0,
+        downline_count INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_referral_counts_downline ON referral_counts (downline_count DESC)",
+    """
+    CREATE TABLE IF NOT EXISTS referral_depth_counts (
+        user_id BIGINT NOT NULL,
+        depth INTEGER NOT NULL,
+        users INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, depth)
+    )
+    """,
+    (BACKFILL_CLOSURE_SQL, REFERRAL_MAX_DEPTH),
+    *BACKFILL_COUNTS_SQL,
+]
+
+# אינדקסים לשאילתות ה-CRM החמות: היסטוריה לפי משתמש, עץ הפניות, סטטיסטיקות קמפיין וייצוא
+HOT_PATH_INDEXES_SQL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_crm_leads_user_created ON crm_leads (user_id, created_at DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_crm_leads_created ON crm_leads (created_at)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_referred_by ON users (referred_by)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_campaign_source ON users (campaign_source)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_created_at ON users (created_at)",
+]
+
+# משימות מתוזמנות (Follow-up / Drip) - ראה scheduler.py
+SCHEDULED_JOBS_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        sequence TEXT NOT NULL,
+        step INTEGER NOT NULL,
+        run_at TIMESTAMP NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        locked_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (sequence, user_id, step)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs (run_at) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_running ON scheduled_jobs (locked_at) WHERE status = 'running'",
+]
+
+# מצב Cluster: תיבת עדכונים משותפת (כפילויות וסדר לכל צ'אט בין תהליכים) ו-Rate Limit משותף
+CLUSTER_TABLES_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS update_inbox (
+        update_id BIGINT PRIMARY KEY,
+        chat_key TEXT NOT NULL,
+        payload JSONB NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        received_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+        locked_at TIMESTAMP,
+        processed_at TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_update_inbox_pending ON update_inbox (update_id) WHERE status = 'pending'",
+    "CREATE INDEX IF NOT EXISTS idx_update_inbox_chat ON update_inbox (chat_key, update_id) WHERE status IN ('pending', 'processing')",
+    "CREATE INDEX IF NOT EXISTS idx_update_inbox_done ON update_inbox (processed_at) WHERE status = 'done'",
+    """
+    CREATE TABLE IF NOT EXISTS rate_limits (
+        key TEXT PRIMARY KEY,
+        tokens DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+]
+
+# סיכומי אנליטיקה מצטברים (ראה analytics.py). המילוי הראשוני מ-users; crm_leads מעובדת ע"י ה-Job.
+ANALYTICS_TABLES_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS analytics_campaign_daily (
+        campaign TEXT NOT NULL,
+        day DATE NOT NULL,
+        signups INTEGER NOT NULL DEFAULT 0,
+        messages INTEGER NOT NULL DEFAULT 0,
+        support_requests INTEGER NOT NULL DEFAULT 0,
+        support_users INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (campaign, day)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_intent_daily (
+        campaign TEXT NOT NULL,
+        day DATE NOT NULL,
+        intent_type TEXT NOT NULL,
+        messages INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (campaign, day, intent_type)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_referrer (
+        referrer_id BIGINT PRIMARY KEY,
+        signups INTEGER NOT NULL DEFAULT 0,
+        messages INTEGER NOT NULL DEFAULT 0,
+        support_requests INTEGER NOT NULL DEFAULT 0,
+        support_users INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_analytics_referrer_signups ON analytics_referrer (signups DESC)",
+    """
+    CREATE TABLE IF NOT EXISTS analytics_score_histogram (
+        campaign TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        users INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (campaign, score)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_support_users (
+        user_id BIGINT PRIMARY KEY,
+        lead_id BIGINT NOT NULL,
+        campaign TEXT NOT NULL,
+        day DATE NOT NULL,
+        referrer_id BIGINT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_analytics_support_users_lead ON analytics_support_users (lead_id)",
+    """
+    CREATE TABLE IF NOT EXISTS analytics_state (
+        name TEXT PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    "INSERT INTO analytics_state (name, last_id) VALUES ('crm_leads', 0) ON CONFLICT DO NOTHING",
+    """
+    INSERT INTO analytics_campaign_daily (campaign, day, signups)
+    SELECT COALESCE(campaign_source, 'direct'), COALESCE(created_at, LOCALTIMESTAMP)::date, COUNT(*) FROM users GROUP BY 1, 2
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO analytics_referrer (referrer_id, signups)
+    SELECT referred_by, COUNT(*) FROM users WHERE referred_by IS NOT NULL GROUP BY 1
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO analytics_score_histogram (campaign, score, users)
+    SELECT COALESCE(campaign_source, 'direct'), COALESCE(lead_score, 1), COUNT(*) FROM users GROUP BY 1, 2
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+# crm_leads כטבלה מחולקת למחיצות חודשיות לפי created_at (ראה partitions.py).
+# רק DDL, כדי שהעלייה לא תחכה להעתקה: הטבלה הישנה נשארת כ-crm_leads_legacy והשורות שלה מועברות ב-Batches
+# אצל המנהיג (partitions.migrate_legacy). ה-Sequence נשמר כדי שה-id ימשיכו לעלות (High-water mark של האנליטיקה).
+PARTITIONED_CRM_LEADS_SQL = [
+    "ALTER TABLE crm_leads RENAME TO crm_leads_legacy",
+    "ALTER TABLE crm_leads_legacy RENAME CONSTRAINT crm_leads_pkey TO crm_leads_legacy_pkey",
+    "ALTER INDEX IF EXISTS idx_crm_leads_user_created RENAME TO idx_crm_leads_legacy_user_created",
+    "ALTER INDEX IF EXISTS idx_crm_leads_created RENAME TO idx_crm_leads_legacy_created",
+    "ALTER SEQUENCE crm_leads_id_seq OWNED BY NONE",
+    "ALTER SEQUENCE crm_leads_id_seq AS BIGINT",
+    """
+    CREATE TABLE crm_leads (
+        id BIGINT NOT NULL DEFAULT nextval('crm_leads_id_seq'),
+        user_id BIGINT,
+        message_content TEXT,
+        intent_type TEXT,
+        source TEXT DEFAULT 'bot',
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    """,
+    "ALTER SEQUENCE crm_leads_id_seq OWNED BY crm_leads.id",
+    # שורות מחוץ לטווח המחיצות (למשל שעון שגוי) לא נכשלות; partitions.py מעביר אותן למחיצה המתאימה
+    "CREATE TABLE crm_leads_default PARTITION OF crm_leads DEFAULT",
+    "CREATE INDEX idx_crm_leads_user_created ON crm_leads (user_id, created_at DESC)",
+    "CREATE INDEX idx_crm_leads_created ON crm_leads (created_at)",
+    """
+    DO $$
+    DECLARE
+        month DATE := date_trunc('month', COALESCE((SELECT MIN(created_at) FROM crm_leads_legacy), LOCALTIMESTAMP))::date;
+        last_month DATE := (date_trunc('month', LOCALTIMESTAMP) + interval '2 months')::date;
+    BEGIN
+        WHILE month <= last_month LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF crm_leads FOR VALUES FROM (%L) TO (%L)',
+                           'crm_leads_p' || to_char(month, 'YYYYMM'), month, (month + interval '1 month')::date);
+            month := (month + interval '1 month')::date;
+        END LOOP;
+    END $$
+    """,
+]
+
+# שידורים יזומים (ראה broadcast.py) וסימון משתמשים שחסמו את הבוט
+BROADCAST_TABLES_SQL = [
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN NOT NULL DEFAULT FALSE",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP",
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id BIGSERIAL PRIMARY KEY,
+        created_by BIGINT,
+        text TEXT NOT NULL,
+        segment JSONB NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'pending',
+        total INTEGER NOT NULL DEFAULT 0,
+        last_user_id BIGINT NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        lease INTEGER NOT NULL DEFAULT 0,
+        progress_chat_id BIGINT,
+        progress_message_id BIGINT,
+        created_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+        started_at TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts (updated_at) WHERE status = 'running'",
+]
+
+# ניקוד לידים מחושב (ראה scoring.py): ניקוד גולמי דעוך לכל משתמש ומצב ה-Job.
+# last_id מתחיל מ-0, כך שה-Job צובר את כל ההיסטוריה הקיימת ב-Batches. decayed_at ריק = השלמת היסטוריה:
+# ה-lead_score הקיים נשאר כמו שהוא עד שה-Job מסיים, ומעבר הדעיכה הראשון מחליף את כולם בבת אחת.
+SCORING_TABLES_SQL = [
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS score_raw DOUBLE PRECISION NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS score_as_of TIMESTAMP",
+    """
+    CREATE TABLE IF NOT EXISTS scoring_state (
+        name TEXT PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        signups_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+        decayed_at TIMESTAMP
+    )
+    """,
+    "INSERT INTO scoring_state (name, signups_at) VALUES ('default', '-infinity') ON CONFLICT DO NOTHING",
+]
+
+# Follow-up אחד פעיל לכל (רצף, משתמש, שלב) במקום אחד לכל החיים: אחרי שנשלח (או בוטל כי המשתמש חסם
+# וחזר) /start חוזר רושם אותו שוב. גם running נכלל - אחרת Retry / Reclaim שמחזיר ל-pending היה מתנגש.
+SCHEDULED_JOBS_LIVE_UNIQUE_SQL = [
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_scheduled_jobs_live ON scheduled_jobs (sequence, user_id, step)
+    WHERE status IN ('pending', 'running')
+    """,
+    "ALTER TABLE scheduled_jobs DROP CONSTRAINT IF EXISTS scheduled_jobs_sequence_user_id_step_key",
+]
+
+# רשימת המיגרציות לפי סדר. לעולם לא משנים מיגרציה קיימת - רק מוסיפים חדשה בסוף.
+MIGRATIONS = [
+    Migration(1, "base tables", [USERS_TABLE_SQL, CRM_LEADS_TABLE_SQL], True),
+    Migration(2, "referral closure tables", REFERRAL_TABLES_SQL, True),
+    Migration(3, "hot-path indexes", HOT_PATH_INDEXES_SQL, False),
+    Migration(4, "scheduled jobs", SCHEDULED_JOBS_SQL, True),
+    Migration(5, "cluster inbox and rate limits", CLUSTER_TABLES_SQL, True),
+    Migration(6, "analytics rollups", ANALYTICS_TABLES_SQL, True),
+    Migration(7, "monthly partitioned crm_leads", PARTITIONED_CRM_LEADS_SQL, True),
+    Migration(8, "broadcasts and blocked users", BROADCAST_TABLES_SQL, True),
+    Migration(9, "computed lead scores", SCORING_TABLES_SQL, True),
+    Migration(10, "one live follow-up per step", SCHEDULED_JOBS_LIVE_UNIQUE_SQL, True),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+SCHEMA_VERSION_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+async def get_schema_version(conn):
+    """הגרסה הנוכחית של הסכמה (0 אם עוד לא הורצו מיגרציות)"""
+    if await conn.fetchval("SELECT to_regclass('schema_version')") is None:
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+async def _drop_invalid_indexes(conn, statements):
+    """CREATE INDEX CONCURRENTLY שנכשל משאיר אינדקס INVALID ש-IF NOT EXISTS ידלג עליו - מוחקים אותו לפני ניסיון חוזר"""
+    names = [m.group(1) for m in (re.search(r"IF NOT EXISTS (\w+)", sql) for sql in statements) if m]
+    invalid = await conn.fetch("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid AND c.relname = ANY($1::text[])
+    """, names)
+    for row in invalid:
+        logger.warning(f"Dropping invalid index {row['relname']} before rebuilding it.")
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{row["relname"]}"')
+
+def _execute(conn, statement):
+    if isinstance(statement, tuple):
+        return conn.execute(*statement)
+    return conn.execute(statement)
+
+async def apply_migration(conn, migration):
+    if migration.transactional:
+        async with conn.transaction():
+            for statement in migration.statements:
+                await _execute(conn, statement)
+            await conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                migration.version, migration.description
+            )
+    else:
+        await _drop_invalid_indexes(conn, migration.statements)
+        for statement in migration.statements:
+            await _execute(conn, statement)
+        await conn.execute(
+            "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+            migration.version, migration.description
+        )
+
+async def run_migrations(conn):
+    """מריץ את כל המיגרציות שטרם הורצו. מחזיר את הגרסה הסופית."""
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_KEY)
+    try:
+        await conn.execute(SCHEMA_VERSION_TABLE_SQL)
+        # קריאה חוזרת אחרי הנעילה - ייתכן שתהליך אחר כבר סיים
+        current = await get_schema_version(conn)
+        for migration in MIGRATIONS:
+            if migration.version <= current:
+                continue
+            logger.info(f"Applying migration {migration.version}: {migration.description}")
+            await apply_migration(conn, migration)
+            current = migration.version
+        return current
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
 
 async def create_tables():
     """
-    יוצר את סכמת הטבלאות ב-PostgreSQL.
+    מביא את הסכמה ב-PostgreSQL לגרסה האחרונה.
+    כשהסכמה כבר עדכנית - רק בדיקת גרסה, בלי שום DDL.
     """
     pool = await get_db_pool()
     if not pool:
@@ -10,31 +385,31 @@ async def create_tables():
 
     async with pool.acquire() as conn:
         try:
-            # טבלת משתמשים - עם שדות ניקוד וקמפיין
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    referred_by BIGINT,
-                    campaign_source TEXT,          
-                    lead_score INTEGER DEFAULT 1,  
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            # טבלת CRM / לידים
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS crm_leads (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT,
-                    message_content TEXT,
-                    intent_type TEXT,              
-                    source TEXT DEFAULT 'bot',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            logger.info("Tables created/verified successfully with new schema.")
+            current = await get_schema_version(conn)
+            if current >= LATEST_VERSION:
+                logger.info(f"Schema is up to date (v{current}).")
+                return
+
+            current = await run_migrations(conn)
+            logger.info(f"Schema migrated to v{current}.")
         except Exception as e:
-            logger.error(f"Error creating tables: {e}")
+            logger.error(f"Error migrating schema: {e}")
+
+async def _main(argv):
+    """python create_tables.py [status]"""
+    await init_db_pool()
+    pool = await get_db_pool()
+    if not pool:
+        return 1
+    try:
+        if argv[1:] == ["status"]:
+            async with pool.acquire() as conn:
+                print(f"schema version: {await get_schema_version(conn)} (latest: {LATEST_VERSION})")
+        else:
+            await create_tables()
+    finally:
+        await close_db_pool()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))
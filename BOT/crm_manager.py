@@ -1,94 +1,372 @@
 # קובץ: crm_manager.py
 
-from database import get_db_pool, logger
+import asyncio
+import datetime
+import time
+from database import get_db_pool, fetchval_hot, hot_statement, logger
+from cache import TTLCache, MISSING
+import referral_tree
+import analytics
+from analytics import score_update_sql
+from metrics import timed
+from config import (WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_PENDING,
+                    CRM_CACHE_MAX_ENTRIES, CRM_CACHE_TTL, CLUSTER_MODE, CLUSTER_STATS_RESYNC)
+
+LEAD_SCORE = hot_statement("lead_score", "SELECT lead_score FROM users WHERE user_id = $1")
+
+MAX_LEAD_SCORE = 10
+LEAD_COLUMNS = ['user_id', 'message_content', 'source', 'intent_type', 'created_at']
+
+# משתמשים שחסמו את הבוט (Forbidden בשליחה): לא נכללים בשידורים, וה-Follow-ups שלהם מבוטלים.
+# /start חוזר מנקה את הסימון (ראה add_user).
+MARK_BLOCKED_SQL = """
+    WITH blocked AS (
+        UPDATE users SET is_blocked = TRUE, blocked_at = LOCALTIMESTAMP
+        WHERE user_id = ANY($1::bigint[]) AND NOT is_blocked
+        RETURNING user_id
+    )
+    UPDATE scheduled_jobs SET status = 'cancelled', locked_at = NULL
+    WHERE user_id = ANY($1::bigint[]) AND status = 'pending'
+"""
+
+# עדכון ניקוד מאוחד לכל המשתמשים ב-Round-trip אחד, כולל העברת המשתמשים בין תאי התפלגות הניקוד
+# של האנליטיקה. מחזיר את סך הנקודות שנוספו בפועל (אחרי התקרה) לטובת הסיכומים הרצים.
+FLUSH_SCORES_SQL = score_update_sql("""
+    d AS (
+        SELECT * FROM unnest($1::bigint[], $2::int[]) AS t(user_id, delta)
+    ), old AS (
+        SELECT u.user_id, u.lead_score FROM users u JOIN d USING (user_id) FOR UPDATE OF u
+    ), upd AS (
+        UPDATE users AS u
+        SET lead_score = LEAST(o.lead_score + d.delta, 10)
+        FROM d JOIN old o USING (user_id)
+        WHERE u.user_id = d.user_id
+        RETURNING COALESCE(u.campaign_source, 'direct') AS campaign, o.lead_score AS old_score, u.lead_score AS new_score
+    )
+""")
+
+
+class RunningStats:
+    """סיכומים רצים לפאנל הניהול - נטענים פעם אחת ומתעדכנים בכל כתיבה, בלי לסרוק את users"""
+
+    def __init__(self):
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.total_users = 0
+        self.score_sum = 0
+
+    def needs_load(self):
+        # במצב Cluster תהליכים אחרים כותבים גם הם, לכן טוענים מחדש מדי פעם
+        if not self.loaded:
+            return True
+        return CLUSTER_MODE and time.monotonic() - self.loaded_at > CLUSTER_STATS_RESYNC
+
+    async def load(self, conn):
+        row = await conn.fetchrow("SELECT COUNT(*) AS total, COALESCE(SUM(lead_score), 0) AS score_sum FROM users")
+        self.total_users = row["total"]
+        self.score_sum = row["score_sum"]
+        self.loaded = True
+        self.loaded_at = time.monotonic()
+
+    def add_user(self, initial_score=1):
+        self.total_users += 1
+        self.score_sum += initial_score
+
+    def add_score(self, applied):
+        self.score_sum += applied
+
+    def snapshot(self):
+        avg_score = self.score_sum / self.total_users if self.total_users else 0
+        return {"total_users": self.total_users, "avg_score": round(float(avg_score), 2)}
+
+
+running_stats = RunningStats()
+score_cache = TTLCache(CRM_CACHE_MAX_ENTRIES, CRM_CACHE_TTL, name="lead_score")
+referral_cache = TTLCache(CRM_CACHE_MAX_ENTRIES, CRM_CACHE_TTL, name="referral_count")
+
+
+class WriteBehindBuffer:
+    """
+    מאגר כתיבה מושהית (Write-Behind).
+    מאחד תוספות ניקוד לפי user_id ואוסף שורות crm_leads, ושוטף הכל
+    בחיבור אחד כשהתור מתמלא או כשעובר פרק הזמן שהוגדר.
+    """
+
+    def __init__(self, max_batch=WRITE_BEHIND_MAX_BATCH, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._score_deltas = {}     # user_id -> סכום נקודות שטרם נכתב
+        self._inflight_deltas = {}  # נקודות שנמצאות כרגע בשטיפה
+        self._leads = []            # שורות crm_leads שטרם נכתבו
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+        # מדדים
+        self.flushes = 0
+        self.flush_errors = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._score_deltas) + len(self._leads)
+
+    def add_score(self, user_id, points):
+        self._score_deltas[user_id] = self._score_deltas.get(user_id, 0) + points
+        self._maybe_wakeup()
+
+    def add_interaction(self, user_id, content, source, intent_type):
+        self._leads.append((user_id, content, source, intent_type, datetime.datetime.utcnow()))
+        overflow = len(self._leads) - self.max_pending
+        if overflow > 0:
+            # הגנה על הזיכרון כשה-DB לא זמין: זורקים את השורות הישנות ביותר
+            del self._leads[:overflow]
+            self.dropped += overflow
+        self._maybe_wakeup()
+
+    def pending_score(self, user_id):
+        """נקודות שנרשמו אך עדיין לא הגיעו ל-DB"""
+        return self._score_deltas.get(user_id, 0) + self._inflight_deltas.get(user_id, 0)
+
+    def _maybe_wakeup(self):
+        if self.queue_depth >= self.max_batch:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+            logger.info("Write-behind buffer started.")
+
+    async def stop(self):
+        """
+        עוצר את לולאת השטיפה ומרוקן את כל מה שנשאר בתור.
+        בלי cancel: שטיפה שכבר באמצע מסתיימת, אחרת ה-Batch שלה (שכבר הוצא מהתור) היה הולך לאיבוד.
+        """
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        logger.info(f"Write-behind buffer drained (pending: {self.queue_depth}).")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @timed("crm", "write_behind_flush")
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._score_deltas and not self._leads:
+                return
+
+            pool = await get_db_pool()
+            if not pool:
+                self._score_deltas, self._leads = {}, []
+                return
+
+            deltas, self._score_deltas = self._score_deltas, {}
+            leads, self._leads = self._leads, []
+            self._inflight_deltas = deltas
+            started = time.perf_counter()
+            try:
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        applied = 0
+                        if deltas:
+                            applied = await conn.fetchval(FLUSH_SCORES_SQL, list(deltas.keys()), list(deltas.values()))
+                        if leads:
+                            await conn.copy_records_to_table('crm_leads', records=leads, columns=LEAD_COLUMNS)
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Write-behind flush failed ({len(deltas)} scores, {len(leads)} leads): {e}")
+                self._requeue(deltas, leads)
+            except BaseException:
+                # ביטול באמצע הטרנזקציה (CancelledError אינו Exception) - ה-Batch חוזר לתור לשטיפה הבאה
+                self._requeue(deltas, leads)
+                raise
+            else:
+                running_stats.add_score(applied or 0)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.flushes += 1
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self._total_flush_ms += elapsed_ms
+                logger.debug(f"Write-behind flushed {len(deltas)} scores, {len(leads)} leads in {elapsed_ms:.1f}ms")
+            finally:
+                self._inflight_deltas = {}
+
+    def _requeue(self, deltas, leads):
+        for user_id, points in deltas.items():
+            self._score_deltas[user_id] = self._score_deltas.get(user_id, 0) + points
+        self._leads = leads + self._leads
+        overflow = len(self._leads) - self.max_pending
+        if overflow > 0:
+            del self._leads[:overflow]
+            self.dropped += overflow
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "pending_scores": len(self._score_deltas),
+            "pending_leads": len(self._leads),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "dropped": self.dropped,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+
+write_buffer = WriteBehindBuffer()
+
 
 class CRMManager:
+    write_buffer = write_buffer
+
     @staticmethod
+    @timed("crm", "add_user")
     async def add_user(user_id, username, first_name, referred_by=None, campaign_source=None):
         pool = await get_db_pool()
         if not pool: return
-        
+
         async with pool.acquire() as conn:
             try:
-                await conn.execute("""
-                    INSERT INTO users (user_id, username, first_name, referred_by, campaign_source)
-                    VALUES ($1, $2, $3, $4, $5)
-                    ON CONFLICT (user_id) DO NOTHING
-                """, user_id, username, first_name, referred_by, campaign_source)
+                async with conn.transaction():
+                    inserted = await conn.fetchval("""
+                        INSERT INTO users (user_id, username, first_name, referred_by, campaign_source)
+                        VALUES ($1, $2, $3, $4, $5)
+                        ON CONFLICT (user_id) DO NOTHING
+                        RETURNING user_id
+                    """, user_id, username, first_name, referred_by, campaign_source)
+                    if inserted is not None:
+                        await referral_tree.record_referral(conn, user_id, referred_by)
+                        await analytics.record_signup(conn, campaign_source, referred_by)
+                    else:
+                        # משתמש שחסם את הבוט וחזר - שוב נכלל בשידורים
+                        await conn.execute(
+                            "UPDATE users SET is_blocked = FALSE, blocked_at = NULL WHERE user_id = $1 AND is_blocked",
+                            user_id,
+                        )
             except Exception as e:
                 logger.error(f"DB Error add_user: {e}")
+                return
+
+        if inserted is not None:
+            # משתמש חדש: ניקוד התחלתי ידוע, והמפנה קיבל הפניה נוספת
+            score_cache.set(user_id, 1)
+            if referred_by is not None:
+                referral_cache.update(referred_by, lambda count: count + 1)
+            if running_stats.loaded:
+                running_stats.add_user()
 
     @staticmethod
+    @timed("crm", "log_interaction")
     async def log_interaction(user_id, content, source="ai_chat", intent_type=None):
+        """נרשם ל-Buffer ונכתב ל-crm_leads בשטיפה הבאה (COPY)"""
         pool = await get_db_pool()
         if not pool: return
 
-        async with pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO crm_leads (user_id, message_content, source, intent_type)
-                VALUES ($1, $2, $3, $4)
-            """, user_id, content, source, intent_type)
-    
+        write_buffer.add_interaction(user_id, content, source, intent_type)
+
     @staticmethod
+    @timed("crm", "update_lead_score")
     async def update_lead_score(user_id, points=1):
-        """מעלה את ניקוד הליד (מקסימום 10)"""
+        """מעלה את ניקוד הליד (מקסימום 10). העדכון מאוחד ונכתב בשטיפה הבאה."""
         pool = await get_db_pool()
         if not pool: return
 
-        async with pool.acquire() as conn:
-            await conn.execute("""
-                UPDATE users SET lead_score = LEAST(lead_score + $1, 10)
-                WHERE user_id = $2
-            """, points, user_id)
-            logger.info(f"Lead score updated for {user_id}. Added {points} points.")
+        write_buffer.add_score(user_id, points)
+        score_cache.update(user_id, lambda score: min(score + points, MAX_LEAD_SCORE) if score is not None else None)
+        logger.info(f"Lead score updated for {user_id}. Added {points} points.")
 
     @staticmethod
+    @timed("crm", "get_stats")
     async def get_stats():
         pool = await get_db_pool()
         if not pool: return {"total_users": 0, "avg_score": 0}
-        
-        async with pool.acquire() as conn:
-            total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-            avg_score = await conn.fetchval("SELECT AVG(lead_score) FROM users")
-            return {"total_users": total_users, "avg_score": round(float(avg_score or 0), 2)}
+
+        if running_stats.needs_load():
+            async with pool.acquire() as conn:
+                await running_stats.load(conn)
+        return running_stats.snapshot()
 
     @staticmethod
+    @timed("crm", "get_user_lead_score")
     async def get_user_lead_score(user_id):
         pool = await get_db_pool()
         if not pool: return 1
-        async with pool.acquire() as conn:
-            return await conn.fetchval("SELECT lead_score FROM users WHERE user_id = $1", user_id)
+
+        # במצב Cluster תהליכים אחרים מעדכנים את הניקוד - ה-Cache המקומי היה מחזיר ערך ישן
+        if not CLUSTER_MODE:
+            cached = score_cache.get(user_id)
+            if cached is not MISSING:
+                return cached
+
+        score = await fetchval_hot(LEAD_SCORE, user_id)
+        if score is not None:
+            # כולל נקודות שעדיין ממתינות ב-Write-Behind
+            score = min(score + write_buffer.pending_score(user_id), MAX_LEAD_SCORE)
+        score_cache.set(user_id, score)
+        return score
 
     @staticmethod
+    @timed("crm", "get_referral_count")
     async def get_referral_count(user_id):
         """סופר כמה משתמשים הופנו ישירות על ידי המשתמש הזה"""
         pool = await get_db_pool()
         if not pool: return 0
-        async with pool.acquire() as conn:
-            count = await conn.fetchval("""
-                SELECT COUNT(*) FROM users WHERE referred_by = $1
-            """, user_id)
-            return count or 0
+
+        cached = referral_cache.get(user_id)
+        if cached is not MISSING:
+            return cached
+
+        count = await fetchval_hot(referral_tree.DIRECT_COUNT, user_id) or 0
+        referral_cache.set(user_id, count)
+        return count
 
     @staticmethod
+    @timed("crm", "get_referral_downline_count")
     async def get_referral_downline_count(user_id):
-        """סופר את כל המשתמשים שהופנו על ידי המשתמש הזה ומטה (דורות)"""
+        """סופר את כל המשתמשים שהופנו על ידי המשתמש הזה ומטה (דורות) - מתוך המונים הממומשים"""
         pool = await get_db_pool()
         if not pool: return 0
+        return await fetchval_hot(referral_tree.DOWNLINE_COUNT, user_id) or 0
+
+    @staticmethod
+    @timed("crm", "get_referral_depth_counts")
+    async def get_referral_depth_counts(user_id):
+        """פילוח הרשת לפי דורות: {1: ישירים, 2: ..., }"""
+        pool = await get_db_pool()
+        if not pool: return {}
         async with pool.acquire() as conn:
-            count = await conn.fetchval("""
-                WITH RECURSIVE downline AS (
-                    SELECT user_id
-                    FROM users
-                    WHERE referred_by = $1
-                    UNION ALL
-                    SELECT u.user_id
-                    FROM users u
-                    JOIN downline d ON u.referred_by = d.user_id
-                )
-                SELECT COUNT(*) FROM downline
-            """, user_id)
-            return count or 0
+            return await referral_tree.get_depth_counts(conn, user_id)
+
+    @staticmethod
+    @timed("crm", "get_top_referrers")
+    async def get_top_referrers(limit=10):
+        pool = await get_db_pool()
+        if not pool: return []
+        async with pool.acquire() as conn:
+            return await referral_tree.get_top_referrers(conn, limit)
+
+    @staticmethod
+    def cache_stats():
+        return {cache.name: cache.stats() for cache in (score_cache, referral_cache)}
 
 # הגדרת המופע של ה-CRM כמשתנה גלובלי
 crm = CRMManager()
@@ -1,22 +1,175 @@
+import asyncio
 import asyncpg
-from config import DATABASE_URL, logger
-import io
-import csv
-import datetime
+from config import (DATABASE_URL, EXPORT_SPOOL_MAX_MEMORY, EXPORT_MAX_BYTES, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_ACQUIRE_TIMEOUT,
+                    DB_COMMAND_TIMEOUT, DB_MAX_QUERIES, DB_MAX_INACTIVE_LIFETIME, DB_STATEMENT_CACHE_SIZE,
+                    DB_RETRY_ATTEMPTS, DB_SLOW_QUERY_MS, logger)
+from metrics import Histogram
+from tracing import tracer
+import gzip
+import tempfile
+import time
 
 pool = None
 
+# שגיאות שבהן ניסיון חוזר על חיבור אחר צפוי להצליח
+TRANSIENT_ERRORS = (
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.ConnectionDoesNotExistError,
+    asyncpg.exceptions.TooManyConnectionsError,
+    asyncpg.exceptions.CannotConnectNowError,
+    asyncpg.exceptions.SerializationError,
+    asyncpg.exceptions.DeadlockDetectedError,
+    ConnectionError,
+)
+
+# שאילתות חמות: מוכנות (PREPARE) פעם אחת לכל חיבור. המודולים רושמים אותן עם hot_statement.
+HOT_STATEMENTS = {}
+
+def hot_statement(name, sql):
+    HOT_STATEMENTS[name] = sql
+    return name
+
+def get_dsn():
+    # asyncpg דורש postgresql://
+    return DATABASE_URL.replace("postgres://", "postgresql://") if DATABASE_URL else None
+
+
+class PoolStats:
+    def __init__(self):
+        self.waiting = 0
+        self.acquire_timeouts = 0
+        self.retries = 0
+        self.slow_queries = 0
+        self.query_errors = 0
+        self.acquire_wait = Histogram()
+        self.query_latency = Histogram()
+        self.hot_latency = {}  # שם שאילתה חמה -> Histogram
+
+    def on_query(self, record):
+        """Query logger של asyncpg - נקרא אחרי כל שאילתה עם זמן הריצה"""
+        self.query_latency.observe(record.elapsed)
+        tracer.add("db", record.elapsed)
+        if record.exception is not None:
+            self.query_errors += 1
+        if record.elapsed * 1000 >= DB_SLOW_QUERY_MS:
+            self.slow_queries += 1
+            logger.warning(f"Slow query ({record.elapsed * 1000:.0f}ms): {' '.join(record.query.split())[:200]}")
+
+    def observe_hot(self, name, elapsed):
+        histogram = self.hot_latency.get(name)
+        if histogram is None:
+            histogram = self.hot_latency[name] = Histogram()
+        histogram.observe(elapsed)
+
+
+pool_stats = PoolStats()
+
+
+class CRMConnection(asyncpg.Connection):
+    """חיבור עם מטמון Prepared Statements לשאילתות החמות (נשמר בין השאלות מה-Pool)"""
+
+    async def _hot(self, name):
+        prepared = self.__dict__.setdefault("_hot_statements", {})
+        statement = prepared.get(name)
+        if statement is None:
+            statement = prepared[name] = await self.prepare(HOT_STATEMENTS[name])
+        return statement
+
+    async def prepare_hot_statements(self):
+        for name in HOT_STATEMENTS:
+            try:
+                await self._hot(name)
+            except asyncpg.exceptions.UndefinedTableError:
+                # DB חדש שהמיגרציות עוד לא רצו עליו - יוכן בשימוש הראשון
+                pass
+
+    async def run_hot(self, name, method, *args):
+        started = time.perf_counter()
+        try:
+            statement = await self._hot(name)
+            try:
+                return await getattr(statement, method)(*args)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                # הסכמה השתנתה (למשל מיגרציה) - מכינים מחדש
+                self._hot_statements.pop(name, None)
+                return await getattr(await self._hot(name), method)(*args)
+        finally:
+            pool_stats.observe_hot(name, time.perf_counter() - started)
+
+    async def fetchval_hot(self, name, *args):
+        return await self.run_hot(name, "fetchval", *args)
+
+    async def fetchrow_hot(self, name, *args):
+        return await self.run_hot(name, "fetchrow", *args)
+
+    async def fetch_hot(self, name, *args):
+        return await self.run_hot(name, "fetch", *args)
+
+
+async def _init_connection(conn):
+    if hasattr(conn, "add_query_logger"):
+        conn.add_query_logger(pool_stats.on_query)
+    await conn.prepare_hot_statements()
+
+
+class _Acquire:
+    def __init__(self, raw_pool, timeout):
+        self._pool = raw_pool
+        self._timeout = timeout
+        self._conn = None
+
+    async def __aenter__(self):
+        pool_stats.waiting += 1
+        started = time.perf_counter()
+        try:
+            self._conn = await self._pool.acquire(timeout=self._timeout)
+        except asyncio.TimeoutError:
+            pool_stats.acquire_timeouts += 1
+            logger.error(f"Timed out after {self._timeout}s waiting for a DB connection")
+            raise
+        finally:
+            pool_stats.waiting -= 1
+            pool_stats.acquire_wait.observe(time.perf_counter() - started)
+        return self._conn
+
+    async def __aexit__(self, *exc_info):
+        await self._pool.release(self._conn)
+
+
+class InstrumentedPool:
+    """עטיפה דקה ל-asyncpg.Pool: Timeout ומדדים על acquire, כל השאר מועבר כמו שהוא"""
+
+    def __init__(self, raw_pool, acquire_timeout=DB_ACQUIRE_TIMEOUT):
+        self._pool = raw_pool
+        self.acquire_timeout = acquire_timeout
+
+    def acquire(self, timeout=None):
+        return _Acquire(self._pool, timeout or self.acquire_timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
 async def init_db_pool():
-    """יצירת Pool של חיבורים למסד הנתונים PostgreSQL"""
+    """יצירת Pool של חיבורים למסד הנתונים PostgreSQL, עם ההגדרות מ-config"""
     global pool
     if not DATABASE_URL:
         logger.error("DATABASE_URL is missing!")
         return
     try:
-        # asyncpg דורש postgresql://
-        dsn = DATABASE_URL.replace("postgres://", "postgresql://")
-        pool = await asyncpg.create_pool(dsn)
-        logger.info("Database pool created successfully.")
+        raw_pool = await asyncpg.create_pool(
+            get_dsn(),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            max_queries=DB_MAX_QUERIES,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            connection_class=CRMConnection,
+            init=_init_connection,
+        )
+        pool = InstrumentedPool(raw_pool)
+        logger.info(f"Database pool created successfully ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE} connections).")
     except Exception as e:
         logger.error(f"Failed to create DB pool: {e}")
 
@@ -28,37 +181,159 @@ async def close_db_pool():
         await pool.close()
         logger.info("Database pool closed.")
 
-async def fetch_all_users_csv():
-    """שולף את כל נתוני המשתמשים ומחזיר אותם כקובץ CSV בזיכרון."""
+async def with_retry(fn, attempts=DB_RETRY_ATTEMPTS):
+    """
+    מריץ fn(conn) על חיבור מה-Pool, ובשגיאה זמנית (חיבור שנפל, Deadlock, Failover) מנסה שוב על חיבור אחר.
+    רק לפעולות שבטוח להריץ פעמיים (קריאות, או כתיבות אידמפוטנטיות).
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            async with pool.acquire() as conn:
+                return await fn(conn)
+        except TRANSIENT_ERRORS as e:
+            if attempt >= attempts:
+                raise
+            pool_stats.retries += 1
+            logger.warning(f"Transient DB error (attempt {attempt}/{attempts}): {e}")
+            await asyncio.sleep(0.05 * 2 ** attempt)
+
+async def fetchval_hot(name, *args):
+    return await with_retry(lambda conn: conn.fetchval_hot(name, *args))
+
+async def fetchrow_hot(name, *args):
+    return await with_retry(lambda conn: conn.fetchrow_hot(name, *args))
+
+async def fetch_hot(name, *args):
+    return await with_retry(lambda conn: conn.fetch_hot(name, *args))
+
+async def check_health(timeout=2.0):
+    """SELECT 1 עם Timeout קצר - לבדיקות מוכנות ולמדדים"""
+    if not pool:
+        return {"ok": False, "error": "no pool"}
+    started = time.perf_counter()
+    try:
+        async with pool.acquire(timeout=timeout) as conn:
+            await conn.fetchval("SELECT 1", timeout=timeout)
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+    return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+def pool_metrics():
+    if not pool:
+        return {}
+    size = pool.get_size()
+    return {
+        "size": size,
+        "in_use": size - pool.get_idle_size(),
+        "min_size": pool.get_min_size(),
+        "max_size": pool.get_max_size(),
+        "waiting": pool_stats.waiting,
+        "acquire_timeouts": pool_stats.acquire_timeouts,
+        "retries": pool_stats.retries,
+        "slow_queries": pool_stats.slow_queries,
+        "query_errors": pool_stats.query_errors,
+        "acquire_wait": pool_stats.acquire_wait.snapshot(),
+        "query_latency": pool_stats.query_latency.snapshot(),
+        "hot_statements": {name: h.snapshot() for name, h in pool_stats.hot_latency.items()},
+    }
+
+# עמודות הייצוא לכל טבלה
+EXPORT_COLUMNS = {
+    "users": ['user_id', 'username', 'first_name', 'referred_by', 'campaign_source', 'lead_score', 'created_at'],
+    "leads": ['id', 'user_id', 'message_content', 'intent_type', 'source', 'created_at'],
+}
+
+def build_export_query(table="users", campaign=None, since=None, until=None, min_score=None):
+    """בונה שאילתת ייצוא עם מסננים. מחזיר (sql, args)."""
+    args = []
+    clauses = []
+
+    def arg(value):
+        args.append(value)
+        return f"${len(args)}"
+
+    if table == "users":
+        columns = ", ".join(f"u.{c}" for c in EXPORT_COLUMNS["users"])
+        sql = f"SELECT {columns} FROM users u"
+        time_column = "u.created_at"
+        needs_users = False
+    elif table == "leads":
+        columns = ", ".join(f"l.{c}" for c in EXPORT_COLUMNS["leads"])
+        # JOIN ל-users רק כשמסננים לפי נתוני המשתמש
+        needs_users = campaign is not None or min_score is not None
+        sql = f"SELECT {columns} FROM crm_leads l" + (" JOIN users u ON u.user_id = l.user_id" if needs_users else "")
+        time_column = "l.created_at"
+    else:
+        raise ValueError(f"Unknown export table: {table}")
+
+    if campaign is not None:
+        clauses.append(f"u.campaign_source = {arg(campaign)}")
+    if min_score is not None:
+        clauses.append(f"u.lead_score >= {arg(min_score)}")
+    if since is not None:
+        clauses.append(f"{time_column} >= {arg(since)}")
+    if until is not None:
+        clauses.append(f"{time_column} < {arg(until)}")
+
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += f" ORDER BY {time_column} DESC"
+    return sql, args
+
+# COPY מחזיר חלקים קטנים; הם נאספים לגודל הזה לפני כתיבה (ודחיסה) ב-Thread
+EXPORT_WRITE_CHUNK = 1024 * 1024
+
+class ExportTooLarge(Exception):
+    """הייצוא עבר את EXPORT_MAX_BYTES - ה-COPY נעצר באמצע, בלי להמשיך לקרוא את כל הטבלה"""
+
+async def export_csv(table="users", campaign=None, since=None, until=None, min_score=None, compress=False):
+    """
+    מייצא טבלה ל-CSV ישירות מ-COPY ... TO STDOUT, בחלקים, לקובץ זמני (Spooled).
+    - הכתיבה והדחיסה רצות ב-Thread, לא על ה-Event loop.
+    - עד EXPORT_SPOOL_MAX_MEMORY בזיכרון, מעבר לזה בדיסק. בהעלאה PTB קורא את כל הקובץ לזיכרון,
+      ולכן הקובץ חסום ב-EXPORT_MAX_BYTES (מתחת לתקרת ההעלאה של טלגרם); מעבר לה נזרק ExportTooLarge.
+    מחזיר (file, rows) או None אם אין נתונים / אירעה שגיאה.
+    """
     pool = await get_db_pool()
     if not pool: return None
 
-    async with pool.acquire() as conn:
-        try:
-            records = await conn.fetch("""
-                SELECT user_id, username, first_name, referred_by, campaign_source, lead_score, created_at 
-                FROM users 
-                ORDER BY created_at DESC
-            """)
-            
-            if not records:
-                return None
-
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # כתיבת כותרות
-            headers = ['user_id', 'username', 'first_name', 'referred_by', 'campaign_source', 'lead_score', 'created_at']
-            writer.writerow(headers)
-            
-            # כתיבת נתונים
-            for record in records:
-                row = [record[h] for h in headers]
-                writer.writerow(row)
-
-            output.seek(0)
-            return output
-
-        except Exception as e:
-            logger.error(f"DB Export Error: {e}")
-            return None
+    sql, args = build_export_query(table, campaign, since, until, min_score)
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_MEMORY, mode="w+b")
+    sink = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    pending = bytearray()
+
+    async def write_pending():
+        data = bytes(pending)
+        pending.clear()
+        await asyncio.to_thread(sink.write, data)
+        if spool.tell() > EXPORT_MAX_BYTES:
+            raise ExportTooLarge(f"export exceeds {EXPORT_MAX_BYTES} bytes")
+
+    async def write_chunk(chunk):
+        pending.extend(chunk)
+        if len(pending) >= EXPORT_WRITE_CHUNK:
+            await write_pending()
+
+    try:
+        async with pool.acquire() as conn:
+            status = await conn.copy_from_query(sql, *args, output=write_chunk, format="csv", header=True)
+        await write_pending()
+        if compress:
+            await asyncio.to_thread(sink.close)  # סוגר רק את שכבת ה-gzip, הקובץ עצמו נשאר פתוח
+            if spool.tell() > EXPORT_MAX_BYTES:
+                raise ExportTooLarge(f"export exceeds {EXPORT_MAX_BYTES} bytes")
+    except ExportTooLarge:
+        spool.close()
+        raise
+    except Exception as e:
+        logger.error(f"DB Export Error: {e}")
+        spool.close()
+        return None
+
+    rows = int(status.split()[-1]) if status else 0
+    if not rows:
+        spool.close()
+        return None
+
+    spool.seek(0)
+    return spool, rows
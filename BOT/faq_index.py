@@ -0,0 +1,293 @@
+# קובץ: faq_index.py
+"""
+אינדקס שאלות נפוצות מקומי, לפני הקריאה ל-LLM:
+1. דמיון גבוה לשאלה מהקורפוס (FAQ_ANSWER_THRESHOLD) - התשובה נשלחת מיד, בלי LLM.
+2. אחרת - הקטעים הקרובים ביותר (מעל FAQ_CONTEXT_THRESHOLD) מצורפים כהקשר לקריאה ל-LLM.
+- ייצוג: TF-IDF על n-gram תווים (3 ו-4) של טקסט מנורמל (כמו intent_engine), וקטורים דלילים ב-NumPy
+  שמאוחסנים לפי עמודה (אינדקס הפוך), כך שחיפוש נוגע רק בשורות שחולקות n-gram עם השאלה.
+- הקורפוס: קובץ JSON ([{"question", "answer", "alternates"}]) או HTML עם .faq-item / .faq-question / .faq-answer.
+  ברירת המחדל היא ה-FAQ של דף הנחיתה (index.html).
+- טעינה מחדש כשהקובץ משתנה (FAQ_RELOAD_INTERVAL) או ב-/faq reload: נבנה אינדקס חדש ומוחלף בבת אחת.
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+from collections import Counter, namedtuple
+from html.parser import HTMLParser
+import numpy as np
+from intent_engine import normalize
+from metrics import Histogram
+from config import (FAQ_CORPUS_PATH, FAQ_ANSWER_THRESHOLD, FAQ_CONTEXT_THRESHOLD, FAQ_CONTEXT_PASSAGES,
+                    FAQ_RELOAD_INTERVAL, logger)
+
+SITE_FAQ_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "index.html")
+NGRAM_SIZES = (3, 4)
+# חיפוש באינדקס לוקח עשרות מיקרו-שניות - הגבולות של metrics.DEFAULT_BUCKETS גסים מדי
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)
+
+FAQEntry = namedtuple("FAQEntry", ["question", "answer", "alternates"])
+FAQMatch = namedtuple("FAQMatch", ["answer", "score", "context"])
+
+_MARKDOWN_BOLD = re.compile(r"\*\*(.+?)\*\*")
+
+
+def _clean(text):
+    # התשובות באתר מסומנות ב-**; בטלגרם הן נשלחות כטקסט רגיל
+    return " ".join(_MARKDOWN_BOLD.sub(r"\1", text).split())
+
+
+class _SiteFAQParser(HTMLParser):
+    """שולף זוגות שאלה/תשובה מה-HTML של האתר (.faq-question ואחריו .faq-answer)"""
+
+    VOID_TAGS = {"br", "img", "hr", "input", "meta", "link", "wbr"}
+
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+        self._field = None  # "question" / "answer"
+        self._depth = 0     # תגיות פתוחות בתוך השדה הנוכחי
+        self._text = []
+        self._question = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.VOID_TAGS:
+            if tag == "br" and self._field:
+                self._text.append(" ")  # אחרת המילים משני צדי השבירה נדבקות
+            return
+        if self._field:
+            self._depth += 1
+            return
+        classes = (dict(attrs).get("class") or "").split()
+        if "faq-question" in classes:
+            self._field = "question"
+        elif "faq-answer" in classes:
+            self._field = "answer"
+        else:
+            return
+        self._depth = 1
+        self._text = []
+
+    def handle_endtag(self, tag):
+        if not self._field or tag in self.VOID_TAGS:
+            return
+        self._depth -= 1
+        if self._depth:
+            return
+        text = _clean("".join(self._text))
+        if self._field == "question":
+            self._question = text
+        elif self._question and text:
+            self.entries.append(FAQEntry(self._question, text, ()))
+            self._question = None
+        self._field = None
+
+    def handle_data(self, data):
+        if self._field:
+            self._text.append(data)
+
+
+def load_corpus(path):
+    """רשימת FAQEntry מקובץ JSON או HTML"""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".json"):
+        return [
+            FAQEntry(_clean(item["question"]), _clean(item["answer"]), tuple(item.get("alternates", ())))
+            for item in json.loads(content)
+        ]
+    parser = _SiteFAQParser()
+    parser.feed(content)
+    parser.close()
+    return parser.entries
+
+
+def _grams(normalized):
+    grams = Counter()
+    padded = f" {normalized} "
+    for n in NGRAM_SIZES:
+        grams.update(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+class FAQIndex:
+    """
+    מטריצת TF-IDF דלילה: שורה לכל ניסוח של שאלה ושורה לכל תשובה, בפורמט עמודות
+    (indptr / rows / values). השורות מנורמלות, כך שמכפלה עם שאילתה מנורמלת היא דמיון קוסינוס.
+    """
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        row_entry, row_is_question, row_grams = [], [], []
+        for i, entry in enumerate(self.entries):
+            for question in (entry.question, *entry.alternates):
+                row_entry.append(i)
+                row_is_question.append(True)
+                row_grams.append(_grams(normalize(question)))
+            row_entry.append(i)
+            row_is_question.append(False)
+            row_grams.append(_grams(normalize(entry.answer)))
+
+        self.row_entry = np.array(row_entry, dtype=np.int64)
+        self.row_is_question = np.array(row_is_question, dtype=bool)
+        self.rows = len(row_grams)
+
+        self.vocabulary = {}
+        coo_rows, coo_cols, coo_tf = [], [], []
+        for row, grams in enumerate(row_grams):
+            for gram, count in grams.items():
+                coo_rows.append(row)
+                coo_cols.append(self.vocabulary.setdefault(gram, len(self.vocabulary)))
+                coo_tf.append(count)
+        rows = np.array(coo_rows, dtype=np.int64)
+        cols = np.array(coo_cols, dtype=np.int64)
+
+        df = np.bincount(cols, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + self.rows) / (1 + df)) + 1
+        # n-gram שלא מופיע בקורפוס מוריד את הדמיון (נכנס לנורמה של השאילתה) אבל לא תורם למכפלה
+        self.unknown_idf = np.log(1 + self.rows) + 1
+
+        values = (1 + np.log(np.array(coo_tf, dtype=np.float64))) * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=self.rows))
+        values /= norms[rows]
+
+        order = np.argsort(cols, kind="stable")
+        self.post_rows = rows[order]
+        self.post_values = values[order]
+        self.indptr = np.concatenate(([0], np.cumsum(df)))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def scores(self, text):
+        """(דמיון מיטבי לשאלה, דמיון מיטבי לשאלה או לתשובה) לכל רשומה"""
+        question_scores = np.zeros(len(self.entries))
+        passage_scores = np.zeros(len(self.entries))
+        grams = _grams(normalize(text))
+        if not grams or not self.rows:
+            return question_scores, passage_scores
+
+        known = [(self.vocabulary[gram], count) for gram, count in grams.items() if gram in self.vocabulary]
+        unknown = np.array([count for gram, count in grams.items() if gram not in self.vocabulary], dtype=np.float64)
+        if not known:
+            return question_scores, passage_scores
+
+        cols = np.array([col for col, _ in known], dtype=np.int64)
+        weights = (1 + np.log(np.array([count for _, count in known], dtype=np.float64))) * self.idf[cols]
+        norm = np.sqrt(np.sum(weights ** 2) + np.sum(((1 + np.log(unknown)) * self.unknown_idf) ** 2))
+        weights /= norm
+
+        starts, ends = self.indptr[cols], self.indptr[cols + 1]
+        lengths = ends - starts
+        positions = np.repeat(ends - lengths.cumsum(), lengths) + np.arange(lengths.sum())
+        similarity = np.bincount(
+            self.post_rows[positions], weights=self.post_values[positions] * np.repeat(weights, lengths),
+            minlength=self.rows,
+        )
+
+        np.maximum.at(question_scores, self.row_entry[self.row_is_question], similarity[self.row_is_question])
+        np.maximum.at(passage_scores, self.row_entry, similarity)
+        return question_scores, passage_scores
+
+
+class FAQService:
+    def __init__(self, path=None, answer_threshold=FAQ_ANSWER_THRESHOLD, context_threshold=FAQ_CONTEXT_THRESHOLD,
+                 context_passages=FAQ_CONTEXT_PASSAGES, reload_interval=FAQ_RELOAD_INTERVAL):
+        self.path = path or FAQ_CORPUS_PATH or SITE_FAQ_PATH
+        self.answer_threshold = answer_threshold
+        self.context_threshold = context_threshold
+        self.context_passages = context_passages
+        self.reload_interval = reload_interval
+        self.index = FAQIndex([])
+        self._mtime = None
+        self._task = None
+        # מדדים
+        self.queries = 0
+        self.answered = 0
+        self.with_context = 0
+        self.reloads = 0
+        self.reload_errors = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+    async def load(self):
+        """בונה אינדקס מהקורפוס (ב-Thread) ומחליף את הקיים. בכשל נשאר האינדקס הקודם."""
+        try:
+            mtime = os.path.getmtime(self.path)
+            index = FAQIndex(await asyncio.to_thread(load_corpus, self.path))
+        except Exception as e:
+            self.reload_errors += 1
+            logger.error(f"FAQ corpus {self.path} not loaded: {e}")
+            return False
+        self.index = index
+        self._mtime = mtime
+        self.reloads += 1
+        logger.info(f"FAQ index loaded: {len(index)} entries, {len(index.vocabulary)} n-grams from {self.path}")
+        return True
+
+    def start(self):
+        if self._task is None and self.reload_interval > 0:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                changed = os.path.getmtime(self.path) != self._mtime
+            except OSError:
+                continue
+            if changed:
+                await self.load()
+
+    def search(self, text):
+        """
+        FAQMatch: answer - תשובה מוכנה אם השאלה מוכרת (אחרת None);
+        context - הקטעים הרלוונטיים ("ש: ... ת: ...") לצירוף לקריאה ל-LLM.
+        """
+        started = time.perf_counter()
+        self.queries += 1
+        index = self.index
+        try:
+            if not len(index):
+                return FAQMatch(None, 0.0, [])
+            question_scores, passage_scores = index.scores(text)
+            best = int(np.argmax(question_scores))
+            if question_scores[best] >= self.answer_threshold:
+                self.answered += 1
+                return FAQMatch(index.entries[best].answer, float(question_scores[best]), [])
+
+            top = np.argsort(-passage_scores)[:self.context_passages]
+            context = [
+                f"ש: {index.entries[i].question}\nת: {index.entries[i].answer}"
+                for i in top.tolist() if passage_scores[i] >= self.context_threshold
+            ]
+            if context:
+                self.with_context += 1
+            return FAQMatch(None, float(question_scores[best]), context)
+        finally:
+            self.latency.observe(time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            "entries": len(self.index),
+            "queries": self.queries,
+            "answered": self.answered,
+            "deflection_rate": round(self.answered / self.queries, 3) if self.queries else 0.0,
+            "with_context": self.with_context,
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+            "latency": self.latency.snapshot(),
+        }
+
+
+faq_index = FAQService()
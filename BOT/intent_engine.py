@@ -0,0 +1,157 @@
+# קובץ: intent_engine.py
+"""
+סיווג כוונות משתמש לפני/במקום קריאה ל-LLM:
+1. מטמון לפי טקסט מנורמל (LRU).
+2. מסווג מקומי: מילות מפתח + דמיון n-gram תווים לביטויי דוגמה.
+3. רק אם שניהם לא הכריעו - קריאת LLM (שרצה במקביל ליצירת התשובה ב-bot.py).
+"""
+
+import re
+from collections import Counter
+from math import sqrt
+from cache import TTLCache, MISSING
+from config import INTENT_CACHE_MAX_ENTRIES, INTENT_CACHE_TTL, INTENT_FAST_PATH_THRESHOLD, logger
+
+INTENT_PRICE = 'התעניינות במחיר'
+INTENT_SUPPORT = 'בקשת תמיכה'
+INTENT_GENERAL = 'שאלה כללית'
+INTENT_CALLBACK = 'בקשת חזרה טלפונית'
+INTENT_OTHER = 'אחר'
+INTENTS = [INTENT_PRICE, INTENT_SUPPORT, INTENT_GENERAL, INTENT_CALLBACK, INTENT_OTHER]
+
+INTENT_PROMPT = (
+    "סווג את כוונת המשתמש הבאה לקטגוריה אחת בלבד. התשובה שלך תהיה רק שם הקטגוריה: "
+    "'התעניינות במחיר', 'בקשת תמיכה', 'שאלה כללית', 'בקשת חזרה טלפונית', 'אחר'. טקסט: {text}"
+)
+
+# מילות מפתח (אחרי נרמול - בלי אותיות סופיות) שמכריעות לבדן
+KEYWORDS = {
+    INTENT_PRICE: ['מחיר', 'מחירונ', 'כמה עולה', 'כמה זה עולה', 'עלות', 'תמחור', 'הצעת מחיר', 'תשלומ', 'תעריפ',
+                   'price', 'cost', 'pricing'],
+    INTENT_SUPPORT: ['תמיכה', 'תקלה', 'לא עובד', 'לא מצליח', 'שגיאה', 'בעיה', 'נתקע', 'support', 'error', 'bug'],
+    INTENT_CALLBACK: ['תתקשרו', 'להתקשר', 'תחזרו אלי', 'חזרו אלי', 'שיחת טלפונ', 'מספר טלפונ', 'טלפונ', 'call me',
+                      'callback'],
+}
+
+# ביטויי דוגמה לכל קטגוריה - בסיס לדמיון n-gram כשאין מילת מפתח מדויקת
+EXAMPLES = {
+    INTENT_PRICE: ['כמה זה עולה', 'מה המחירים שלכם', 'אפשר לקבל הצעת מחיר', 'מה העלות של קמפיין',
+                   'יש חבילות מחיר'],
+    INTENT_SUPPORT: ['יש לי בעיה', 'משהו לא עובד', 'אני צריך עזרה', 'הקישור לא נפתח', 'לא מצליח להתחבר'],
+    INTENT_CALLBACK: ['תחזרו אליי בבקשה', 'אפשר שיחה', 'תתקשרו אליי', 'אשמח שנציג יחזור אליי',
+                      'הנה המספר שלי'],
+    INTENT_GENERAL: ['מה אתם עושים', 'איך זה עובד', 'מי אתם', 'ספרו לי עוד', 'באילו תחומים אתם עובדים'],
+}
+
+_NIQQUD = re.compile(r'[\u0591-\u05C7]')
+_NON_WORD = re.compile(r'[^\w\s]')
+_SPACES = re.compile(r'\s+')
+_FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+
+
+def normalize(text):
+    """נרמול לצורך מטמון והשוואה: בלי ניקוד, סימני פיסוק ואותיות סופיות"""
+    text = _NIQQUD.sub('', text or '').lower().translate(_FINAL_LETTERS)
+    text = _NON_WORD.sub(' ', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def char_ngrams(text, n=3):
+    padded = f' {text} '
+    return Counter(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def _cosine(a, b):
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    if not dot:
+        return 0.0
+    return dot / (sqrt(sum(v * v for v in a.values())) * sqrt(sum(v * v for v in b.values())))
+
+
+class IntentEngine:
+    def __init__(self, threshold=INTENT_FAST_PATH_THRESHOLD):
+        self.threshold = threshold
+        self.cache = TTLCache(INTENT_CACHE_MAX_ENTRIES, INTENT_CACHE_TTL, name="intent")
+        self._keywords = {intent: [normalize(k) for k in words] for intent, words in KEYWORDS.items()}
+        self._examples = {
+            intent: [char_ngrams(normalize(example)) for example in examples]
+            for intent, examples in EXAMPLES.items()
+        }
+        # מדדים
+        self.requests = 0
+        self.fast_path_hits = 0
+        self.llm_calls = 0
+        self.llm_errors = 0
+
+    def classify_local(self, normalized):
+        """מחזיר קטגוריה אם המסווג המקומי בטוח מספיק, אחרת None"""
+        # התאמת תת-מחרוזת: בעברית אותיות השימוש (ה, ב, ו...) צמודות למילה
+        matched = [intent for intent, keywords in self._keywords.items()
+                   if any(k in normalized for k in keywords)]
+        if len(matched) == 1:
+            return matched[0]
+
+        grams = char_ngrams(normalized)
+        candidates = matched or list(self._examples)
+        best_intent, best_score = None, 0.0
+        for intent in candidates:
+            score = max(_cosine(grams, example) for example in self._examples.get(intent, [Counter()]))
+            if score > best_score:
+                best_intent, best_score = intent, score
+        if best_score >= self.threshold:
+            return best_intent
+        return None
+
+    @staticmethod
+    def parse_llm_label(raw):
+        label = (raw or '').strip().replace("'", "").split('\n')[0]
+        for intent in INTENTS:
+            if intent in label:
+                return intent
+        return INTENT_OTHER
+
+    async def classify(self, text, llm=None):
+        """
+        מסווג הודעה. llm הוא Callable אסינכרוני (prompt -> str); אם None ואין הכרעה מקומית,
+        מוחזרת ברירת המחדל 'שאלה כללית'.
+        """
+        self.requests += 1
+        normalized = normalize(text)
+
+        cached = self.cache.get(normalized)
+        if cached is not MISSING:
+            return cached
+
+        intent = self.classify_local(normalized)
+        if intent is not None:
+            self.fast_path_hits += 1
+            self.cache.set(normalized, intent)
+            return intent
+
+        if llm is None:
+            return INTENT_GENERAL
+
+        self.llm_calls += 1
+        try:
+            intent = self.parse_llm_label(await llm(INTENT_PROMPT.format(text=text)))
+        except Exception as e:
+            self.llm_errors += 1
+            logger.warning(f"AI intent analysis failed: {e}")
+            return INTENT_GENERAL
+        self.cache.set(normalized, intent)
+        return intent
+
+    def stats(self):
+        saved = self.cache.hits + self.fast_path_hits
+        return {
+            "requests": self.requests,
+            "cache": self.cache.stats(),
+            "fast_path_hits": self.fast_path_hits,
+            "fast_path_hit_rate": round(self.fast_path_hits / self.requests, 3) if self.requests else 0.0,
+            "llm_calls": self.llm_calls,
+            "llm_errors": self.llm_errors,
+            "saved_api_calls": saved,
+        }
+
+
+intent_engine = IntentEngine()
@@ -1,59 +1,273 @@
+import time
+from startup import startup  # ראשון - מודד את זמן ה-import-ים של כל השאר
+import asyncio
+import datetime
+import os
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Request, Response, Header
 import uvicorn
 from bot import create_bot_application
-from webhook_handler import process_webhook_update
-from config import WEBHOOK_URL, PORT, logger
-from database import init_db_pool, close_db_pool
+from webhook_handler import update_ingestor
+from cluster import leader_election, shared_rate_limiter, update_inbox
+from config import (WEBHOOK_URL, TELEGRAM_WEBHOOK_SECRET, ANALYTICS_API_KEY, PORT, CLUSTER_MODE, WEB_CONCURRENCY,
+                    FAST_BOOT, logger)
+from database import init_db_pool, close_db_pool, pool_metrics, check_health
 from create_tables import create_tables
+from crm_manager import crm, write_buffer
+from intent_engine import intent_engine
+from ai_service import ai_service
+from faq_index import faq_index
+from static_assets import static_assets
+from conversation_memory import conversation_memory
+from qr_generator import qr_cache
+from scheduler import followup_dispatcher
+from outbound import outbound
+from analytics import analytics
+from partitions import partition_manager
+from scoring import lead_scoring
+from broadcast import broadcasts
+from metrics import registry, MetricsMiddleware
+from tracing import tracer
 
-bot_app = create_bot_application()
+startup.record("imports", time.perf_counter() - startup.started)
+
+# נבנה ב-start_bot ולא ב-import: ה-import נשאר זול, ו-/telegram מחזיר 503 עד שהבוט קיים
+bot_app = None
+
+# במצב Cluster כל תהליך קולט עדכונים דרך update_inbox המשותפת
+ingestor = update_inbox if CLUSTER_MODE else update_ingestor
+
+_background = set()
+
+async def ensure_webhook():
+    """
+    רושם את ה-Webhook רק אם הכתובת השתנתה, או אם טלגרם דיווח לאחרונה על שגיאת מסירה
+    (למשל TELEGRAM_WEBHOOK_SECRET שהוחלף). בהפעלה מחדש רגילה זו קריאה אחת ל-getWebhookInfo.
+    """
+    webhook_path = f"{WEBHOOK_URL}/telegram"
+    info = await bot_app.bot.get_webhook_info()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    recent_error = info.last_error_date and now - info.last_error_date < datetime.timedelta(minutes=10)
+    if info.url == webhook_path and not recent_error:
+        logger.info(f"Webhook already set: {webhook_path}")
+        return
+    logger.info(f"Setting webhook: {webhook_path}")
+    await bot_app.bot.set_webhook(url=webhook_path, secret_token=TELEGRAM_WEBHOOK_SECRET)
+
+async def start_leader_duties():
+    """משימות שרצות בתהליך אחד בלבד: Webhook, Follow-ups, המשך שידורים שנעצרו, אנליטיקה, ניקוד לידים, מחיצות ותחזוקת התיבה המשותפת"""
+    followup_dispatcher.start(bot_app.bot)
+    broadcasts.start_resumer()
+    analytics.start()
+    lead_scoring.start()
+    partition_manager.start()
+    if CLUSTER_MODE:
+        update_inbox.start_maintenance()
+        # בלי Cluster ה-Webhook נבדק כבר באתחול, במקביל ל-DB
+        await ensure_webhook()
+
+async def stop_leader_duties():
+    await followup_dispatcher.stop()
+    await broadcasts.stop_resumer()
+    await analytics.stop()
+    await lead_scoring.stop()
+    await partition_manager.stop()
+    await update_inbox.stop_maintenance()
+
+async def start_database():
+    # המיגרציות רצות רק כשהסכמה לא עדכנית
+    await startup.step("db_pool", init_db_pool())
+    await startup.step("schema", create_tables())
+    write_buffer.start()
+
+async def start_bot():
+    global bot_app
+    started = time.perf_counter()
+    bot_app = create_bot_application()
+    startup.record("bot_build", time.perf_counter() - started)
+    await startup.step("bot_init", bot_app.initialize())
+    await startup.step("bot_start", bot_app.start())
+    outbound.start(bot_app.bot)
+    broadcasts.start(bot_app.bot)
+    if not CLUSTER_MODE:
+        await startup.step("webhook", ensure_webhook())
+
+async def start_faq():
+    await startup.step("faq_index", faq_index.load())
+    faq_index.start()
+
+async def run_startup():
+    """אתחול כל הרכיבים. ה-DB, ה-Bot, אינדקס ה-FAQ ודף הנחיתה לא תלויים זה בזה ועולים במקביל."""
+    try:
+        await asyncio.gather(start_database(), start_bot(), start_faq(), startup.step("static_assets", static_assets.load()))
+
+        # קליטת העדכונים ומשימות תקופתיות (scheduled_jobs ב-DB) - במצב Cluster רק אצל המנהיג
+        if CLUSTER_MODE:
+            await startup.step("ingestor", update_inbox.start(bot_app))
+            leader_election.start(on_elected=start_leader_duties, on_demoted=stop_leader_duties)
+        else:
+            update_ingestor.start(bot_app)
+            await startup.step("leader_duties", start_leader_duties())
+    except Exception as e:
+        startup.fail(e)
+        raise
+    startup.finish()
+
+    # ספריות ה-AI נטענות ב-Thread אחרי שהשרת כבר מוכן
+    task = asyncio.create_task(ai_service.preload())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """פונקציית Lifecycle שמטפלת באתחול וסגירת משאבים"""
     logger.info("Starting up...")
-    
-    # 1. חיבור ואיחול DB
-    await init_db_pool()
-    await create_tables()
-    
-    # 2. הפעלת הבוט וה-JobQueue
-    await bot_app.initialize()
-    await bot_app.start()
-    await bot_app.job_queue.start() # מפעיל את מנגנון התזמון
-    
-    # 3. הגדרת Webhook
-    webhook_path = f"{WEBHOOK_URL}/telegram"
-    logger.info(f"Setting webhook: {webhook_path}")
-    await bot_app.bot.set_webhook(url=webhook_path)
+    startup_task = None
+    if FAST_BOOT:
+        # השרת מקבל בקשות מיד (/health עונה), ו-/ready ו-/telegram מחכים לסיום האתחול ברקע
+        startup_task = asyncio.create_task(run_startup())
+    else:
+        await run_startup()
     
     yield
     
     # --- Shutdown ---
     logger.info("Shutting down...")
-    await bot_app.job_queue.stop()
-    await bot_app.stop()
-    await bot_app.shutdown()
+    if startup_task and not startup_task.done():
+        startup_task.cancel()
+    if startup_task:
+        await asyncio.gather(startup_task, return_exceptions=True)
+    if CLUSTER_MODE:
+        await leader_election.stop()  # משחרר את ההנהגה לתהליך אחר
+    await ingestor.stop()  # מסיים לעבד עדכונים שכבר אושרו לטלגרם
+    await stop_leader_duties()
+    await broadcasts.stop()  # שידורים שרצים חוזרים לתור וממשיכים מה-Checkpoint בתהליך הבא
+    await outbound.stop()  # Digest אחרון והודעות שעדיין בתור
+    if bot_app is not None:
+        if bot_app.running:
+            await bot_app.stop()
+        await bot_app.shutdown()
+    await ai_service.close()
+    await faq_index.stop()
+    qr_cache.close()
+    await write_buffer.stop()  # ריקון כתיבות ממתינות לפני סגירת ה-Pool
     await close_db_pool()
     
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+def cluster_stats():
+    return {
+        "enabled": CLUSTER_MODE,
+        "pid": os.getpid(),
+        "leader": leader_election.stats(),
+        "rate_limiter": shared_rate_limiter.stats(),
+    }
 
-@app.get("/")
+# stats() של כל רכיב - מוחזר כ-JSON ב-/stats ונחשף כ-Gauges ב-/metrics
+COMPONENT_STATS = {
+    "db": pool_metrics,
+    "write_behind": write_buffer.stats,
+    "crm_cache": crm.cache_stats,
+    "intent": intent_engine.stats,
+    "faq": faq_index.stats,
+    "ai": ai_service.stats,
+    "conversation_memory": conversation_memory.stats,
+    "qr_cache": qr_cache.stats,
+    "followups": followup_dispatcher.stats,
+    "broadcasts": broadcasts.stats,
+    "outbound": outbound.stats,
+    "analytics": analytics.stats,
+    "scoring": lead_scoring.stats,
+    "partitions": partition_manager.stats,
+    "ingest": ingestor.stats,
+    "tracing": tracer.stats,
+    "static": static_assets.stats,
+    "startup": startup.report,
+    "cluster": cluster_stats,
+}
+for component, collect in COMPONENT_STATS.items():
+    registry.register_stats(component, collect)
+
+@app.get("/health")
 async def health_check():
+    """Liveness: התהליך חי (גם לפני שהאתחול הסתיים)"""
     return {"status": "ok", "system": "Eliezer Advanced CRM AI"}
 
+@app.get("/ready")
+async def readiness():
+    """Readiness: האתחול הסתיים וה-DB עונה. 503 עד אז - לבדיקת ה-Healthcheck של הפריסה."""
+    if not startup.ready:
+        return Response(status_code=503, content=f"starting: {', '.join(sorted(startup.running)) or startup.error or '...'}")
+    db = await check_health()
+    if not db["ok"]:
+        return Response(status_code=503, content=f"database: {db['error']}")
+    return {"status": "ready", "db_latency_ms": db["latency_ms"], "startup_ms": startup.total_ms}
+
+@app.get("/startup")
+async def startup_profile():
+    """זמני העלייה: import-ים, כל שלב באתחול והזמן הכולל עד מוכנות"""
+    return startup.report()
+
+@app.get("/stats")
+async def stats():
+    """מדדים פנימיים של רכיבי הביצועים"""
+    return {component: collect() for component, collect in COMPONENT_STATS.items()}
+
+@app.get("/metrics")
+async def metrics():
+    """מדדים בפורמט Prometheus (לכל תהליך בנפרד במצב Cluster)"""
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/traces")
+async def traces():
+    """העדכונים האיטיים האחרונים מבין אלה שנדגמו, עם פירוק הזמן ל-DB / AI / טלגרם / QR"""
+    return {"stats": tracer.stats(), "slow": tracer.recent()}
+
+@app.get("/analytics")
+async def analytics_report(days: int = 30, campaign: str = None, x_api_key: str = Header(None)):
+    """דוח אנליטיקה (JSON) - דורש כותרת X-API-Key. עם campaign מוחזרת גם סדרה יומית."""
+    if not ANALYTICS_API_KEY or x_api_key != ANALYTICS_API_KEY:
+        return Response(status_code=403)
+    report = await analytics.report(days=days)
+    if campaign:
+        report["daily"] = await analytics.daily(campaign, days=days)
+    return report
+
 @app.post("/telegram")
 async def telegram_webhook(request: Request):
-    """הנתיב שאליו טלגרם שולח עדכונים"""
+    """הנתיב שאליו טלגרם שולח עדכונים - מאשר מיד והעיבוד מתבצע ברקע"""
+    if TELEGRAM_WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != TELEGRAM_WEBHOOK_SECRET:
+        return Response(status_code=403)
+    if bot_app is None or not startup.ready:
+        # האתחול עוד רץ - טלגרם ישלח שוב
+        return Response(status_code=503)
     try:
         body = await request.json()
-        await process_webhook_update(bot_app, body)
-        return Response(status_code=200)
     except Exception as e:
         logger.error(f"Webhook Error: {e}")
-        return Response(status_code=500)
+        return Response(status_code=400)
+
+    status = await ingestor.submit(body)
+    if status == "invalid":
+        return Response(status_code=400)
+    if status == "dropped":
+        # התור מלא (או ה-DB לא זמין במצב Cluster) - טלגרם ינסה שוב מאוחר יותר
+        return Response(status_code=503)
+    return Response(status_code=200)
+
+# אחרון - כל נתיב GET שלא נתפס למעלה מחפש קובץ של דף הנחיתה
+@app.api_route("/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def landing_site(path: str, request: Request):
+    """דף הנחיתה מהזיכרון: דחוס מראש, עם ETag ו-304"""
+    if not static_assets.loaded:
+        return Response(status_code=503)
+    result = static_assets.serve(f"/{path}", request.headers.get("accept-encoding"), request.headers.get("if-none-match"))
+    if result is None:
+        return Response(status_code=404)
+    status, headers, body = result
+    return Response(body, status_code=status, headers=headers)
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=PORT)
+    uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=WEB_CONCURRENCY)
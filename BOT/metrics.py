@@ -0,0 +1,284 @@
+# קובץ: metrics.py
+"""
+מדדים בזיכרון התהליך, בלי תלויות חיצוניות.
+- Histogram / Counter / Gauge, ומשפחות עם תוויות (labels) ב-Registry אחד.
+- timed: דקורטור שמודד זמן, שגיאות ובקשות בתהליך לכל פעולה (וגם Span אם העדכון נדגם ל-tracing).
+- render: פורמט הטקסט של Prometheus עבור GET /metrics, כולל כל מילוני stats() של הרכיבים.
+המדידה עצמה היא שני perf_counter ו-bisect, כך שאפשר להשאיר אותה פעילה בפרודקשן.
+"""
+
+import asyncio
+import functools
+import math
+import re
+import time
+from bisect import bisect_left
+from tracing import tracer
+
+# גבולות ברירת מחדל בשניות - מתאים גם לזמני DB וגם לקריאות AI
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """היסטוגרמה מצטברת בגבולות קבועים: זיכרון קבוע, observe ב-O(מספר הגבולות)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # האחרון = +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.counts[bisect_left(self.buckets, value)] += 1
+
+    def quantile(self, q):
+        """הערכת אחוזון לפי הגבול העליון של התא שבו הוא נופל"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5) * 1000,
+            "p95_ms": self.quantile(0.95) * 1000,
+            "p99_ms": self.quantile(0.99) * 1000,
+        }
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class MetricFamily:
+    """מדד עם תוויות: labels(...) יוצר את המדד לכל צירוף ערכים בפעם הראשונה ומחזיר אותו"""
+
+    def __init__(self, name, documentation, kind, labelnames=(), factory=None):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = factory or {"counter": Counter, "gauge": Gauge, "histogram": Histogram}[kind]
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._factory()
+        return child
+
+    def samples(self):
+        """(סיומת, תוויות, ערך) לכל שורה בפורמט Prometheus"""
+        for values, child in self._children.items():
+            labels = dict(zip(self.labelnames, values))
+            if self.kind != "histogram":
+                yield "", labels, child.value
+                continue
+            cumulative = 0
+            for bound, count in zip(child.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield "_bucket", dict(labels, le=_format_value(bound)), cumulative
+            yield "_sum", labels, child.sum
+            yield "_count", labels, child.count
+
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _metric_name(*parts):
+    return _NAME_RE.sub("_", "_".join(parts)).lower()
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _flatten(prefix, value):
+    """מילון stats() מקונן -> זוגות (שם, ערך) מספריים"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(f"{prefix}_{key}", item)
+    elif isinstance(value, (bool, int, float)) and not (isinstance(value, float) and math.isnan(value)):
+        yield _metric_name(prefix), float(value)
+
+
+class Registry:
+    def __init__(self, namespace="eliezer"):
+        self.namespace = namespace
+        self._families = {}
+        self._collectors = {}  # רכיב -> פונקציית stats()
+
+    def _family(self, name, documentation, kind, labelnames, factory=None):
+        name = f"{self.namespace}_{name}"
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = MetricFamily(name, documentation, kind, labelnames, factory)
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "counter", labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "gauge", labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._family(name, documentation, "histogram", labelnames, lambda: Histogram(buckets))
+
+    def register_stats(self, component, collect):
+        """חשיפת stats() של רכיב קיים כ-Gauges (eliezer_<רכיב>_<מפתח>) בלי לשנות את הרכיב"""
+        self._collectors[component] = collect
+
+    def render(self):
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for suffix, labels, value in family.samples():
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{family.name}{suffix}{{{label_text}}} {_format_value(value)}" if label_text
+                             else f"{family.name}{suffix} {_format_value(value)}")
+        for component, collect in self._collectors.items():
+            try:
+                values = collect()
+            except Exception as e:
+                lines.append(f"# {component} stats failed: {e}")
+                continue
+            for name, value in _flatten(f"{self.namespace}_{component}", values):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+OPERATION_SECONDS = registry.histogram("operation_seconds", "Latency of instrumented operations",
+                                       ("component", "operation"))
+OPERATION_ERRORS = registry.counter("operation_errors_total", "Instrumented operations that raised",
+                                    ("component", "operation"))
+OPERATION_IN_FLIGHT = registry.gauge("operation_in_flight", "Instrumented operations currently running",
+                                     ("component", "operation"))
+
+
+def timed(component, operation, span=None):
+    """
+    מודד פונקציה (async או רגילה): זמן ריצה, שגיאות ובקשות בתהליך לפי component/operation.
+    span - קטגוריה לפירוק הזמן בעדכון שנדגם (db / ai / telegram / qr).
+    """
+    def decorator(fn):
+        seconds = OPERATION_SECONDS.labels(component, operation)
+        errors = OPERATION_ERRORS.labels(component, operation)
+        in_flight = OPERATION_IN_FLIGHT.labels(component, operation)
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                in_flight.value += 1
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    errors.value += 1
+                    raise
+                finally:
+                    elapsed = time.perf_counter() - started
+                    in_flight.value -= 1
+                    seconds.observe(elapsed)
+                    if span:
+                        tracer.add(span, elapsed)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                in_flight.value += 1
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    errors.value += 1
+                    raise
+                finally:
+                    elapsed = time.perf_counter() - started
+                    in_flight.value -= 1
+                    seconds.observe(elapsed)
+                    if span:
+                        tracer.add(span, elapsed)
+        return wrapper
+    return decorator
+
+
+HTTP_REQUESTS = registry.counter("http_requests_total", "HTTP requests", ("method", "route", "status"))
+HTTP_SECONDS = registry.histogram("http_request_seconds", "HTTP request latency", ("method", "route"))
+HTTP_IN_FLIGHT = registry.gauge("http_requests_in_flight", "HTTP requests currently being served")
+
+
+class MetricsMiddleware:
+    """
+    Middleware ב-ASGI ישיר (בלי BaseHTTPMiddleware, שמוסיף Task לכל בקשה).
+    התווית route היא תבנית הנתיב של FastAPI ולא ה-URL עצמו, כדי לא לפוצץ את מספר הסדרות.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight = HTTP_IN_FLIGHT.labels()
+        in_flight.value += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.value -= 1
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_SECONDS.labels(scope["method"], route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(scope["method"], route, status).inc()
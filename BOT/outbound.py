@@ -0,0 +1,293 @@
+# קובץ: outbound.py
+"""
+שכבת שליחה אחת לכל ההודעות היוצאות לטלגרם.
+- תור לכל צ'אט (הסדר נשמר) עם Token Bucket: צ'אט פרטי ~1 לשנייה, קבוצה ~20 לדקה.
+- תקרה גלובלית לכל הבוט (TELEGRAM_GLOBAL_RATE); במצב Cluster היא משותפת דרך PostgreSQL.
+- 429 (RetryAfter): ממתינים בדיוק את הזמן שטלגרם ביקש ושולחים שוב, במקום לזרוק את ההודעה.
+- לידים חדשים לקבוצת הלוגים מאוחדים להודעת Digest אחת לכל חלון זמן.
+- לא רק הודעות טקסט: call() מעביר כל מתודת Bot API לצ'אט (תמונות, קבצים, עריכת הודעות) באותו תור.
+  פטורים רק answer_callback_query ו-send_chat_action - הם לא הודעות בצ'אט ולא נספרים במגבלה.
+"""
+
+import asyncio
+import time
+from collections import Counter, deque
+from telegram.error import NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+from cache import TTLCache, MISSING
+from cluster import shared_rate_limiter
+from metrics import Histogram, registry
+from tracing import tracer
+from config import (OUTBOUND_PRIVATE_RATE, OUTBOUND_PRIVATE_BURST, OUTBOUND_GROUP_PER_MINUTE, OUTBOUND_GROUP_BURST,
+                    OUTBOUND_MAX_RETRIES, OUTBOUND_MAX_CHATS, LOG_DIGEST_WINDOW, TELEGRAM_GLOBAL_RATE,
+                    CLUSTER_MODE, INGEST_DRAIN_TIMEOUT, LOG_GROUP_ID, logger)
+
+
+# שניות בלי שליחה שאחריהן דלי נשכח (כבר התמלא מחדש)
+BUCKET_IDLE_TTL = 60
+
+
+def is_group(chat_id):
+    # מזהי קבוצות וערוצים בטלגרם שליליים
+    return str(chat_id).startswith("-")
+
+
+def _seconds(retry_after):
+    # בגרסאות חדשות של python-telegram-bot זה timedelta
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+TELEGRAM_API_SECONDS = registry.histogram("telegram_api_seconds", "Bot API call latency", ("method",))
+TELEGRAM_API_ERRORS = registry.counter("telegram_api_errors_total", "Bot API calls that raised", ("method",))
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """שכבת ה-HTTP של python-telegram-bot עם זמן לכל מתודת Bot API (וזמן "telegram" ב-Trace)"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            TELEGRAM_API_ERRORS.labels(api_method).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_API_SECONDS.labels(api_method).observe(elapsed)
+            tracer.add("telegram", elapsed)
+
+
+class TokenBucket:
+    """דלי אסימונים בשיטת הזמנה: reserve מחזיר כמה שניות להמתין לפני השליחה"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate) - 1
+        self.updated_at = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def pause(self, seconds):
+        """אחרי 429 - אף הודעה לצ'אט לא יוצאת לפני שעבר הזמן שטלגרם ביקש"""
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class LeadDigest:
+    """איסוף לידים לקבוצת הלוגים: הראשון בחלון שקט נשלח מיד, השאר מאוחדים לסיכום בסוף החלון"""
+
+    __slots__ = ("items", "last_sent", "timer")
+
+    def __init__(self):
+        self.items = []  # (campaign, detail)
+        self.last_sent = float("-inf")
+        self.timer = None
+
+
+class OutboundSender:
+    def __init__(self, max_retries=OUTBOUND_MAX_RETRIES, digest_window=LOG_DIGEST_WINDOW):
+        self.max_retries = max_retries
+        self.digest_window = digest_window
+        self._bot = None
+        self._queues = {}   # chat_id -> deque של (method, kwargs, future, enqueued_at)
+        self._workers = {}  # chat_id -> Task שמרוקן את התור של הצ'אט
+        # דלי שלא נגעו בו דקה כבר מלא ממילא, אז אפשר לשכוח אותו - אלא אם טלגרם ביקש המתנה ארוכה יותר
+        # (RetryAfter), ואז ה-TTL גדל כדי שההשהיה לא תישכח לפני שהיא נגמרת (ראה _deliver)
+        self._buckets = TTLCache(OUTBOUND_MAX_CHATS, BUCKET_IDLE_TTL, name="outbound_buckets")
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._digests = {}
+        # מדדים
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.digests = 0
+        self.digested_leads = 0
+        self.send_latency = Histogram()
+        self.queue_age = Histogram()
+
+    def start(self, bot):
+        self._bot = bot
+
+    async def stop(self, drain_timeout=INGEST_DRAIN_TIMEOUT):
+        """שולח את ה-Digest הממתינים וממתין לריקון התורים"""
+        for chat_id, digest in list(self._digests.items()):
+            if digest.timer:
+                digest.timer.cancel()
+                digest.timer = None
+            if digest.items:
+                self._flush_digest(chat_id)
+        workers = list(self._workers.values())
+        if workers:
+            _, still_running = await asyncio.wait(workers, timeout=drain_timeout)
+            if still_running:
+                logger.warning(f"Outbound stopped with {self.queue_depth()} messages still queued.")
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is MISSING:
+            if is_group(chat_id):
+                bucket = TokenBucket(OUTBOUND_GROUP_PER_MINUTE / 60, OUTBOUND_GROUP_BURST)
+            else:
+                bucket = TokenBucket(OUTBOUND_PRIVATE_RATE, OUTBOUND_PRIVATE_BURST)
+        # כל שימוש מאריך את התפוגה: דלי נשכח רק אחרי ttl בלי שליחות
+        self._buckets.set(chat_id, bucket)
+        return bucket
+
+    def _enqueue(self, chat_id, method, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id, queue))
+        queue.append((method, kwargs, future, time.perf_counter()))
+        return future
+
+    async def send(self, chat_id, text, **kwargs):
+        """שליחה דרך התור של הצ'אט. מחזיר את ה-Message, או זורק את השגיאה הסופית (למשל Forbidden)."""
+        return await self.call(chat_id, "send_message", text=text, **kwargs)
+
+    async def call(self, chat_id, method, **kwargs):
+        """
+        כל מתודת Bot API שפונה לצ'אט (send_photo, send_document, edit_message_text...) דרך התור שלו.
+        קבצים צריכים להגיע כ-bytes / file_id / InputFile כדי שניסיון חוזר ישלח אותם שוב במלואם.
+        """
+        # ב-Trace נזקף כל הזמן עד המסירה, כולל ההמתנה ל-Rate Limit
+        with tracer.span("telegram"):
+            return await self._enqueue(chat_id, method, kwargs)
+
+    def post(self, chat_id, text, **kwargs):
+        """שליחה בלי להמתין לתוצאה - שגיאות נרשמות ללוג"""
+        def log_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(f"Failed to send to {chat_id}: {future.exception()}")
+
+        self._enqueue(chat_id, "send_message", dict(kwargs, text=text)).add_done_callback(log_failure)
+
+    async def _drain(self, chat_id, queue):
+        # ה-Worker משרת הודעות של עדכונים רבים - לא שייך ל-Trace של העדכון שיצר אותו
+        tracer.detach()
+        try:
+            while queue:
+                method, kwargs, future, enqueued_at = queue[0]
+                try:
+                    await asyncio.sleep(self._bucket(chat_id).reserve())
+                    if CLUSTER_MODE:
+                        await shared_rate_limiter.acquire("telegram:global", TELEGRAM_GLOBAL_RATE)
+                    else:
+                        await asyncio.sleep(self._global.reserve())
+                    self.queue_age.observe(time.perf_counter() - enqueued_at)
+                    result = await self._deliver(chat_id, method, kwargs)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                queue.popleft()
+        finally:
+            for _, _, future, _ in queue:
+                future.cancel()
+            del self._queues[chat_id]
+            del self._workers[chat_id]
+
+    async def _deliver(self, chat_id, method, kwargs):
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                message = await getattr(self._bot, method)(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                self.rate_limited += 1
+                delay = _seconds(e.retry_after)
+                # ה-TTL חייב להיות ארוך מההשהיה הארוכה ביותר שנראתה, אחרת הדלי נשכח ונוצר מחדש מלא
+                self._buckets.ttl = max(self._buckets.ttl, delay + BUCKET_IDLE_TTL)
+                self._bucket(chat_id).pause(delay)
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Flood control for {chat_id}: retrying in {delay}s")
+            except TimedOut:
+                # ייתכן שההודעה כבר נמסרה - לא שולחים שוב כדי לא לשכפל
+                raise
+            except NetworkError:
+                if attempt >= self.max_retries:
+                    raise
+                delay = 2 ** attempt
+            else:
+                self.send_latency.observe(time.perf_counter() - started)
+                self.sent += 1
+                return message
+            attempt += 1
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    # --- Digest לקבוצת הלוגים ---
+
+    def log_lead(self, campaign, detail, chat_id=LOG_GROUP_ID):
+        if not chat_id:
+            return
+        digest = self._digests.get(chat_id)
+        if digest is None:
+            digest = self._digests[chat_id] = LeadDigest()
+
+        now = time.monotonic()
+        if digest.timer is None and now - digest.last_sent >= self.digest_window:
+            digest.last_sent = now
+            self.post(chat_id, detail, parse_mode='Markdown')
+            return
+
+        digest.items.append((campaign, detail))
+        if digest.timer is None:
+            delay = max(0.0, digest.last_sent + self.digest_window - now)
+            digest.timer = asyncio.get_running_loop().call_later(delay, self._flush_digest, chat_id)
+
+    def _flush_digest(self, chat_id):
+        digest = self._digests[chat_id]
+        items, digest.items, digest.timer = digest.items, [], None
+        digest.last_sent = time.monotonic()
+        if len(items) == 1:
+            self.post(chat_id, items[0][1], parse_mode='Markdown')
+            return
+
+        by_campaign = Counter(campaign for campaign, _ in items)
+        breakdown = ", ".join(f"{campaign}: {count}" for campaign, count in by_campaign.most_common())
+        text = (f"🔔 **{len(items)} לידים חדשים ב-{int(self.digest_window)} השניות האחרונות**\n"
+                f"לפי קמפיין: {breakdown}")
+        self.digests += 1
+        self.digested_leads += len(items)
+        self.post(chat_id, text, parse_mode='Markdown')
+
+    def queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "active_chats": len(self._queues),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "bucket_ttl": self._buckets.ttl,
+            "digests": self.digests,
+            "digested_leads": self.digested_leads,
+            "pending_digest_leads": sum(len(d.items) for d in self._digests.values()),
+            "send_latency": self.send_latency.snapshot(),
+            "queue_age": self.queue_age.snapshot(),
+        }
+
+
+outbound = OutboundSender()
@@ -0,0 +1,304 @@
+# קובץ: partitions.py
+"""
+ניהול המחיצות החודשיות של crm_leads (ראה מיגרציה 7 ב-create_tables.py).
+- העברת השורות מהטבלה שלפני החלוקה (crm_leads_legacy) ב-Batches לפי id, כל Batch בטרנזקציה משלו,
+  כך שההעברה לא מעכבת את העלייה וממשיכה מאותה נקודה אחרי הפעלה מחדש. בסוף הטבלה הישנה נמחקת.
+- יצירה מראש של מחיצות לחודשים הבאים, והעברת שורות שנפלו למחיצת ה-DEFAULT למחיצה משלהן.
+- Retention: מחיצות ישנות מ-CRM_LEADS_RETENTION_MONTHS נשמרות כ-CSV דחוס (אם הוגדרה תיקיית ארכיון
+  על אחסון קבוע - CRM_LEADS_ARCHIVE_DURABLE) ואז מנותקות ונמחקות - DROP של מחיצה שלמה במקום DELETE ו-VACUUM על טבלה ענקית.
+
+הרצה ידנית:
+    python partitions.py status
+    python partitions.py maintain
+    python partitions.py migrate    # העברת הטבלה הישנה עד הסוף, בלי לחכות למנהיג
+"""
+
+import asyncio
+import datetime
+import gzip
+import os
+import re
+import sys
+import time
+from database import init_db_pool, get_db_pool, close_db_pool, logger
+from config import (CRM_LEADS_PARTITIONS_AHEAD, CRM_LEADS_RETENTION_MONTHS, CRM_LEADS_ARCHIVE_DIR, CRM_LEADS_ARCHIVE_DURABLE,
+                    PARTITION_MAINTENANCE_INTERVAL, CRM_LEADS_LEGACY_BATCH_SIZE, CRM_LEADS_LEGACY_PAUSE)
+
+PARENT_TABLE = "crm_leads"
+DEFAULT_PARTITION = "crm_leads_default"
+LEGACY_TABLE = "crm_leads_legacy"
+ARCHIVE_WRITE_CHUNK = 1024 * 1024
+PARTITION_RE = re.compile(r"^crm_leads_p(\d{4})(\d{2})$")
+
+# מפתח ל-Advisory Lock כדי שרק תהליך אחד יעביר את הטבלה הישנה בכל רגע
+LEGACY_LOCK_KEY = 0xC7A1E6
+
+# $1 = גודל ה-Batch. השורות נמחקות מהטבלה הישנה ונכנסות לחדשה באותה פקודה, לפי סדר id.
+MOVE_LEGACY_SQL = f"""
+    WITH moved AS (
+        DELETE FROM {LEGACY_TABLE}
+        WHERE id IN (SELECT id FROM {LEGACY_TABLE} ORDER BY id LIMIT $1)
+        RETURNING id, user_id, message_content, intent_type, source, created_at
+    )
+    INSERT INTO {PARENT_TABLE} (id, user_id, message_content, intent_type, source, created_at)
+    SELECT id, user_id, message_content, intent_type, source, COALESCE(created_at, LOCALTIMESTAMP) FROM moved
+"""
+
+LIST_PARTITIONS_SQL = """
+    SELECT c.relname AS name, c.reltuples::bigint AS rows_estimate, pg_total_relation_size(c.oid) AS bytes
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'crm_leads'::regclass
+    ORDER BY c.relname
+"""
+
+
+def month_start(value):
+    return datetime.date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"crm_leads_p{month:%Y%m}"
+
+
+def partition_month(name):
+    match = PARTITION_RE.match(name)
+    return datetime.date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+async def list_partitions(conn):
+    return [dict(row, month=partition_month(row["name"])) for row in await conn.fetch(LIST_PARTITIONS_SQL)]
+
+
+async def create_partition(conn, month):
+    """
+    יוצר מחיצה לחודש. שורות של אותו חודש שכבר נמצאות ב-DEFAULT מועברות אליה באותה טרנזקציה,
+    אחרת ATTACH ייכשל על התנגשות טווחים.
+    """
+    name, start, end = partition_name(month), month, add_months(month, 1)
+    async with conn.transaction():
+        await conn.execute(f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS)")
+        moved = await conn.execute(f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= $1 AND created_at < $2 RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """, start, end)
+        await conn.execute(
+            f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+    rows = int(moved.split()[-1])
+    logger.info(f"Created partition {name}" + (f" (moved {rows} rows from default)" if rows else ""))
+    return name
+
+
+async def ensure_partitions(conn, months_ahead=CRM_LEADS_PARTITIONS_AHEAD):
+    """מחיצות לחודש הנוכחי ול-months_ahead הבאים, ולכל חודש שיש לו שורות ב-DEFAULT"""
+    existing = {p["month"] for p in await list_partitions(conn) if p["month"]}
+    current = month_start(datetime.date.today())
+    wanted = {add_months(current, i) for i in range(months_ahead + 1)}
+    stray = await conn.fetch(f"SELECT DISTINCT date_trunc('month', created_at)::date AS month FROM {DEFAULT_PARTITION}")
+    wanted.update(row["month"] for row in stray)
+
+    created = []
+    for month in sorted(wanted - existing):
+        created.append(await create_partition(conn, month))
+    return created
+
+
+async def move_legacy_batch(conn, batch_size=CRM_LEADS_LEGACY_BATCH_SIZE):
+    """
+    מעביר עד batch_size שורות מהטבלה הישנה. מחזיר כמה הועברו (0 אם תהליך אחר מעביר כרגע),
+    או None אם אין טבלה ישנה. כשהיא מתרוקנת היא נמחקת.
+    """
+    async with conn.transaction():
+        if await conn.fetchval("SELECT to_regclass($1)", LEGACY_TABLE) is None:
+            return None
+        if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", LEGACY_LOCK_KEY):
+            return 0
+        moved = int((await conn.execute(MOVE_LEGACY_SQL, batch_size)).split()[-1])
+        if not moved:
+            await conn.execute(f"DROP TABLE {LEGACY_TABLE}")
+            logger.info(f"{LEGACY_TABLE} is empty - dropped.")
+    return moved
+
+
+async def migrate_legacy(conn, batch_size=CRM_LEADS_LEGACY_BATCH_SIZE, pause=CRM_LEADS_LEGACY_PAUSE):
+    """מעביר את כל הטבלה הישנה, Batch אחרי Batch. מחזיר את מספר השורות שהועברו."""
+    total = 0
+    while True:
+        moved = await move_legacy_batch(conn, batch_size)
+        if not moved:
+            break
+        total += moved
+        await asyncio.sleep(pause)
+    if total:
+        logger.info(f"Moved {total} rows from {LEGACY_TABLE} into partitions.")
+    return total
+
+
+async def high_water_mark(conn):
+    """
+    ה-id המקסימלי לעיבוד מצטבר לפי id (analytics, scoring). כל עוד הטבלה הישנה לא הועברה עד הסוף,
+    ה-id שלה נמוכים מכל שורה חדשה - הגבול נעצר לפני השורה הראשונה שעוד לא הועברה, כדי לא לדלג עליה.
+    """
+    upper = await conn.fetchval(f"SELECT COALESCE(MAX(id), 0) FROM {PARENT_TABLE}")
+    if await conn.fetchval("SELECT to_regclass($1)", LEGACY_TABLE) is not None:
+        pending = await conn.fetchval(f"SELECT MIN(id) FROM {LEGACY_TABLE}")
+        if pending is not None:
+            upper = min(upper, pending - 1)
+    return upper
+
+
+async def archive_partition(conn, name, archive_dir):
+    """
+    COPY של המחיצה ל-CSV דחוס. הקובץ נכתב לשם זמני ומוחלף רק כשהוא שלם.
+    הדחיסה והכתיבה לדיסק רצות ב-Thread, ב-Chunks של ARCHIVE_WRITE_CHUNK, כדי לא לעצור את ה-Event loop של המנהיג.
+    """
+    await asyncio.to_thread(os.makedirs, archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    tmp_path = f"{path}.tmp"
+    sink = await asyncio.to_thread(gzip.open, tmp_path, "wb")
+    pending = bytearray()
+
+    async def write_pending():
+        data = bytes(pending)
+        pending.clear()
+        await asyncio.to_thread(sink.write, data)
+
+    async def write_chunk(chunk):
+        pending.extend(chunk)
+        if len(pending) >= ARCHIVE_WRITE_CHUNK:
+            await write_pending()
+
+    try:
+        status = await conn.copy_from_table(name, output=write_chunk, format="csv", header=True)
+        await write_pending()
+        await asyncio.to_thread(sink.close)
+    except BaseException:
+        await asyncio.to_thread(sink.close)
+        await asyncio.to_thread(os.remove, tmp_path)
+        raise
+    await asyncio.to_thread(os.replace, tmp_path, path)
+    return path, int(status.split()[-1])
+
+
+async def apply_retention(conn, retention_months=CRM_LEADS_RETENTION_MONTHS, archive_dir=CRM_LEADS_ARCHIVE_DIR,
+                          archive_durable=CRM_LEADS_ARCHIVE_DURABLE):
+    """
+    מוחק (ומארכב) מחיצות של חודשים ישנים מ-retention_months. 0 = שומרים הכל.
+    עם תיקיית ארכיון מוחקים רק אם סומן שהיא על אחסון קבוע (archive_durable).
+    """
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(datetime.date.today()), -retention_months)
+
+    if archive_dir and not archive_durable:
+        # ארכיון על דיסק זמני (למשל Railway בלי Volume) נמחק בפריסה הבאה - לא מוחקים את המקור
+        logger.warning(f"Retention skipped: {archive_dir} is not marked durable (CRM_LEADS_ARCHIVE_DURABLE)")
+        return []
+
+    dropped = []
+    for partition in await list_partitions(conn):
+        month = partition["month"]
+        if month is None or month >= cutoff:
+            continue
+        name = partition["name"]
+        if archive_dir:
+            path, rows = await archive_partition(conn, name, archive_dir)
+            logger.info(f"Archived partition {name} ({rows} rows) to {path}")
+        async with conn.transaction():
+            await conn.execute(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}")
+            await conn.execute(f"DROP TABLE {name}")
+        logger.info(f"Dropped partition {name}")
+        dropped.append(name)
+    return dropped
+
+
+class PartitionManager:
+    """תחזוקה תקופתית (רק אצל המנהיג): העברת הטבלה הישנה, יצירת מחיצות קדימה ו-Retention"""
+
+    def __init__(self, interval=PARTITION_MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._task = None
+        # מדדים
+        self.legacy_moved = 0
+        self.created = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_run_ms = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Partition maintenance failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        pool = await get_db_pool()
+        if not pool: return
+
+        started = time.perf_counter()
+        async with pool.acquire() as conn:
+            # קודם ההעברה - שורות ישנות מחוץ לטווח נוחתות ב-DEFAULT ו-ensure_partitions מסדר אותן
+            self.legacy_moved += await migrate_legacy(conn)
+            self.created += len(await ensure_partitions(conn))
+            self.dropped += len(await apply_retention(conn))
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+
+    def stats(self):
+        return {
+            "legacy_moved": self.legacy_moved,
+            "created": self.created,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "last_run_ms": round(self.last_run_ms, 1),
+        }
+
+
+partition_manager = PartitionManager()
+
+
+async def _main(argv):
+    await init_db_pool()
+    pool = await get_db_pool()
+    if not pool:
+        return 1
+    try:
+        if argv[1:] == ["maintain"]:
+            await partition_manager.run_once()
+        async with pool.acquire() as conn:
+            if argv[1:] == ["migrate"]:
+                await migrate_legacy(conn, pause=0)
+            legacy_rows = await conn.fetchval("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass($1)", LEGACY_TABLE)
+            if legacy_rows is not None:
+                print(f"{LEGACY_TABLE:<24} ~{max(legacy_rows, 0):>12} rows left to move")
+            for partition in await list_partitions(conn):
+                print(f"{partition['name']:<24} ~{partition['rows_estimate']:>12} rows  {partition['bytes'] / 1024 / 1024:10.1f} MB")
+    finally:
+        await close_db_pool()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))
@@ -1,19 +1,31 @@
-import qrcode
+import asyncio
+import hashlib
 import io
-from config import logger
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache, MISSING
+from metrics import timed
+from tracing import tracer
+from config import QR_CACHE_DIR, QR_CACHE_MAX_BYTES, QR_CACHE_DISK_MAX_BYTES, QR_RENDER_WORKERS, logger
 
-def generate_user_qr(bot_username, user_id, campaign_source=None):
-    """יוצר תמונת QR עם לינק אישי להפניה (Referral)"""
-    
+# משתנה כשמשנים פרמטרים של הציור - מבטל את כל המטמון הקיים
+QR_RENDER_VERSION = "v1-box10-border5"
+# ניקוי הדיסק מוריד עד לחלק הזה מהתקרה, כדי לא לנקות שוב אחרי כל ציור
+DISK_SWEEP_TARGET = 0.9
+
+def build_referral_link(bot_username, user_id, campaign_source=None):
     # ה-Payload שיירשם ב-?start=
     payload = str(user_id)
     if campaign_source:
-         # מאפשר מעקב קמפיינים עם referral
+        # מאפשר מעקב קמפיינים עם referral
         payload = f"{campaign_source}_{user_id}"
+    return f"https://t.me/{bot_username}?start={payload}"
 
-    link = f"https://t.me/{bot_username}?start={payload}"
-    logger.info(f"Generating QR for link: {link}")
-    
+@timed("qr", "render")
+def render_qr_png(link):
+    """מצייר QR ומחזיר PNG כ-bytes. עבודת CPU - רצה ב-Executor ולא ב-Event Loop."""
+    import qrcode  # import עצל: qrcode ו-PIL נטענים רק בציור הראשון (ב-Thread), לא בעליית השרת
     qr = qrcode.QRCode(
         version=1,
         box_size=10,
@@ -21,11 +33,235 @@ def generate_user_qr(bot_username, user_id, campaign_source=None):
     )
     qr.add_data(link)
     qr.make(fit=True)
-    
+
     img = qr.make_image(fill='black', back_color='white')
-    
+
     # המרת התמונה ל-Bytes בזיכרון
     bio = io.BytesIO()
     img.save(bio, 'PNG')
+    return bio.getvalue()
+
+def generate_user_qr(bot_username, user_id, campaign_source=None):
+    """יוצר תמונת QR עם לינק אישי להפניה (Referral) - גרסה סינכרונית ללא מטמון"""
+    link = build_referral_link(bot_username, user_id, campaign_source)
+    logger.info(f"Generating QR for link: {link}")
+    bio = io.BytesIO(render_qr_png(link))
     bio.seek(0)
     return bio
+
+
+class QRCache:
+    """
+    מטמון QR לפי תוכן: LRU בזיכרון (חסום בבתים) ← קבצים בדיסק ← ציור ב-Worker.
+    שומר גם את ה-file_id שטלגרם מחזיר, כך שבקשה חוזרת לא שולחת בכלל את התמונה.
+    גם הדיסק חסום (disk_max_bytes): קריאה מעדכנת את ה-mtime, וכשעוברים את התקרה נמחקים הקבצים הישנים ביותר.
+    """
+
+    def __init__(self, cache_dir=QR_CACHE_DIR, max_bytes=QR_CACHE_MAX_BYTES, workers=QR_RENDER_WORKERS,
+                 disk_max_bytes=QR_CACHE_DISK_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._disk_bytes = None       # None = עוד לא נסרק; מתעדכן בכל כתיבה ובכל ניקוי
+        self._sweeping = False
+        self._memory = OrderedDict()  # key -> png bytes
+        self._memory_bytes = 0
+        self._file_ids = TTLCache(100_000, 0, name="qr_file_id")
+        self._inflight = {}           # key -> Future של ציור שכבר רץ
+        self._tasks = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qr")
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        # מדדים
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+        self.disk_evictions = 0
+        self.warm_skipped = 0
+
+    @staticmethod
+    def cache_key(link):
+        return hashlib.sha256(f"{QR_RENDER_VERSION}|{link}".encode()).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, f"{key}.{suffix}")
+
+    def _remember_png(self, key, png):
+        if key in self._memory:
+            return
+        self._memory[key] = png
+        self._memory_bytes += len(png)
+        while self._memory_bytes > self.max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _load_or_render(self, key, link):
+        """רץ ב-Executor: קריאה מהדיסק, ואם אין - ציור ושמירה"""
+        if self.cache_dir:
+            path = self._path(key, "png")
+            try:
+                with open(path, "rb") as f:
+                    png = f.read()
+                os.utime(path)  # LRU: הניקוי מוחק לפי mtime
+                return png, True
+            except FileNotFoundError:
+                pass
+        png = render_qr_png(link)
+        if self.cache_dir:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(png)
+        return png, False
+
+    def _sweep(self):
+        """רץ ב-Executor: סכום הקבצים בתיקייה, ומחיקת הישנים ביותר (לפי mtime) כשעוברים את disk_max_bytes"""
+        try:
+            files, total = [], 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".tmp"):
+                    continue  # נכתב כרגע
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+                total += stat.st_size
+            if total > self.disk_max_bytes:
+                target = self.disk_max_bytes * DISK_SWEEP_TARGET
+                for _, path, size in sorted(files):
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    self.disk_evictions += 1
+            self._disk_bytes = total
+        except Exception as e:
+            logger.warning(f"QR disk cache sweep failed: {e}")
+        finally:
+            self._sweeping = False
+
+    def _maybe_sweep(self):
+        if not self.cache_dir or self._sweeping:
+            return
+        if self._disk_bytes is None or self._disk_bytes > self.disk_max_bytes:
+            self._sweeping = True
+            self.executor.submit(self._sweep)
+
+    def _load_file_id(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key, "fid"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _store_file_id(self, key, file_id):
+        with open(self._path(key, "fid"), "w", encoding="utf-8") as f:
+            f.write(file_id)
+
+    @timed("qr", "get_png", span="qr")
+    async def get_png(self, link):
+        key = self.cache_key(link)
+        png = self._memory.get(key)
+        if png is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return key, png
+
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, self._load_or_render, key, link)
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._loaded(key, link, done))
+        # shield: ביטול של ממתין אחד לא מבטל את הציור המשותף לכל הממתינים על אותו מפתח
+        png, _ = await asyncio.shield(future)
+        return key, png
+
+    def _loaded(self, key, link, future):
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        png, from_disk = future.result()
+        if from_disk:
+            self.disk_hits += 1
+        else:
+            self.renders += 1
+            logger.info(f"Rendered QR for link: {link}")
+            self._maybe_sweep()
+        self._remember_png(key, png)
+
+    async def get_photo(self, bot_username, user_id, campaign_source=None):
+        """
+        מחזיר (photo, key): photo הוא file_id של טלגרם אם כבר נשלח בעבר, אחרת BytesIO של PNG.
+        אחרי שליחה יש לקרוא ל-remember_file_id עם ה-file_id שהתקבל.
+        """
+        link = build_referral_link(bot_username, user_id, campaign_source)
+        key = self.cache_key(link)
+
+        file_id = self._file_ids.get(key)
+        if file_id is MISSING:
+            loop = asyncio.get_running_loop()
+            file_id = await loop.run_in_executor(self.executor, self._load_file_id, key)
+            if file_id:
+                self._file_ids.set(key, file_id)
+        if file_id:
+            return file_id, key
+
+        key, png = await self.get_png(link)
+        bio = io.BytesIO(png)
+        bio.name = "qr.png"
+        return bio, key
+
+    def remember_file_id(self, key, file_id):
+        if not file_id or self._file_ids.get(key) == file_id:
+            return
+        self._file_ids.set(key, file_id)
+        if self.cache_dir:
+            self.executor.submit(self._store_file_id, key, file_id)
+
+    def warm(self, bot_username, user_id, campaign_source=None):
+        """
+        יצירה מוקדמת ברקע (למשל ב-/start) כדי שהלחיצה על 'צור QR' תהיה מיידית.
+        רק כשה-Workers פנויים: בגל הרשמות לא מציירים (וכותבים לדיסק) QR לכל מי שאולי לא יבקש אותו.
+        """
+        if self._inflight:
+            self.warm_skipped += 1
+            return
+        link = build_referral_link(bot_username, user_id, campaign_source)
+        task = asyncio.create_task(self._warm(link))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm(self, link):
+        tracer.detach()
+        try:
+            await self.get_png(link)
+        except Exception as e:
+            logger.warning(f"QR pre-generation failed for {link}: {e}")
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "renders": self.renders,
+            "disk_bytes": self._disk_bytes,
+            "disk_evictions": self.disk_evictions,
+            "warm_skipped": self.warm_skipped,
+            "file_ids": self._file_ids.stats(),
+        }
+
+
+qr_cache = QRCache()
@@ -0,0 +1,173 @@
+# קובץ: referral_tree.py
+"""
+עץ הפניות ממומש (Closure Table).
+כל הפניה חדשה מוסיפה שורות referral_closure לכל זוג (אב, צאצא) ומעדכנת מונים
+לכל אב קדמון, כך שגודל הרשת, פילוח לפי דורות וטבלת המובילים הם שליפה אחת באינדקס.
+
+המילוי הראשוני מטבלת users רץ במיגרציה 2 (create_tables.py). בנייה מחדש ידנית (למשל אחרי תיקון referred_by):
+    python referral_tree.py backfill
+"""
+
+import asyncio
+import sys
+from database import init_db_pool, get_db_pool, close_db_pool, hot_statement, logger
+from config import REFERRAL_MAX_DEPTH
+
+# מפתח ל-Advisory Locks של העץ: (KEY) משותף לכל הפניה ובלעדי ל-backfill, ו-(KEY, שורש) לכל עץ בנפרד
+REFERRAL_LOCK_KEY = 0x5EF7EE
+
+# האב הקדמון העליון של המשתמש (או המשתמש עצמו אם אין לו מפנה)
+ROOT_SQL = """
+    SELECT COALESCE(
+        (SELECT ancestor_id FROM referral_closure WHERE descendant_id = $1 ORDER BY depth DESC LIMIT 1),
+        $1::bigint
+    )
+"""
+
+# $1 = המפנה, $2 = המשתמש החדש.
+# כל האבות של המפנה (כולל המפנה עצמו) x המשתמש החדש וכל הצאצאים שכבר נרשמו תחתיו.
+# המונים מחושבים מהשורות שנוספו בפועל באותה פקודה.
+RECORD_REFERRAL_SQL = """
+    WITH new_rows AS (
+        INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+        FROM (
+            SELECT ancestor_id, depth FROM referral_closure WHERE descendant_id = $1
+            UNION ALL SELECT $1::bigint, 0
+        ) a
+        CROSS JOIN (
+            SELECT descendant_id, depth FROM referral_closure WHERE ancestor_id = $2
+            UNION ALL SELECT $2::bigint, 0
+        ) d
+        ON CONFLICT DO NOTHING
+        RETURNING ancestor_id, depth
+    ), per_depth AS (
+        INSERT INTO referral_depth_counts (user_id, depth, users)
+        SELECT ancestor_id, depth, COUNT(*) FROM new_rows GROUP BY ancestor_id, depth
+        ON CONFLICT (user_id, depth) DO UPDATE
+        SET users = referral_depth_counts.users + EXCLUDED.users
+    )
+    INSERT INTO referral_counts (user_id, direct_count, downline_count)
+    SELECT ancestor_id, COUNT(*) FILTER (WHERE depth = 1), COUNT(*) FROM new_rows GROUP BY ancestor_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET direct_count = referral_counts.direct_count + EXCLUDED.direct_count,
+        downline_count = referral_counts.downline_count + EXCLUDED.downline_count
+"""
+
+BACKFILL_CLOSURE_SQL = """
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    WITH RECURSIVE chain AS (
+        SELECT referred_by AS ancestor_id, user_id AS descendant_id, 1 AS depth
+        FROM users
+        WHERE referred_by IS NOT NULL AND referred_by <> user_id
+        UNION ALL
+        SELECT u.referred_by, c.descendant_id, c.depth + 1
+        FROM chain c
+        JOIN users u ON u.user_id = c.ancestor_id
+        WHERE u.referred_by IS NOT NULL AND u.referred_by <> u.user_id AND c.depth < $1
+    )
+    SELECT ancestor_id, descendant_id, MIN(depth)
+    FROM chain
+    WHERE ancestor_id <> descendant_id
+    GROUP BY ancestor_id, descendant_id
+"""
+
+BACKFILL_COUNTS_SQL = [
+    """
+    INSERT INTO referral_counts (user_id, direct_count, downline_count)
+    SELECT ancestor_id, COUNT(*) FILTER (WHERE depth = 1), COUNT(*)
+    FROM referral_closure GROUP BY ancestor_id
+    """,
+    """
+    INSERT INTO referral_depth_counts (user_id, depth, users)
+    SELECT ancestor_id, depth, COUNT(*)
+    FROM referral_closure GROUP BY ancestor_id, depth
+    """,
+]
+
+
+async def lock_trees(conn, *user_ids):
+    """
+    נועל (עד סוף הטרנזקציה) את העצים שהמשתמשים שייכים אליהם, לפי השורש של כל עץ.
+    הפניות בעצים שונים לא ממתינות זו לזו. אם עץ חובר מתחת לעץ אחר בזמן ההמתנה השורש משתנה,
+    ולכן בודקים שוב ונועלים גם את השורש החדש.
+    """
+    await conn.execute("SELECT pg_advisory_xact_lock_shared($1)", REFERRAL_LOCK_KEY)
+    locked = set()
+    while True:
+        roots = {await conn.fetchval(ROOT_SQL, user_id) for user_id in user_ids}
+        missing = sorted(roots - locked)
+        if not missing:
+            return
+        for root in missing:
+            await conn.execute("SELECT pg_advisory_xact_lock($1, hashtext($2::bigint::text))", REFERRAL_LOCK_KEY, root)
+            locked.add(root)
+
+
+async def record_referral(conn, user_id, referrer_id):
+    """מעדכן את העץ עבור משתמש חדש. יש לקרוא בתוך הטרנזקציה של הוספת המשתמש."""
+    if referrer_id is None or referrer_id == user_id:
+        return
+    await lock_trees(conn, referrer_id, user_id)
+    # מניעת מעגל: המפנה כבר רשום מתחת למשתמש הזה
+    if await conn.fetchval(
+        "SELECT 1 FROM referral_closure WHERE ancestor_id = $1 AND descendant_id = $2", user_id, referrer_id
+    ):
+        logger.warning(f"Referral cycle ignored: {referrer_id} is already under {user_id}")
+        return
+    await conn.execute(RECORD_REFERRAL_SQL, referrer_id, user_id)
+
+
+# שאילתות חמות (Prepared על כל חיבור ב-Pool)
+DIRECT_COUNT = hot_statement("referral_direct_count", "SELECT direct_count FROM referral_counts WHERE user_id = $1")
+DOWNLINE_COUNT = hot_statement("referral_downline_count", "SELECT downline_count FROM referral_counts WHERE user_id = $1")
+
+
+async def get_depth_counts(conn, user_id):
+    """מחזיר {עומק: מספר משתמשים} עבור הרשת של המשתמש"""
+    rows = await conn.fetch(
+        "SELECT depth, users FROM referral_depth_counts WHERE user_id = $1 ORDER BY depth", user_id
+    )
+    return {row["depth"]: row["users"] for row in rows}
+
+
+async def get_top_referrers(conn, limit=10):
+    return await conn.fetch("""
+        SELECT user_id, direct_count, downline_count
+        FROM referral_counts
+        ORDER BY downline_count DESC
+        LIMIT $1
+    """, limit)
+
+
+async def backfill(conn, max_depth=REFERRAL_MAX_DEPTH):
+    """בונה מחדש את כל טבלאות העץ מתוך users.referred_by"""
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", REFERRAL_LOCK_KEY)
+        await conn.execute("TRUNCATE referral_closure, referral_counts, referral_depth_counts")
+        await conn.execute(BACKFILL_CLOSURE_SQL, max_depth)
+        for statement in BACKFILL_COUNTS_SQL:
+            await conn.execute(statement)
+    rows = await conn.fetchval("SELECT COUNT(*) FROM referral_closure")
+    logger.info(f"Referral closure backfilled: {rows} rows.")
+    return rows
+
+
+async def _main(argv):
+    if argv[1:] != ["backfill"]:
+        print(__doc__)
+        return 1
+    await init_db_pool()
+    pool = await get_db_pool()
+    if not pool:
+        return 1
+    try:
+        async with pool.acquire() as conn:
+            await backfill(conn)
+    finally:
+        await close_db_pool()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))
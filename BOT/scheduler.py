@@ -0,0 +1,215 @@
+# קובץ: scheduler.py
+"""
+תזמון הודעות Follow-up מבוסס DB (טבלת scheduled_jobs) במקום JobQueue בזיכרון.
+- שורד Deploy/Restart: המשימות שמורות ב-PostgreSQL.
+- ללא כפילויות: אינדקס ייחודי על (sequence, user_id, step) למשימות שעוד לא נשלחו (pending / running),
+  כך ש-/start חוזר לא מוסיף משימות. אחרי שהשלב נשלח (או בוטל), /start חוזר רושם אותו מחדש.
+- מספר Replicas: כל Dispatcher תופס Batch עם FOR UPDATE SKIP LOCKED.
+- רצפי Drip: כל רצף הוא רשימת שלבים עם השהיה ביחס להרשמה.
+"""
+
+import asyncio
+import datetime
+import time
+from collections import deque, namedtuple
+from telegram.error import Forbidden
+from database import get_db_pool, logger
+from crm_manager import crm, MARK_BLOCKED_SQL
+from outbound import outbound
+from config import (SCHEDULER_POLL_INTERVAL, SCHEDULER_BATCH_SIZE, SCHEDULER_SEND_CONCURRENCY,
+                    SCHEDULER_MAX_ATTEMPTS, SCHEDULER_LOCK_TIMEOUT)
+
+DripStep = namedtuple("DripStep", ["delay", "text", "score_points"])
+
+DRIP_SEQUENCES = {
+    "followup": [
+        DripStep(
+            datetime.timedelta(hours=24),
+            "👋 היי שוב! רציתי לוודא שקיבלת את כל המידע שאתה צריך. יש שאלה ספציפית שתרצה לשאול?",
+            1,
+        ),
+    ],
+}
+
+CLAIM_SQL = """
+    UPDATE scheduled_jobs AS j
+    SET status = 'running', locked_at = LOCALTIMESTAMP, attempts = j.attempts + 1
+    FROM (
+        SELECT id FROM scheduled_jobs
+        WHERE status = 'pending' AND run_at <= LOCALTIMESTAMP
+        ORDER BY run_at
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ) AS due
+    WHERE j.id = due.id
+    RETURNING j.id, j.user_id, j.sequence, j.step, j.attempts,
+              EXTRACT(EPOCH FROM LOCALTIMESTAMP - j.run_at)::float8 AS lag_s
+"""
+
+# משימות שנתפסו ע"י תהליך שקרס באמצע השליחה חוזרות לתור
+RECLAIM_SQL = """
+    UPDATE scheduled_jobs SET status = 'pending', locked_at = NULL
+    WHERE status = 'running' AND locked_at < LOCALTIMESTAMP - make_interval(secs => $1)
+"""
+
+
+async def enroll(user_id, sequence="followup"):
+    """
+    רושם משתמש לרצף. כל עוד שלב ממתין לשליחה, קריאה חוזרת לא יוצרת כפילות;
+    שלב שכבר נשלח נרשם מחדש (משתמש שחזר מקבל שוב Follow-up).
+    """
+    steps = DRIP_SEQUENCES[sequence]
+    pool = await get_db_pool()
+    if not pool: return
+
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute("""
+                INSERT INTO scheduled_jobs (user_id, sequence, step, run_at)
+                SELECT $1, $2, s.step, LOCALTIMESTAMP + make_interval(secs => s.delay)
+                FROM unnest($3::int[], $4::float8[]) AS s(step, delay)
+                ON CONFLICT (sequence, user_id, step) WHERE status IN ('pending', 'running') DO NOTHING
+            """, user_id, sequence, list(range(len(steps))), [step.delay.total_seconds() for step in steps])
+        except Exception as e:
+            logger.error(f"DB Error enroll {user_id} in {sequence}: {e}")
+
+
+class FollowupDispatcher:
+    def __init__(self, poll_interval=SCHEDULER_POLL_INTERVAL, batch_size=SCHEDULER_BATCH_SIZE,
+                 concurrency=SCHEDULER_SEND_CONCURRENCY, max_attempts=SCHEDULER_MAX_ATTEMPTS,
+                 lock_timeout=SCHEDULER_LOCK_TIMEOUT):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lock_timeout = lock_timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bot = None
+        self._task = None
+        self._last_reclaim = 0.0
+        # מדדים
+        self.sent = 0
+        self.failed = 0
+        self.cancelled = 0
+        self._recent_sends = deque()  # זמני שליחה בדקה האחרונה
+        self.last_lag_s = 0.0
+
+    def start(self, bot):
+        if self._task is None:
+            self._bot = bot
+            self._task = asyncio.create_task(self._run())
+            logger.info("Follow-up dispatcher started.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.dispatch_once()
+            except Exception as e:
+                logger.error(f"Follow-up dispatcher error: {e}")
+                processed = 0
+            # Batch מלא = כנראה יש עוד משימות שהגיע זמנן, ממשיכים מיד
+            if processed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    async def dispatch_once(self):
+        pool = await get_db_pool()
+        if not pool: return 0
+
+        async with pool.acquire() as conn:
+            if time.monotonic() - self._last_reclaim > self.lock_timeout:
+                await conn.execute(RECLAIM_SQL, self.lock_timeout)
+                self._last_reclaim = time.monotonic()
+            jobs = await conn.fetch(CLAIM_SQL, self.batch_size)
+        if not jobs:
+            return 0
+
+        self.last_lag_s = max(job["lag_s"] for job in jobs)
+        results = await asyncio.gather(*(self._send(job) for job in jobs))
+
+        done = [job["id"] for job, result in zip(jobs, results) if result == "done"]
+        retry = [job["id"] for job, result in zip(jobs, results) if result == "retry"]
+        failed = [job["id"] for job, result in zip(jobs, results) if result == "failed"]
+        blocked = [(job["user_id"], job["sequence"]) for job, result in zip(jobs, results) if result == "blocked"]
+
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if done:
+                    await conn.execute(
+                        "UPDATE scheduled_jobs SET status = 'done', locked_at = NULL WHERE id = ANY($1::bigint[])", done
+                    )
+                if retry:
+                    # Backoff לינארי לפי מספר הניסיונות
+                    await conn.execute("""
+                        UPDATE scheduled_jobs
+                        SET status = 'pending', locked_at = NULL,
+                            run_at = LOCALTIMESTAMP + make_interval(mins => attempts * 5)
+                        WHERE id = ANY($1::bigint[])
+                    """, retry)
+                if failed:
+                    await conn.execute(
+                        "UPDATE scheduled_jobs SET status = 'failed', locked_at = NULL WHERE id = ANY($1::bigint[])", failed
+                    )
+                for user_id, sequence in blocked:
+                    # המשתמש חסם את הבוט - מבטלים את כל שאר הרצף
+                    await conn.execute("""
+                        UPDATE scheduled_jobs SET status = 'cancelled', locked_at = NULL
+                        WHERE user_id = $1 AND sequence = $2 AND status IN ('pending', 'running')
+                    """, user_id, sequence)
+                if blocked:
+                    # לא נכללים בשידורים הבאים (broadcast.py)
+                    await conn.execute(MARK_BLOCKED_SQL, [user_id for user_id, _ in blocked])
+        return len(jobs)
+
+    async def _send(self, job):
+        step = DRIP_SEQUENCES.get(job["sequence"], [])[job["step"]:job["step"] + 1]
+        if not step:
+            logger.warning(f"Unknown drip step {job['sequence']}#{job['step']} - marking failed")
+            self.failed += 1
+            return "failed"
+
+        user_id = job["user_id"]
+        async with self._semaphore:
+            try:
+                # Rate Limit ו-Retry על 429 מטופלים בשכבת השליחה
+                await outbound.send(user_id, step[0].text)
+            except Forbidden:
+                self.cancelled += 1
+                return "blocked"
+            except Exception as e:
+                logger.warning(f"Failed to send followup to {user_id}: {e}")
+                if job["attempts"] >= self.max_attempts:
+                    self.failed += 1
+                    return "failed"
+                return "retry"
+
+        if step[0].score_points:
+            await crm.update_lead_score(user_id, step[0].score_points)
+        self.sent += 1
+        self._recent_sends.append(time.monotonic())
+        return "done"
+
+    def sends_per_minute(self):
+        cutoff = time.monotonic() - 60
+        while self._recent_sends and self._recent_sends[0] < cutoff:
+            self._recent_sends.popleft()
+        return len(self._recent_sends)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "sends_per_minute": self.sends_per_minute(),
+            "last_lag_s": round(self.last_lag_s, 1),
+        }
+
+
+followup_dispatcher = FollowupDispatcher()
@@ -0,0 +1,410 @@
+# קובץ: scoring.py
+"""
+ניקוד לידים מחושב מהאירועים ב-crm_leads (מקור וכוונה) ומפעילות ההפניות, עם דעיכה מעריכית בזמן.
+- לכל משתמש נשמר ניקוד גולמי score_raw נכון ל-score_as_of. אירוע חדש מוסיף weight * 2^(-גיל/זמן מחצית),
+  והניקוד הקיים דועך עד עכשיו - כך שאין צורך לקרוא שוב את כל ההיסטוריה.
+- Job מצטבר (רק אצל המנהיג): אירועים חדשים לפי High-water mark על id (כמו analytics.py), והמפנים
+  של משתמשים שנרשמו מאז הריצה הקודמת. אחת ל-SCORING_DECAY_INTERVAL - מעבר דעיכה על כל המשתמשים.
+- החישוב וקטורי (NumPy על עמודות שנשלפו), והכתיבה היא UPDATE אחד עם unnest לכל Batch,
+  כולל עדכון התפלגות הניקוד של האנליטיקה.
+- lead_score (1-10) = 1 + 9 * (1 - e^(-raw / SCORING_SCALE)), כאשר raw כולל log(1 + הפניות).
+update_lead_score נשאר משוב מיידי בין הריצות; ה-Job הוא מקור האמת ודורס אותו.
+- השלמת היסטוריה (אחרי המיגרציה או rebuild, כל עוד decayed_at ריק): האירועים נצברים ל-score_raw בלבד,
+  ה-lead_score הקיים לא נוגע ומעבר ההפניות מדולג. כשה-Job מגיע לגבול הבטוח, מעבר דעיכה אחד מחליף
+  את הניקוד של כל המשתמשים בבת אחת - בלי תקופה שבה מוצג ניקוד חלקי.
+
+הרצה ידנית - חישוב מחדש מכל ההיסטוריה (אחרי שינוי משקלים), או מעבר דעיכה מיידי:
+    python scoring.py rebuild
+    python scoring.py decay
+"""
+
+import asyncio
+import json
+import sys
+import time
+import numpy as np
+from database import init_db_pool, get_db_pool, close_db_pool, logger
+from partitions import high_water_mark
+from analytics import score_update_sql
+from crm_manager import running_stats, score_cache, MAX_LEAD_SCORE
+from intent_engine import INTENT_PRICE, INTENT_SUPPORT, INTENT_GENERAL, INTENT_CALLBACK
+from config import (SCORING_INTERVAL, SCORING_BATCH_SIZE, SCORING_HALF_LIFE_DAYS, SCORING_SCALE,
+                    SCORING_DECAY_INTERVAL, SCORING_WEIGHTS)
+
+SCORING_LOCK_KEY = 0x5C0FE
+# הרשמות שנכנסו בטרנזקציה ארוכה עם created_at מוקדם - נסרקות שוב (חישוב ההפניות אידמפוטנטי)
+SIGNUP_OVERLAP = 300
+
+# נקודות לכל אירוע לפי crm_leads.source
+DEFAULT_SOURCE_WEIGHTS = {
+    "user_msg": 1.0,
+    "qr_request": 2.0,
+    "support_request": 4.0,
+}
+
+# תוספת לפי הכוונה שסווגה להודעה (intent_engine)
+DEFAULT_INTENT_WEIGHTS = {
+    INTENT_CALLBACK: 3.0,
+    INTENT_PRICE: 2.0,
+    INTENT_SUPPORT: 1.0,
+    INTENT_GENERAL: 0.5,
+}
+
+# מוכפל ב-log(1 + מספר ההפניות), כך שמפנה גדול לא מגיע לתקרה רק מהפניות
+DEFAULT_REFERRAL_WEIGHTS = {
+    "direct": 2.0,
+    "downline": 0.5,
+}
+
+# $1, $2 = טווח id, $3 = עכשיו, $4 = המקורות שיש להם משקל
+EVENTS_SQL = """
+    SELECT user_id, source, COALESCE(intent_type, '') AS intent_type,
+           EXTRACT(EPOCH FROM $3::timestamp - created_at)::float8 / 86400 AS age_days
+    FROM crm_leads
+    WHERE id > $1 AND id <= $2 AND user_id IS NOT NULL AND source = ANY($4::text[])
+"""
+
+# כל האבות (כל הדורות) של משתמשים שנרשמו מאז $1
+REFERRERS_SQL = """
+    SELECT DISTINCT c.ancestor_id
+    FROM users u JOIN referral_closure c ON c.descendant_id = u.user_id
+    WHERE u.created_at > $1::timestamp - make_interval(secs => $2)
+"""
+
+USER_STATE_COLUMNS = """
+    SELECT u.user_id, u.score_raw,
+           EXTRACT(EPOCH FROM $2::timestamp - COALESCE(u.score_as_of, $2::timestamp))::float8 / 86400 AS age_days,
+           COALESCE(u.lead_score, 1) AS lead_score,
+           COALESCE(r.direct_count, 0) AS direct_count, COALESCE(r.downline_count, 0) AS downline_count
+    FROM users u LEFT JOIN referral_counts r ON r.user_id = u.user_id
+"""
+
+USER_STATE_BY_IDS_SQL = USER_STATE_COLUMNS + " WHERE u.user_id = ANY($1::bigint[])"
+
+# דף משתמשים למעבר הדעיכה (Keyset לפי user_id)
+USER_STATE_PAGE_SQL = USER_STATE_COLUMNS + " WHERE u.user_id > $1 ORDER BY u.user_id LIMIT $3"
+
+# כתיבת הניקוד המחושב ב-Round-trip אחד, כולל העברת המשתמשים בין תאי התפלגות הניקוד (כמו FLUSH_SCORES_SQL).
+# מחזיר את סך השינוי ב-lead_score לטובת הסיכומים הרצים.
+APPLY_SCORES_SQL = score_update_sql("""
+    s AS (
+        SELECT * FROM unnest($1::bigint[], $2::float8[], $3::int[]) AS t(user_id, score_raw, score)
+    ), old AS (
+        SELECT u.user_id, COALESCE(u.lead_score, 1) AS lead_score FROM users u JOIN s USING (user_id) FOR UPDATE OF u
+    ), upd AS (
+        UPDATE users AS u
+        SET score_raw = s.score_raw, score_as_of = $4, lead_score = s.score
+        FROM s JOIN old o USING (user_id)
+        WHERE u.user_id = s.user_id
+        RETURNING COALESCE(u.campaign_source, 'direct') AS campaign, o.lead_score AS old_score, u.lead_score AS new_score
+    )
+""")
+
+REBUILD_SQL = [
+    "UPDATE users SET score_raw = 0, score_as_of = NULL WHERE score_raw <> 0 OR score_as_of IS NOT NULL",
+    "UPDATE scoring_state SET last_id = 0, signups_at = '-infinity', decayed_at = NULL WHERE name = 'default'",
+]
+
+
+class ScoringWeights:
+    """משקלי המודל. SCORING_WEIGHTS (JSON) דורס חלק מהם: {"sources": {...}, "intents": {...}, "referrals": {...}}"""
+
+    def __init__(self, sources=None, intents=None, referrals=None):
+        self.sources = {**DEFAULT_SOURCE_WEIGHTS, **(sources or {})}
+        self.intents = {**DEFAULT_INTENT_WEIGHTS, **(intents or {})}
+        self.referrals = {**DEFAULT_REFERRAL_WEIGHTS, **(referrals or {})}
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(**json.loads(text)) if text else cls()
+
+    def scored_sources(self):
+        """רק מקורות עם משקל נשלפים מ-crm_leads (למשל לא ai_reply)"""
+        return [source for source, weight in self.sources.items() if weight]
+
+    def event_points(self, sources, intents):
+        return _lookup(sources, self.sources) + _lookup(intents, self.intents)
+
+    def as_dict(self):
+        return {"sources": self.sources, "intents": self.intents, "referrals": self.referrals}
+
+
+def _lookup(values, table):
+    """מיפוי וקטורי של מחרוזות למשקלים: פעם אחת לכל ערך שונה ולא לכל שורה"""
+    keys, inverse = np.unique(values, return_inverse=True)
+    return np.array([table.get(key, 0.0) for key in keys], dtype=np.float64)[inverse]
+
+
+def decay(age_days, half_life_days):
+    return np.exp2(-np.maximum(age_days, 0.0) / half_life_days)
+
+
+def sum_by_user(user_ids, values):
+    """(user_ids ממוינים וייחודיים, סכום values לכל אחד)"""
+    users, index = np.unique(user_ids, return_inverse=True)
+    return users, np.bincount(index, weights=values, minlength=len(users))
+
+
+def to_lead_score(raw, direct, downline, weights, scale):
+    total = (raw + weights.referrals["direct"] * np.log1p(direct)
+             + weights.referrals["downline"] * np.log1p(downline))
+    score = 1 + np.rint((MAX_LEAD_SCORE - 1) * -np.expm1(-np.maximum(total, 0.0) / scale))
+    return score.astype(np.int32)
+
+
+def _columns(rows):
+    count = len(rows)
+    return (
+        np.fromiter((row["user_id"] for row in rows), np.int64, count),
+        np.fromiter((row["score_raw"] for row in rows), np.float64, count),
+        np.fromiter((row["age_days"] for row in rows), np.float64, count),
+        np.fromiter((row["lead_score"] for row in rows), np.int32, count),
+        np.fromiter((row["direct_count"] for row in rows), np.float64, count),
+        np.fromiter((row["downline_count"] for row in rows), np.float64, count),
+    )
+
+
+class LeadScoringEngine:
+    def __init__(self, interval=SCORING_INTERVAL, batch_size=SCORING_BATCH_SIZE, half_life_days=SCORING_HALF_LIFE_DAYS,
+                 scale=SCORING_SCALE, decay_interval=SCORING_DECAY_INTERVAL, weights=None):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.half_life_days = half_life_days
+        self.scale = scale
+        self.decay_interval = decay_interval
+        self.weights = weights or ScoringWeights.from_json(SCORING_WEIGHTS)
+        self._candidate = None  # ה-id המקסימלי שנראה לאחרונה
+        self._candidate_at = 0.0
+        self._safe_upper = 0    # עד כאן כל הטרנזקציות כבר הסתיימו
+        self._safe_known = False
+        self._task = None
+        self.replaying = False  # השלמת היסטוריה - ראה בראש הקובץ
+        self.caught_up = False  # last_id הגיע לגבול הבטוח
+        # מדדים
+        self.runs = 0
+        self.events = 0
+        self.rescored = 0
+        self.last_id = 0
+        self.last_run_ms = 0.0
+        self.decay_passes = 0
+        self.last_decay_ms = 0.0
+        self.last_decay_changed = 0
+        self.errors = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Lead scoring job started.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.run_once() >= self.batch_size:
+                    pass  # יש עוד פיגור - ממשיכים מיד
+                # הדעיכה (וההחלפה הראשונה לניקוד המחושב) רק אחרי שכל האירועים עד הגבול הבטוח נקראו
+                if self.caught_up and await self.decay_due():
+                    await self.decay_all()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Lead scoring failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def rescore(self, events, user_rows):
+        """
+        החישוב עצמו, בלי DB. events: שורות EVENTS_SQL; user_rows: שורות USER_STATE של כל המושפעים.
+        מחזיר (user_ids, score_raw, lead_score, lead_score הקודם).
+        """
+        ids, raw, age_days, old_scores, direct, downline = _columns(user_rows)
+        raw = raw * decay(age_days, self.half_life_days)
+
+        if events:
+            count = len(events)
+            points = self.weights.event_points(
+                np.array([row["source"] for row in events], dtype=object),
+                np.array([row["intent_type"] for row in events], dtype=object),
+            ) * decay(np.fromiter((row["age_days"] for row in events), np.float64, count), self.half_life_days)
+            users, added = sum_by_user(np.fromiter((row["user_id"] for row in events), np.int64, count), points)
+            # יישור לפי user_id: users ממוין, ids בסדר כלשהו
+            position = np.minimum(np.searchsorted(users, ids), len(users) - 1)
+            found = users[position] == ids
+            raw[found] += added[position[found]]
+
+        return ids, raw, to_lead_score(raw, direct, downline, self.weights, self.scale), old_scores
+
+    async def run_once(self):
+        """מעבד את האירועים החדשים ב-crm_leads עד הגבול הבטוח. מחזיר את מספר ה-id שעובדו."""
+        pool = await get_db_pool()
+        if not pool: return 0
+
+        started = time.perf_counter()
+        # Candidate שנצפה לפני interval שניות לפחות הופך לגבול הבטוח לעיבוד
+        if self._candidate is not None and started - self._candidate_at >= self.interval:
+            self._safe_upper, self._candidate = self._candidate, None
+            self._safe_known = True
+
+        processed = 0
+        event_count = 0
+        ids = np.empty(0, np.int64)
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # הגנה מפני שני תהליכים שמריצים את ה-Job במקביל
+                if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", SCORING_LOCK_KEY):
+                    return 0
+                state = await conn.fetchrow("""
+                    SELECT last_id, signups_at, decayed_at IS NULL AS replaying, LOCALTIMESTAMP AS now
+                    FROM scoring_state WHERE name = 'default' FOR UPDATE
+                """)
+                last_id, now, replaying = state["last_id"], state["now"], state["replaying"]
+                upper = min(self._safe_upper, last_id + self.batch_size)
+                events = []
+                if upper > last_id:
+                    events = await conn.fetch(EVENTS_SQL, last_id, upper, now, self.weights.scored_sources())
+                    processed = upper - last_id
+                    last_id = upper
+                # בזמן השלמת ההיסטוריה score_raw עוד חלקי - מעבר הדעיכה בסוף יחשב את ההפניות של כולם
+                referrers = [] if replaying else await conn.fetch(REFERRERS_SQL, state["signups_at"], SIGNUP_OVERLAP)
+
+                affected = {row["user_id"] for row in events} | {row["ancestor_id"] for row in referrers}
+                if affected:
+                    user_rows = await conn.fetch(USER_STATE_BY_IDS_SQL, list(affected), now)
+                    ids, raw, scores, old_scores = self.rescore(events, user_rows)
+                    if replaying:
+                        scores = old_scores  # רק score_raw; ה-lead_score הקיים נשאר עד ההחלפה
+                    applied = await conn.fetchval(APPLY_SCORES_SQL, ids.tolist(), raw.tolist(), scores.tolist(), now)
+                    running_stats.add_score(applied or 0)
+                await conn.execute(
+                    "UPDATE scoring_state SET last_id = $1, signups_at = $2 WHERE name = 'default'", last_id, now
+                )
+                event_count = len(events)
+            if self._candidate is None:
+                self._candidate = await high_water_mark(conn)
+                self._candidate_at = time.perf_counter()
+
+        self._invalidate(ids)
+        self.replaying = replaying
+        self.caught_up = self._safe_known and last_id >= self._safe_upper
+        self.runs += 1
+        self.events += event_count
+        self.rescored += len(ids)
+        self.last_id = last_id
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+        return processed
+
+    async def decay_due(self):
+        pool = await get_db_pool()
+        if not pool: return False
+
+        async with pool.acquire() as conn:
+            return await conn.fetchval("""
+                SELECT decayed_at IS NULL OR decayed_at < LOCALTIMESTAMP - make_interval(secs => $1)
+                FROM scoring_state WHERE name = 'default'
+            """, self.decay_interval)
+
+    async def decay_all(self):
+        """
+        מעבר על כל המשתמשים בדפים של batch_size: דעיכה עד עכשיו ועדכון הניקוד (גם ההפניות).
+        נכתבים רק משתמשים שה-lead_score השלם שלהם השתנה. מחזיר את מספר המשתמשים שעודכנו.
+        """
+        pool = await get_db_pool()
+        if not pool: return 0
+
+        started = time.perf_counter()
+        last_user_id = 0
+        changed_total = 0
+        while True:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute("SELECT pg_advisory_xact_lock($1)", SCORING_LOCK_KEY)
+                    now = await conn.fetchval("SELECT LOCALTIMESTAMP")
+                    rows = await conn.fetch(USER_STATE_PAGE_SQL, last_user_id, now, self.batch_size)
+                    if not rows:
+                        await conn.execute("UPDATE scoring_state SET decayed_at = $1 WHERE name = 'default'", now)
+                        break
+                    ids, raw, scores, old_scores = self.rescore([], rows)
+                    changed = scores != old_scores
+                    if changed.any():
+                        applied = await conn.fetchval(
+                            APPLY_SCORES_SQL, ids[changed].tolist(), raw[changed].tolist(), scores[changed].tolist(), now
+                        )
+                        running_stats.add_score(applied or 0)
+            last_user_id = rows[-1]["user_id"]
+            self._invalidate(ids[changed])
+            changed_total += int(changed.sum())
+
+        self.decay_passes += 1
+        self.last_decay_changed = changed_total
+        self.last_decay_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Lead score decay pass: {changed_total} users changed in {self.last_decay_ms:.0f}ms")
+        return changed_total
+
+    async def rebuild(self):
+        """מאפס את הניקוד הגולמי ומחשב מחדש מכל crm_leads (אחרי שינוי משקלים או זמן מחצית)"""
+        pool = await get_db_pool()
+        if not pool: return
+
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", SCORING_LOCK_KEY)
+                for sql in REBUILD_SQL:
+                    await conn.execute(sql)
+            # ריצה ידנית: כל מה שכבר ב-DB נחשב סגור, בלי להמתין interval
+            self._safe_upper = await high_water_mark(conn)
+            self._safe_known = True
+        while await self.run_once() >= self.batch_size:
+            pass
+        await self.decay_all()
+
+    def _invalidate(self, user_ids):
+        # רק המטמון של התהליך הזה; בתהליכים אחרים הערך מתעדכן עם ה-TTL
+        for user_id in user_ids.tolist():
+            score_cache.invalidate(user_id)
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "events": self.events,
+            "rescored": self.rescored,
+            "last_id": self.last_id,
+            "replaying": self.replaying,
+            "caught_up": self.caught_up,
+            "last_run_ms": round(self.last_run_ms, 1),
+            "decay_passes": self.decay_passes,
+            "last_decay_ms": round(self.last_decay_ms, 1),
+            "last_decay_changed": self.last_decay_changed,
+            "errors": self.errors,
+        }
+
+
+lead_scoring = LeadScoringEngine()
+
+
+async def _main(argv):
+    if argv[1:] not in (["rebuild"], ["decay"]):
+        print(__doc__)
+        return 1
+    await init_db_pool()
+    if not await get_db_pool():
+        return 1
+    try:
+        started = time.perf_counter()
+        if argv[1] == "rebuild":
+            await lead_scoring.rebuild()
+        else:
+            await lead_scoring.decay_all()
+        logger.info(f"Lead scoring {argv[1]} done in {time.perf_counter() - started:.1f}s: {lead_scoring.stats()}")
+    finally:
+        await close_db_pool()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))
@@ -0,0 +1,60 @@
+# קובץ: startup.py
+"""
+פרופיל זמני עליית השרת: import-ים, כל שלב באתחול (גם שלבים שרצים במקביל), וזמן עד מוכנות.
+הדוח זמין ב-GET /startup ונרשם ללוג בסיום; מעבר ל-STARTUP_BUDGET_MS נרשמת אזהרה.
+ready משמש את GET /ready ואת נתיב ה-Webhook (503 עד שהאתחול הסתיים - טלגרם ישלח שוב).
+"""
+
+import time
+from config import STARTUP_BUDGET_MS, logger
+
+
+class StartupProfile:
+    def __init__(self, budget_ms=STARTUP_BUDGET_MS):
+        self.budget_ms = budget_ms
+        self.started = time.perf_counter()
+        self.steps = {}  # שם -> ms, לפי סדר הסיום
+        self.running = set()
+        self.ready = False
+        self.error = None
+        self.total_ms = None
+
+    def record(self, name, seconds):
+        self.steps[name] = round(seconds * 1000, 1)
+
+    async def step(self, name, awaitable):
+        """await awaitable ורישום הזמן שלו תחת name"""
+        self.running.add(name)
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.running.discard(name)
+            self.record(name, time.perf_counter() - started)
+
+    def finish(self):
+        self.total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        self.ready = True
+        breakdown = ", ".join(f"{name}={ms:.0f}ms" for name, ms in self.steps.items())
+        logger.info(f"Ready in {self.total_ms:.0f}ms ({breakdown})")
+        if self.budget_ms and self.total_ms > self.budget_ms:
+            logger.warning(f"Startup took {self.total_ms:.0f}ms, over the {self.budget_ms:.0f}ms budget")
+
+    def fail(self, error):
+        self.error = str(error)
+        self.total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        logger.error(f"Startup failed after {self.total_ms:.0f}ms: {error}")
+
+    def report(self):
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "total_ms": self.total_ms,
+            "budget_ms": self.budget_ms,
+            "pending": sorted(self.running),
+            "steps_ms": dict(self.steps),
+        }
+
+
+# נוצר ב-import הראשון של main, כך שזמן ה-import-ים נמדד מכאן
+startup = StartupProfile()
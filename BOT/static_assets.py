@@ -0,0 +1,192 @@
+# קובץ: static_assets.py
+"""
+הגשת דף הנחיתה (index.html, style.css, scripts.js משורש הריפו) ישירות מה-FastAPI:
+- בעלייה כל קובץ נקרא פעם אחת ונדחס ל-gzip ול-brotli (אם החבילה מותקנת). גרסה דחוסה נשמרת רק אם היא קטנה
+  מהמקור, והבקשות מוגשות מהזיכרון בלי קריאה מהדיסק ובלי דחיסה לכל בקשה.
+- ETag חזק (SHA-256 של התוכן) לכל ייצוג; If-None-Match תואם מחזיר 304 בלי גוף.
+- לכל קובץ שאינו HTML יש גם שם עם טביעת אצבע (style.3f2a9c1d.css) שנשמר במטמון לשנה (immutable),
+  וההפניות אליו מה-HTML נכתבות מחדש לשם הזה. השמות הרגילים נבדקים מול ה-ETag (STATIC_MAX_AGE).
+"""
+
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from collections import Counter, namedtuple
+from config import STATIC_ROOT, STATIC_FILES, STATIC_MAX_AGE, logger
+
+try:
+    import brotli
+except ImportError:  # אופציונלי - בלעדיו מוגש gzip בלבד
+    brotli = None
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+ENCODINGS = ("br", "gzip")  # סדר העדפה כשהלקוח מקבל את שניהם
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# variants: {"identity" / "br" / "gzip": (body, etag)}
+Asset = namedtuple("Asset", ["content_type", "cache_control", "variants"])
+
+
+def _compress(body, content_type):
+    """{encoding: bytes} - רק קידודים שחוסכים בפועל"""
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return {}
+    compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli:
+        compressed["br"] = brotli.compress(body, quality=11)
+    return {encoding: data for encoding, data in compressed.items() if len(data) < len(body)}
+
+
+def _content_type(filename):
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def fingerprinted(filename, digest):
+    name, ext = os.path.splitext(filename)
+    return f"{name}.{digest[:8]}{ext}"
+
+
+def build(root, filenames, max_age=STATIC_MAX_AGE):
+    """{נתיב URL: Asset}. קבצים שאינם HTML נבנים קודם, כדי שה-HTML יפנה לשמות עם טביעת האצבע."""
+    routes = {}
+    renamed = {}  # שם מקורי -> שם עם טביעת אצבע
+    revalidate = f"public, max-age={max_age}, must-revalidate" if max_age else "no-cache"
+    for filename in sorted(filenames, key=lambda name: name.endswith((".html", ".htm"))):
+        with open(os.path.join(root, filename), "rb") as f:
+            body = f.read()
+        content_type = _content_type(filename)
+        if content_type.startswith("text/html") and renamed:
+            html = body.decode("utf-8")
+            for original, target in renamed.items():
+                html = re.sub(rf"""(\b(?:href|src)=["'])(?:\./|/)?{re.escape(original)}(["'])""", rf"\g<1>/{target}\g<2>", html)
+            body = html.encode("utf-8")
+
+        digest = hashlib.sha256(body).hexdigest()
+        variants = {"identity": (body, f'"{digest[:16]}"')}
+        for encoding, data in _compress(body, content_type).items():
+            variants[encoding] = (data, f'"{digest[:16]}-{encoding}"')
+
+        routes[f"/{filename}"] = Asset(content_type, revalidate, variants)
+        if content_type.startswith("text/html"):
+            if filename == "index.html":
+                routes["/"] = routes["/index.html"]
+        else:
+            renamed[filename] = fingerprinted(filename, digest)
+            routes[f"/{renamed[filename]}"] = Asset(content_type, IMMUTABLE_CACHE, variants)
+    return routes
+
+
+def accepted_encodings(header):
+    """הקידודים ב-Accept-Encoding עם q>0. * מתורגם לכל ENCODINGS שלא נדחו במפורש (q=0)."""
+    accepted, rejected = set(), set()
+    for part in (header or "").split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        params = params.strip().replace(" ", "")
+        if not coding:
+            continue
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    rejected.add(coding)
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+    if "*" in accepted:
+        accepted |= set(ENCODINGS) - rejected
+    return accepted
+
+
+def etag_matches(header, etag):
+    """השוואה חלשה לפי If-None-Match: * או אחד מה-ETag-ים ברשימה (W/ לא משנה)"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+class StaticAssets:
+    def __init__(self, root=None, filenames=None, max_age=STATIC_MAX_AGE):
+        self.root = root or STATIC_ROOT or REPO_ROOT
+        self.filenames = filenames or STATIC_FILES
+        self.max_age = max_age
+        self.routes = {}
+        self.loaded = False
+        # מדדים
+        self.requests = 0
+        self.not_modified = 0
+        self.not_found = 0
+        self.bytes_sent = 0
+        self.by_encoding = Counter()
+
+    async def load(self):
+        """קריאה ודחיסה של כל הקבצים (ב-Thread); קובץ חסר נרשם בלוג והשאר מוגשים"""
+        available = [name for name in self.filenames if os.path.isfile(os.path.join(self.root, name))]
+        missing = sorted(set(self.filenames) - set(available))
+        if missing:
+            logger.warning(f"Static assets not found in {self.root}: {', '.join(missing)}")
+        self.routes = await asyncio.to_thread(build, self.root, available, self.max_age)
+        self.loaded = True
+        sizes = self.sizes()
+        logger.info(f"Static assets loaded: {len(available)} files, {sizes['identity']} bytes "
+                    f"(gzip {sizes.get('gzip', 0)}, br {sizes.get('br', 0) or 'n/a'})")
+
+    def serve(self, path, accept_encoding=None, if_none_match=None):
+        """(status, headers, body) או None אם אין קובץ בנתיב הזה"""
+        self.requests += 1
+        asset = self.routes.get(path)
+        if asset is None:
+            self.not_found += 1
+            return None
+
+        accepted = accepted_encodings(accept_encoding)
+        encoding = next((e for e in ENCODINGS if e in asset.variants and e in accepted), "identity")
+        body, etag = asset.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control}
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+
+        if etag_matches(if_none_match, etag):
+            self.not_modified += 1
+            return 304, headers, b""
+
+        headers["Content-Type"] = asset.content_type
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        self.by_encoding[encoding] += 1
+        self.bytes_sent += len(body)
+        return 200, headers, body
+
+    def sizes(self):
+        """סך הבתים לכל קידוד (כל קובץ נספר פעם אחת)"""
+        sizes = Counter()
+        for path, asset in self.routes.items():
+            if asset.cache_control != IMMUTABLE_CACHE and path != "/":
+                for encoding, (body, _) in asset.variants.items():
+                    sizes[encoding] += len(body)
+        return dict(sizes)
+
+    def stats(self):
+        return {
+            "loaded": self.loaded,
+            "routes": len(self.routes),
+            "brotli": brotli is not None,
+            "bytes": self.sizes(),
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "not_found": self.not_found,
+            "by_encoding": dict(self.by_encoding),
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+static_assets = StaticAssets()
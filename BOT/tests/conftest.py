@@ -0,0 +1,8 @@
+# קובץ: tests/conftest.py
+"""הבדיקות מריצים מתוך BOT: python -m pytest tests"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
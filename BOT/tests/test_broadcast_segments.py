@@ -0,0 +1,50 @@
+# קובץ: tests/test_broadcast_segments.py
+"""פילוח שידורים: פירוק הפילטרים מהטקסט, שגיאות על פילטר לא תקין, ובניית ה-WHERE"""
+
+import datetime
+
+import pytest
+
+from broadcast import parse_segment, describe_segment, build_segment_query, recipients_query
+
+
+def test_parse_segment_keeps_message_text_intact():
+    segment, text = parse_segment("campaign=summer min_score=5 from=2025-01-01 שלום!\nשורה שנייה a=b")
+    assert segment == {"campaign": "summer", "min_score": 5, "since": "2025-01-01"}
+    assert text == "שלום!\nשורה שנייה a=b"
+
+
+def test_parse_segment_without_filters():
+    assert parse_segment("  הודעה לכולם ") == ({}, "הודעה לכולם")
+
+
+@pytest.mark.parametrize("body, bad", [
+    ("colour=red שלום", "colour=red"),
+    ("min_score=high שלום", "min_score=high"),
+    ("campaign=x from=2025-13-01 שלום", "from=2025-13-01"),
+])
+def test_parse_segment_rejects_bad_filters(body, bad):
+    with pytest.raises(ValueError) as error:
+        parse_segment(body)
+    assert str(error.value) == bad
+
+
+def test_describe_segment():
+    assert describe_segment({}) == "כל המשתמשים"
+    assert describe_segment({"campaign": "x", "since": "2025-01-01"}) == "campaign=x from=2025-01-01"
+
+
+def test_build_segment_query_numbers_arguments_in_order():
+    where, args = build_segment_query({"campaign": "x", "min_score": 3, "until": "2025-02-01"})
+    assert where == "NOT u.is_blocked AND u.campaign_source = $1 AND u.lead_score >= $2 AND u.created_at < $3"
+    assert args == ["x", 3, datetime.datetime(2025, 2, 1)]
+
+
+def test_build_segment_query_always_excludes_blocked_users():
+    assert build_segment_query({}) == ("NOT u.is_blocked", [])
+
+
+def test_recipients_query_appends_cursor_and_page_size():
+    sql, args = recipients_query({"referrer": 7})
+    assert "u.referred_by = $1 AND u.user_id > $2" in sql and sql.endswith("LIMIT $3")
+    assert args == [7]
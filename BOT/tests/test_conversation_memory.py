@@ -0,0 +1,68 @@
+# קובץ: tests/test_conversation_memory.py
+"""ConversationMemory: במצב משותף (Cluster) ההיסטוריה תמיד נטענת מ-crm_leads"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import conversation_memory
+from conversation_memory import ConversationMemory
+
+
+class FakeConn:
+    def __init__(self):
+        self.rows = []  # החדש ביותר ראשון, כמו ORDER BY created_at DESC
+        self.fetches = 0
+
+    async def fetch(self, sql, *args):
+        self.fetches += 1
+        return list(self.rows)
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.conn
+
+
+def install(monkeypatch, conn):
+    async def get_db_pool():
+        return FakePool(conn)
+    monkeypatch.setattr(conversation_memory, "get_db_pool", get_db_pool)
+
+
+def test_local_memory_loads_once(monkeypatch):
+    conn = FakeConn()
+    conn.rows = [{"message_content": "שלום", "source": "user_msg"}]
+    install(monkeypatch, conn)
+    memory = ConversationMemory(shared=False)
+
+    async def scenario():
+        await memory.get_messages(1)
+        await memory.add_turn(1, "assistant", "היי")
+        return await memory.get_messages(1)
+
+    messages = asyncio.run(scenario())
+    assert conn.fetches == 1
+    assert [m["content"] for m in messages] == ["שלום", "היי"]
+
+
+def test_shared_memory_reloads_every_time(monkeypatch):
+    conn = FakeConn()
+    install(monkeypatch, conn)
+    memory = ConversationMemory(shared=True)
+
+    async def scenario():
+        await memory.get_messages(1)
+        await memory.add_turn(1, "user", "לא נשמר בתהליך")
+        # תהליך אחר כתב תורות בינתיים
+        conn.rows = [{"message_content": "תשובה", "source": "faq_reply"},
+                     {"message_content": "שאלה", "source": "user_msg"}]
+        return await memory.get_messages(1)
+
+    messages = asyncio.run(scenario())
+    assert conn.fetches == 2
+    assert messages == [{"role": "user", "content": "שאלה"}, {"role": "assistant", "content": "תשובה"}]
+    assert memory.stats()["users"] == 0
@@ -0,0 +1,69 @@
+# קובץ: tests/test_faq_index.py
+"""FAQIndex: הדמיון מהאינדקס ההפוך זהה לקוסינוס מחושב ישירות, ו-search עונה / מצרף הקשר"""
+
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from faq_index import FAQEntry, FAQIndex, FAQService, load_corpus, _grams
+from intent_engine import normalize
+
+ENTRIES = [
+    FAQEntry("כמה עולה קמפיין פרסום?", "המחיר מתחיל ב-500 ש\"ח לחודש.", ("מה המחיר",)),
+    FAQEntry("איך מצטרפים לתוכנית השותפים?", "שולחים /start ומשתפים את קוד ה-QR האישי.", ()),
+    FAQEntry("מה שעות הפעילות?", "אנחנו זמינים בימים א-ה בין 9 ל-18.", ()),
+]
+
+
+def dense_cosine(index, query, text):
+    """חישוב ישיר לפי ההגדרה - לבדיקת האינדקס ההפוך"""
+    def weights(grams):
+        return {gram: (1 + math.log(count)) * (index.idf[index.vocabulary[gram]] if gram in index.vocabulary
+                                                else index.unknown_idf)
+                for gram, count in grams.items()}
+
+    q, d = weights(_grams(normalize(query))), weights(_grams(normalize(text)))
+    dot = sum(value * d.get(gram, 0.0) for gram, value in q.items())
+    return dot / math.sqrt(sum(v * v for v in q.values())) / math.sqrt(sum(v * v for v in d.values()))
+
+
+@pytest.mark.parametrize("query", ["כמה עולה פרסום", "שעות פעילות", "מצטרפים לשותפים", "xyz"])
+def test_scores_match_dense_cosine(query):
+    index = FAQIndex(ENTRIES)
+    question_scores, passage_scores = index.scores(query)
+    for i, entry in enumerate(ENTRIES):
+        questions = [dense_cosine(index, query, q) for q in (entry.question, *entry.alternates)]
+        assert question_scores[i] == pytest.approx(max(questions))
+        assert passage_scores[i] == pytest.approx(max(questions + [dense_cosine(index, query, entry.answer)]))
+
+
+def test_exact_question_scores_one_and_empty_index_scores_nothing():
+    question_scores, _ = FAQIndex(ENTRIES).scores("מה המחיר")
+    assert question_scores[0] == pytest.approx(1.0)
+    empty_q, empty_p = FAQIndex([]).scores("מה המחיר")
+    assert len(empty_q) == len(empty_p) == 0
+
+
+def test_search_answers_known_questions_and_adds_context_otherwise():
+    service = FAQService(path="unused", answer_threshold=0.8, context_threshold=0.1, context_passages=2)
+    service.index = FAQIndex(ENTRIES)
+
+    known = service.search("מה המחיר?")
+    assert known.answer == ENTRIES[0].answer and known.context == []
+
+    related = service.search("אני רוצה לדעת על המחיר של קמפיין בפייסבוק")
+    assert related.answer is None
+    assert related.context and related.context[0].startswith("ש: " + ENTRIES[0].question)
+    assert service.stats()["answered"] == 1
+
+
+def test_load_corpus_from_site_html(tmp_path):
+    page = tmp_path / "index.html"
+    page.write_text(
+        '<div class="faq-item"><button class="faq-question">מה <b>המחיר</b>?</button>'
+        '<div class="faq-answer"><p>החל מ-**500** ש"ח<br>לחודש</p></div></div>',
+        encoding="utf-8",
+    )
+    assert load_corpus(str(page)) == [FAQEntry("מה המחיר?", 'החל מ-500 ש"ח לחודש', ())]
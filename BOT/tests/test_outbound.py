@@ -0,0 +1,64 @@
+# קובץ: tests/test_outbound.py
+"""OutboundSender: כל מתודה עוברת בתור של הצ'אט, ו-RetryAfter ארוך לא נשכח עם תפוגת הדלי"""
+
+import asyncio
+
+from telegram.error import RetryAfter
+
+import outbound as outbound_module
+from outbound import OutboundSender, BUCKET_IDLE_TTL
+
+
+class FakeBot:
+    def __init__(self, retry_after=None):
+        self.retry_after = retry_after
+        self.calls = []
+
+    async def send_message(self, chat_id, **kwargs):
+        if self.retry_after:
+            retry_after, self.retry_after = self.retry_after, None
+            raise RetryAfter(retry_after)
+        self.calls.append(("send_message", chat_id, kwargs))
+        return "message"
+
+    async def edit_message_text(self, chat_id, **kwargs):
+        self.calls.append(("edit_message_text", chat_id, kwargs))
+        return True
+
+
+def make_sender(bot, monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(outbound_module.asyncio, "sleep", fake_sleep)
+    sender = OutboundSender(max_retries=1)
+    sender.start(bot)
+    return sender, sleeps
+
+
+def test_call_routes_any_method_through_the_chat_queue(monkeypatch):
+    bot = FakeBot()
+    sender, _ = make_sender(bot, monkeypatch)
+
+    async def scenario():
+        first = await sender.send(42, "שלום")
+        second = await sender.call(42, "edit_message_text", message_id=7, text="עודכן")
+        return first, second
+
+    assert asyncio.run(scenario()) == ("message", True)
+    assert bot.calls == [("send_message", 42, {"text": "שלום"}),
+                         ("edit_message_text", 42, {"message_id": 7, "text": "עודכן"})]
+    assert sender.stats()["sent"] == 2
+
+
+def test_long_retry_after_extends_bucket_ttl(monkeypatch):
+    bot = FakeBot(retry_after=300)
+    sender, sleeps = make_sender(bot, monkeypatch)
+
+    asyncio.run(sender.send(42, "שלום"))
+    assert 300 in sleeps
+    assert sender.stats()["bucket_ttl"] == 300 + BUCKET_IDLE_TTL
+    # הדלי עדיין בהשהיה - ההודעה הבאה ממתינה במקום לצאת מיד
+    assert sender._bucket(42).reserve() > 0
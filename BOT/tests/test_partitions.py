@@ -0,0 +1,69 @@
+# קובץ: tests/test_partitions.py
+"""partitions: חישובי חודשים, High-water mark בזמן העברת הטבלה הישנה, וארכוב מחיצה"""
+
+import asyncio
+import datetime
+import gzip
+
+import partitions
+
+
+class FakeConn:
+    def __init__(self, max_id=0, legacy_min=None, legacy_exists=True, csv=b""):
+        self.max_id = max_id
+        self.legacy_min = legacy_min
+        self.legacy_exists = legacy_exists
+        self.csv = csv
+        self.executed = []
+
+    async def fetchval(self, sql, *args):
+        if "to_regclass" in sql:
+            return partitions.LEGACY_TABLE if self.legacy_exists else None
+        if "MIN(id)" in sql:
+            return self.legacy_min
+        return self.max_id
+
+    async def copy_from_table(self, name, output, **kwargs):
+        # asyncpg שולח את התוכן ב-Chunks
+        for start in range(0, len(self.csv), 7):
+            await output(self.csv[start:start + 7])
+        rows = len(self.csv.splitlines()) - 1  # בלי שורת הכותרת
+        return f"COPY {rows}"
+
+    async def execute(self, sql, *args):
+        self.executed.append(sql)
+
+
+def test_month_helpers():
+    assert partitions.add_months(datetime.date(2025, 11, 1), 3) == datetime.date(2026, 2, 1)
+    assert partitions.add_months(datetime.date(2025, 1, 1), -1) == datetime.date(2024, 12, 1)
+    assert partitions.partition_name(datetime.date(2025, 3, 1)) == "crm_leads_p202503"
+    assert partitions.partition_month("crm_leads_p202503") == datetime.date(2025, 3, 1)
+    assert partitions.partition_month(partitions.DEFAULT_PARTITION) is None
+
+
+def test_high_water_mark_stops_before_unmoved_legacy_rows():
+    assert asyncio.run(partitions.high_water_mark(FakeConn(max_id=500, legacy_min=120))) == 119
+
+
+def test_high_water_mark_without_legacy_rows():
+    assert asyncio.run(partitions.high_water_mark(FakeConn(max_id=500, legacy_min=None))) == 500
+    assert asyncio.run(partitions.high_water_mark(FakeConn(max_id=500, legacy_exists=False))) == 500
+
+
+def test_archive_partition_writes_complete_gzip(tmp_path):
+    csv = b"id,user_id\n1,10\n2,20\n3,30\n"
+    path, rows = asyncio.run(partitions.archive_partition(FakeConn(csv=csv), "crm_leads_p202401", str(tmp_path)))
+    assert rows == 3
+    assert path == str(tmp_path / "crm_leads_p202401.csv.gz")
+    with gzip.open(path, "rb") as f:
+        assert f.read() == csv
+    assert not (tmp_path / "crm_leads_p202401.csv.gz.tmp").exists()
+
+
+def test_retention_keeps_partitions_when_archive_is_not_durable(tmp_path):
+    conn = FakeConn()
+    dropped = asyncio.run(partitions.apply_retention(conn, retention_months=1, archive_dir=str(tmp_path),
+                                                     archive_durable=False))
+    assert dropped == []
+    assert conn.executed == []
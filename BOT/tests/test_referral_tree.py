@@ -0,0 +1,40 @@
+# קובץ: tests/test_referral_tree.py
+"""referral_tree.lock_trees: נעילה לפי שורש העץ, ונעילה חוזרת כשהשורש השתנה בזמן ההמתנה"""
+
+import asyncio
+
+import referral_tree
+
+
+class FakeConn:
+    def __init__(self, roots):
+        self.roots = roots          # user_id -> שורש נוכחי
+        self.on_lock = None         # מדמה עץ שחובר מתחת לעץ אחר בזמן ההמתנה לנעילה
+        self.locks = []
+
+    async def fetchval(self, sql, user_id):
+        return self.roots.get(user_id, user_id)
+
+    async def execute(self, sql, *args):
+        self.locks.append((sql.split("(")[0].split()[-1], args[-1]))
+        if self.on_lock:
+            self.on_lock, callback = None, self.on_lock
+            callback()
+
+
+def test_locks_each_tree_once_in_order():
+    conn = FakeConn({5: 1})
+    asyncio.run(referral_tree.lock_trees(conn, 5, 9))
+    assert conn.locks == [("pg_advisory_xact_lock_shared", referral_tree.REFERRAL_LOCK_KEY),
+                          ("pg_advisory_xact_lock", 1), ("pg_advisory_xact_lock", 9)]
+
+
+def test_relocks_when_root_moves_while_waiting():
+    conn = FakeConn({5: 1})
+
+    def attach():
+        conn.roots[5] = conn.roots[1] = 0
+
+    conn.on_lock = lambda: setattr(conn, "on_lock", attach)
+    asyncio.run(referral_tree.lock_trees(conn, 5))
+    assert [root for _, root in conn.locks[1:]] == [1, 0]
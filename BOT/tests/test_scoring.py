@@ -0,0 +1,56 @@
+# קובץ: tests/test_scoring.py
+"""scoring: דעיכה, מיפוי לניקוד 1-10 וחישוב מחדש בלי DB"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import crm_manager
+import scoring
+from scoring import LeadScoringEngine, ScoringWeights, decay, to_lead_score
+
+
+def user_row(user_id, score_raw=0.0, age_days=0.0, lead_score=1, direct_count=0, downline_count=0):
+    return {"user_id": user_id, "score_raw": score_raw, "age_days": age_days, "lead_score": lead_score,
+            "direct_count": direct_count, "downline_count": downline_count}
+
+
+def test_decay_halves_every_half_life():
+    ages = np.array([0.0, 14.0, 28.0, -3.0])
+    assert np.allclose(decay(ages, 14.0), [1.0, 0.5, 0.25, 1.0])
+
+
+def test_lead_score_is_bounded_and_monotonic():
+    weights = ScoringWeights()
+    raw = np.array([-5.0, 0.0, 5.0, 50.0, 1e6])
+    zeros = np.zeros(len(raw))
+    scores = to_lead_score(raw, zeros, zeros, weights, scale=20.0)
+    assert scores[0] == scores[1] == 1
+    assert scores[-1] == crm_manager.MAX_LEAD_SCORE
+    assert list(scores) == sorted(scores)
+
+
+def test_referrals_raise_the_score():
+    scores = to_lead_score(np.array([5.0, 5.0]), np.array([0.0, 10.0]), np.array([0.0, 40.0]), ScoringWeights(), 20.0)
+    assert scores[1] > scores[0]
+
+
+def test_rescore_decays_old_raw_and_adds_new_events():
+    engine = LeadScoringEngine(half_life_days=10.0, scale=20.0, weights=ScoringWeights())
+    users = [user_row(1, score_raw=8.0, age_days=10.0), user_row(2), user_row(3, score_raw=2.0)]
+    events = [
+        {"user_id": 2, "source": "support_request", "intent_type": "", "age_days": 0.0},
+        {"user_id": 2, "source": "user_msg", "intent_type": "unknown-intent", "age_days": 10.0},
+        {"user_id": 9, "source": "user_msg", "intent_type": "", "age_days": 0.0},  # לא בין המושפעים
+    ]
+    ids, raw, scores, old_scores = engine.rescore(events, users)
+    assert list(ids) == [1, 2, 3]
+    assert np.allclose(raw, [4.0, 4.0 + 0.5, 2.0])
+    assert list(old_scores) == [1, 1, 1]
+    assert list(scores) == list(to_lead_score(raw, np.zeros(3), np.zeros(3), engine.weights, 20.0))
+
+
+def test_score_updates_share_the_histogram_fragment():
+    for sql in (crm_manager.FLUSH_SCORES_SQL, scoring.APPLY_SCORES_SQL):
+        assert "histogram AS (" in sql and "analytics_score_histogram" in sql
+        assert sql.rstrip().endswith("FROM upd")
@@ -0,0 +1,71 @@
+# קובץ: tests/test_static_assets.py
+"""static_assets: בחירת קידוד לפי Accept-Encoding, ETag ו-304, וטביעות אצבע בדף הנחיתה"""
+
+import gzip
+
+import pytest
+
+import static_assets
+from static_assets import StaticAssets, accepted_encodings, etag_matches, IMMUTABLE_CACHE
+
+CSS = b"body { color: #123456; }\n" * 50
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, set()),
+    ("gzip, deflate, br", {"gzip", "deflate", "br"}),
+    ("GZIP;q=0.5, br;q=0", {"gzip"}),
+    ("br; q=bad, gzip", {"gzip"}),
+    ("*", {"*", "br", "gzip"}),
+    ("gzip;q=0, *", {"*", "br"}),
+])
+def test_accepted_encodings(header, expected):
+    assert accepted_encodings(header) == expected
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"x", "abc"', True),
+    ("*", True),
+    ('"abcd"', False),
+])
+def test_etag_matches(header, matches):
+    assert etag_matches(header, '"abc"') is matches
+
+
+@pytest.fixture
+def assets(tmp_path, monkeypatch):
+    # התוצאות לא תלויות בשאלה אם brotli מותקן
+    monkeypatch.setattr(static_assets, "brotli", None)
+    (tmp_path / "index.html").write_bytes(b'<link href="style.css"><script src="./scripts.js"></script>' * 20)
+    (tmp_path / "style.css").write_bytes(CSS)
+    site = StaticAssets(root=str(tmp_path), filenames=["index.html", "style.css"], max_age=0)
+    site.routes = static_assets.build(str(tmp_path), ["index.html", "style.css"], max_age=0)
+    site.loaded = True
+    return site
+
+
+def test_serve_picks_gzip_and_answers_304(assets):
+    status, headers, body = assets.serve("/style.css", "br, gzip")
+    assert status == 200
+    assert headers["Content-Encoding"] == "gzip" and headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(body) == CSS
+
+    status, again, body = assets.serve("/style.css", "gzip", headers["ETag"])
+    assert (status, body) == (304, b"")
+    assert again["ETag"] == headers["ETag"]
+
+    # ה-ETag של הגרסה הדחוסה לא תואם לייצוג הלא דחוס
+    status, plain, body = assets.serve("/style.css", None, headers["ETag"])
+    assert status == 200 and body == CSS and "Content-Encoding" not in plain
+
+
+def test_html_points_to_fingerprinted_assets(assets):
+    status, headers, body = assets.serve("/", "identity")
+    assert status == 200 and headers["Cache-Control"] == "no-cache"
+    fingerprinted = body.decode().split('href="')[1].split('"')[0]
+    assert fingerprinted.startswith("/style.") and fingerprinted != "/style.css"
+    assert assets.serve(fingerprinted)[1]["Cache-Control"] == IMMUTABLE_CACHE
+    assert assets.serve("/missing.js") is None
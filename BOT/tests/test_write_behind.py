@@ -0,0 +1,107 @@
+# קובץ: tests/test_write_behind.py
+"""WriteBehindBuffer: ה-Batch לא הולך לאיבוד בכשל, בביטול באמצע השטיפה או ב-stop"""
+
+import asyncio
+from contextlib import asynccontextmanager
+import pytest
+
+import crm_manager
+from crm_manager import WriteBehindBuffer
+
+
+class FakeConn:
+    def __init__(self, error=None, gate=None):
+        self.error = error
+        self.gate = gate              # אם הוגדר - השטיפה נתקעת עד set()
+        self.entered = asyncio.Event()
+        self.scores = []
+        self.leads = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchval(self, sql, user_ids, points):
+        self.entered.set()
+        if self.gate:
+            await self.gate.wait()
+        if self.error:
+            raise self.error
+        self.scores.append(dict(zip(user_ids, points)))
+        return 0
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.leads.extend(records)
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.conn
+
+
+@pytest.fixture
+def use_conn(monkeypatch):
+    def install(conn):
+        async def get_db_pool():
+            return FakePool(conn)
+        monkeypatch.setattr(crm_manager, "get_db_pool", get_db_pool)
+        return conn
+    return install
+
+
+def test_failed_flush_requeues_batch(use_conn):
+    async def scenario():
+        use_conn(FakeConn(error=RuntimeError("db down")))
+        buffer = WriteBehindBuffer(max_batch=100)
+        buffer.add_score(1, 3)
+        buffer.add_interaction(1, "hi", "user_msg", None)
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert buffer.flush_errors == 1
+    assert buffer.pending_score(1) == 3
+    assert len(buffer._leads) == 1
+
+
+def test_cancelled_flush_requeues_batch(use_conn):
+    async def scenario():
+        conn = use_conn(FakeConn(gate=asyncio.Event()))
+        buffer = WriteBehindBuffer(max_batch=100)
+        buffer.add_score(1, 2)
+        buffer.add_interaction(1, "hi", "user_msg", None)
+        task = asyncio.create_task(buffer.flush())
+        await conn.entered.wait()
+        assert buffer.queue_depth == 0  # ה-Batch כבר הוצא מהתור
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert buffer.pending_score(1) == 2
+    assert len(buffer._leads) == 1
+
+
+def test_stop_finishes_inflight_flush(use_conn):
+    async def scenario():
+        conn = use_conn(FakeConn(gate=asyncio.Event()))
+        buffer = WriteBehindBuffer(max_batch=1, flush_interval=60)
+        buffer.start()
+        buffer.add_score(7, 1)  # max_batch=1 - מעיר את הלולאה
+        await conn.entered.wait()
+        stopping = asyncio.create_task(buffer.stop())
+        await asyncio.sleep(0)
+        assert not stopping.done()
+        conn.gate.set()
+        await stopping
+        return buffer, conn
+
+    buffer, conn = asyncio.run(scenario())
+    assert conn.scores == [{7: 1}]
+    assert buffer.queue_depth == 0
+    assert buffer.flush_errors == 0
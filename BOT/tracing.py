@@ -0,0 +1,135 @@
+# קובץ: tracing.py
+"""
+Tracing מדגמי לעדכונים: לאיזה חלק מזמן הטיפול הלך ל-DB, ל-AI, לטלגרם ול-QR.
+- רק TRACE_SAMPLE_RATE מהעדכונים נדגמים; בעדכון שלא נדגם tracer.add הוא בדיקת ContextVar אחת.
+- ה-Trace עובר דרך ContextVar, כך שכל קוד שרץ בתוך העדכון (כולל Query logger של asyncpg) מוסיף אליו.
+- עדכון שנדגם ונמשך מעל TRACE_SLOW_MS נרשם ללוג ונשמר ברשימת האיטיים האחרונים (GET /traces).
+זמני קטגוריות שרצו במקביל נסכמים, ולכן הסכום יכול לעבור את הזמן הכולל.
+"""
+
+import contextvars
+import random
+import time
+from collections import deque
+from config import TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_KEEP, logger
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    __slots__ = ("name", "attrs", "started", "spans", "counts")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.spans = {}   # קטגוריה -> שניות
+        self.counts = {}  # קטגוריה -> מספר קריאות
+
+    def add(self, category, seconds):
+        self.spans[category] = self.spans.get(category, 0.0) + seconds
+        self.counts[category] = self.counts.get(category, 0) + 1
+
+
+class _TraceScope:
+    __slots__ = ("tracer", "trace", "token")
+
+    def __init__(self, tracer, trace):
+        self.tracer = tracer
+        self.trace = trace
+        self.token = None
+
+    def __enter__(self):
+        if self.trace is not None:
+            self.token = _current.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            _current.reset(self.token)
+            self.tracer._finish(self.trace)
+
+
+class _Span:
+    __slots__ = ("category", "started")
+
+    def __init__(self, category):
+        self.category = category
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        trace = _current.get()
+        if trace is not None:
+            trace.add(self.category, time.perf_counter() - self.started)
+
+
+class Tracer:
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, slow_ms=TRACE_SLOW_MS, keep=TRACE_KEEP):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.slow = deque(maxlen=keep)
+        # מדדים
+        self.sampled = 0
+        self.slow_count = 0
+        self.totals = {}  # קטגוריה -> שניות מצטברות בכל העדכונים שנדגמו
+
+    def trace(self, name, **attrs):
+        """with tracer.trace("update", update_id=...): - מתחיל Trace אם העדכון נדגם"""
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        return _TraceScope(self, Trace(name, attrs) if sampled else None)
+
+    def span(self, category):
+        """with tracer.span("telegram"): - מוסיף את זמן הבלוק ל-Trace הנוכחי, אם יש"""
+        return _Span(category)
+
+    def current(self):
+        """ה-Trace של העדכון הנוכחי, או None אם לא נדגם"""
+        return _current.get()
+
+    def detach(self):
+        """בתחילת Task רקע שנוצר מתוך עדכון: העבודה שלו לא תיזקף ל-Trace של העדכון שיצר אותו"""
+        _current.set(None)
+
+    def add(self, category, seconds):
+        trace = _current.get()
+        if trace is not None:
+            trace.add(category, seconds)
+
+    def _finish(self, trace):
+        total_ms = (time.perf_counter() - trace.started) * 1000
+        self.sampled += 1
+        for category, seconds in trace.spans.items():
+            self.totals[category] = self.totals.get(category, 0.0) + seconds
+        if total_ms < self.slow_ms:
+            return
+
+        self.slow_count += 1
+        breakdown = {category: round(seconds * 1000, 1) for category, seconds in trace.spans.items()}
+        self.slow.append({
+            "name": trace.name,
+            **trace.attrs,
+            "at": time.time(),
+            "total_ms": round(total_ms, 1),
+            "spans_ms": breakdown,
+            "calls": dict(trace.counts),
+        })
+        parts = ", ".join(f"{category}={ms}ms" for category, ms in breakdown.items()) or "no spans"
+        logger.warning(f"Slow {trace.name} {trace.attrs}: {total_ms:.0f}ms ({parts})")
+
+    def recent(self):
+        return list(self.slow)
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "sampled": self.sampled,
+            "slow": self.slow_count,
+            "avg_ms": {
+                category: round(seconds / self.sampled * 1000, 2) for category, seconds in self.totals.items()
+            } if self.sampled else {},
+        }
+
+
+tracer = Tracer()
@@ -1,11 +1,157 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
 from telegram import Update
-from telegram.ext import Application
-from config import logger
-
-async def process_webhook_update(application: Application, request_body: dict):
-    """מקבל את ה-JSON מ-FastAPI ומעביר אותו ל-Bot Application"""
-    try:
-        update = Update.de_json(request_body, application.bot)
-        await application.process_update(update)
-    except Exception as e:
-        logger.error(f"Error processing update: {e}")
+from metrics import Histogram
+from tracing import tracer
+from config import (INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_ENQUEUE_TIMEOUT, INGEST_DEDUPE_SIZE,
+                    INGEST_DRAIN_TIMEOUT, logger)
+
+def chat_key(body):
+    """המפתח לשמירת סדר: מזהה הצ'אט (או המשתמש) שאליו שייך העדכון"""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if field in body:
+            return body[field].get("chat", {}).get("id")
+    callback = body.get("callback_query")
+    if callback:
+        message = callback.get("message") or {}
+        return message.get("chat", {}).get("id") or callback.get("from", {}).get("id")
+    for value in body.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+class UpdateIngestor:
+    """
+    קליטת Webhook מהירה: העדכון נבדק, נכנס לתור ומוחזר 200 מיד, והעיבוד רץ במאגר Workers.
+    - סדר לכל צ'אט: לכל צ'אט תור משלו, ורק Worker אחד מעבד צ'אט בכל רגע (בלי לחסום צ'אטים אחרים).
+    - תור חסום: כשהתור מלא ממתינים עד enqueue_timeout, ואז מחזירים 503 וטלגרם ישלח שוב.
+    - ללא כפילויות: update_id שכבר התקבל נזרק.
+    """
+
+    def __init__(self, workers=INGEST_WORKERS, queue_size=INGEST_QUEUE_SIZE,
+                 enqueue_timeout=INGEST_ENQUEUE_TIMEOUT, dedupe_size=INGEST_DEDUPE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.enqueue_timeout = enqueue_timeout
+        self.dedupe_size = dedupe_size
+        self._capacity = asyncio.Semaphore(queue_size)
+        self._pending = {}             # chat -> deque של (body, enqueued_at)
+        self._ready = asyncio.Queue()  # צ'אטים שיש להם עדכון ממתין ואף Worker לא מעבד אותם
+        self._seen = OrderedDict()     # update_id אחרונים
+        self._application = None
+        self._tasks = []
+        self._accepting = False
+        self.depth = 0
+        # מדדים
+        self.accepted = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.errors = 0
+        self.queue_wait = Histogram()
+        self.processing = Histogram()
+
+    def start(self, application):
+        self._application = application
+        self._accepting = True
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Update ingestor started with {self.workers} workers.")
+
+    async def stop(self, drain_timeout=INGEST_DRAIN_TIMEOUT):
+        """מפסיק לקבל עדכונים, ממתין לריקון התור ואז עוצר את ה-Workers"""
+        self._accepting = False
+        deadline = time.monotonic() + drain_timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth:
+            logger.warning(f"Update ingestor stopped with {self.depth} updates still queued.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, body):
+        """מחזיר 'queued' / 'duplicate' / 'dropped' / 'invalid'"""
+        if not isinstance(body, dict) or not isinstance(body.get("update_id"), int):
+            self.invalid += 1
+            return "invalid"
+        update_id = body["update_id"]
+        if update_id in self._seen:
+            self.duplicates += 1
+            return "duplicate"
+        if not self._accepting:
+            self.dropped += 1
+            return "dropped"
+
+        try:
+            await asyncio.wait_for(self._capacity.acquire(), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            return "dropped"
+        # בדיקה חוזרת - ייתכן שאותו עדכון התקבל בזמן ההמתנה למקום בתור
+        if update_id in self._seen:
+            self._capacity.release()
+            self.duplicates += 1
+            return "duplicate"
+
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedupe_size:
+            self._seen.popitem(last=False)
+
+        key = chat_key(body)
+        if key is None:
+            key = f"update:{update_id}"
+        item = (body, time.perf_counter())
+        queue = self._pending.get(key)
+        if queue is None:
+            self._pending[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            # הצ'אט כבר בתור או בעיבוד - ה-Worker שמטפל בו ימשיך אליו
+            queue.append(item)
+        self.depth += 1
+        self.accepted += 1
+        return "queued"
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            body, enqueued_at = queue.popleft()
+            started = time.perf_counter()
+            self.queue_wait.observe(started - enqueued_at)
+            try:
+                with tracer.trace("update", update_id=body.get("update_id")):
+                    update = Update.de_json(body, self._application.bot)
+                    await self._application.process_update(update)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Error processing update: {e}")
+            finally:
+                self.processing.observe(time.perf_counter() - started)
+                self.depth -= 1
+                self._capacity.release()
+                if queue:
+                    # חוזר לסוף התור כדי לא להרעיב צ'אטים אחרים
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth,
+            "queue_size": self.queue_size,
+            "active_chats": len(self._pending),
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "queue_wait": self.queue_wait.snapshot(),
+            "processing": self.processing.snapshot(),
+        }
+
+
+update_ingestor = UpdateIngestor()